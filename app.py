@@ -1,43 +1,138 @@
-import json
-from typing import List, Dict
+# Imported first so startup timing covers the other imports
+from startup import ensure_tiktoken_encoding, startup_timer
+from typing import Awaitable, List, Dict, Optional
 
 import asyncio
+import logging
+import math
 import os
+import time
 
 from fastapi import (
     FastAPI,
     Security,
     HTTPException,
-    UploadFile,
+    Query,
+    Request,
+    Response,
 )
 from fastapi.middleware.cors import CORSMiddleware
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from sse_starlette.sse import EventSourceResponse
 from fastapi_jwt import JwtAuthorizationCredentials, JwtAccessBearer, JwtRefreshBearer
 from pydantic import BaseModel
 from uuid import uuid4
 import pinecone
 
-from file_handler import FileHandler
-from material import MaterialVectorstore, Material
-from question import Question
+from clients import bind_http_session, close_http_session, close_index, uses_pinecone
+from file_handler import FileHandler, FileTooLarge, InvalidUpload, MultipartUpload
+from ingestion import IngestionPipeline, IngestionJob, IngestionQueueFull
+from material import ANSWER_MODEL_NAME, MaterialVectorstore, Material, embedding_cache
+from question import QUESTION_MODEL_NAME, Question
+from scheduler import SchedulerOverloaded, Ticket, scheduler
+from storage import FileCache, InvalidCursor, get_document_index, get_storage_backend
 from streaming_utils import (
     Stream,
-    QuestionFilteredAsyncCallbackHandler,
     NonFilteredAsyncCallbackHandler,
 )
+from telemetry import configure_logging, observe_stage, span
 from utils import (
     document_from_dict,
 )
 
+startup_timer.mark("imports")
+configure_logging()
+logger = logging.getLogger(__name__)
+
 if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
 
-pinecone.init(
-    api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENV"]
+if uses_pinecone():
+    with startup_timer.phase("pinecone"):
+        pinecone.init(
+            api_key=os.environ["PINECONE_API_KEY"], environment=os.environ["PINECONE_ENV"]
+        )
+
+document_index = get_document_index()
+file_handler = FileHandler(
+    storage=get_storage_backend(),
+    index=document_index,
+    cache=FileCache(
+        os.environ.get("FILE_CACHE_PATH", "cache/files"),
+        max_bytes=int(os.environ.get("FILE_CACHE_MAX_BYTES", 2 * 1024**3)),
+    ),
 )
+max_upload_bytes = int(os.environ.get("MAX_UPLOAD_BYTES", 50 * 1024**2))
+# Tokens a request is expected to use, charged to the rate limits when it starts
+completion_token_estimate = int(os.environ.get("COMPLETION_TOKEN_ESTIMATE", 4000))
+question_doc_token_estimate = int(os.environ.get("QUESTION_DOC_TOKEN_ESTIMATE", 8000))
+# /question_doc holds a slot for each page it sends to the LLM at once
+question_page_concurrency = int(os.environ.get("QUESTION_PAGE_CONCURRENCY", 4))
+
+
+async def ingest_document(job: IngestionJob):
+    document = await asyncio.to_thread(document_index.get, job.user_id, job.document_id)
+    if document is None:
+        return
+    version = job.version or document["object_key"]
+    pending = document["pending_object_key"] == version
+    if not pending and version != document["object_key"]:
+        # A newer upload replaced this version before it was ingested
+        await file_handler.drop_version(job.user_id, job.document_id, version)
+        return
+
+    await asyncio.to_thread(
+        document_index.update_status, job.user_id, job.document_id, "processing"
+    )
+    with span("ingestion"):
+        await MaterialVectorstore(job.user_id, document_index).aadd_docs_from_file(
+            await file_handler.get_file(job.user_id, job.document_id, object_key=version),
+            progress_callback=job.update,
+            document_id=job.document_id,
+            cancelled=job.cancelled,
+        )
+    if pending:
+        await file_handler.promote_version(
+            job.user_id,
+            job.document_id,
+            document["pending_content_hash"],
+            version,
+            document["pending_size"],
+        )
+
+
+async def delete_document(user_id: str, document_id: str):
+    await MaterialVectorstore(user_id, document_index).adelete_document(document_id)
+    await file_handler.delete_file(user_id, document_id)
+
+
+async def discard_document(job: IngestionJob):
+    """Clean up after a failed ingestion, keeping the version the document serves."""
+    document = await asyncio.to_thread(document_index.get, job.user_id, job.document_id)
+    if document is None:
+        return
+    version = job.version or document["object_key"]
+    if version == document["object_key"] and document["pending_object_key"] != version:
+        # The document's first version, there is nothing to fall back to
+        await delete_document(job.user_id, job.document_id)
+    else:
+        await file_handler.drop_version(job.user_id, job.document_id, version)
+
 
-file_handler = FileHandler()
+async def drop_cancelled_versions(jobs: List[IngestionJob]):
+    """Release the uploads of jobs cancelled before they could use them."""
+    for job in jobs:
+        if job.version is not None:
+            await file_handler.drop_version(job.user_id, job.document_id, job.version)
+
+
+ingestion_pipeline = IngestionPipeline(
+    ingest_document,
+    on_failure=discard_document,
+    workers=int(os.environ.get("INGESTION_WORKERS", 2)),
+    max_queue_size=int(os.environ.get("INGESTION_QUEUE_SIZE", 100)),
+)
 
 app = FastAPI()
 app.add_middleware(
@@ -45,8 +140,27 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+
+@app.on_event("startup")
+async def startup():
+    # Loaded here so the first upload or question does not wait for it, and so
+    # the server does not start at all without it
+    await asyncio.to_thread(ensure_tiktoken_encoding)
+    await file_handler.migrate_legacy_uploads(os.environ.get("LEGACY_UPLOADS_PATH", "uploads"))
+    await ingestion_pipeline.start()
+    startup_timer.mark("startup")
+    logger.info(startup_timer.report())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await ingestion_pipeline.stop()
+    await close_http_session()
+    await asyncio.to_thread(close_index)
+
 # Read access token from bearer header
 access_security = JwtAccessBearer(
     secret_key=os.environ["JWT_ACCESS_SECRET"],
@@ -77,42 +191,205 @@ def refresh(credentials: JwtAuthorizationCredentials = Security(refresh_security
     return {"access_token": access_token, "refresh_token": refresh_token}
 
 
-@app.post("/upload")
+# The body is parsed by MultipartUpload, this documents the form it expects
+UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["file"],
+                "properties": {"file": {"type": "string", "format": "binary"}},
+            }
+        }
+    },
+}
+
+
+@app.post("/upload", openapi_extra={"requestBody": UPLOAD_REQUEST_BODY})
 async def upload_file(
-    file: UploadFile,
+    request: Request,
+    document_id: Optional[str] = None,
     credentials: JwtAuthorizationCredentials = Security(access_security),
 ):
+    """Upload a new document, or a new version of ``document_id``.
+
+    The ``file`` form field is streamed into storage as it is received.
+    """
     user_id = credentials["sub"]
 
-    document_id = file_handler.save_file(file, user_id)
     try:
-        MaterialVectorstore(user_id).add_docs_from_file(
-            file_handler.get_file(user_id, document_id)
-        )
-    except Exception as e:
-        print(f"Exception while adding file to vectorstore: {e}")
-        file_handler.delete_file(user_id, document_id)
+        upload = MultipartUpload(request.headers, request.stream())
+        filename = await upload.open()
+        with span("upload"):
+            saved_file = await file_handler.save_file(
+                filename, upload.chunks(), user_id, max_upload_bytes, document_id=document_id
+            )
+    except InvalidUpload as e:
         raise HTTPException(status_code=400, detail=f"File failed to upload: {e}")
+    except FileTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"File failed to upload: {e}")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    if saved_file.duplicate:
+        # Same content as a document the user already has, nothing to ingest
+        return {
+            "message": f"File already uploaded",
+            "document_id": saved_file.document_id,
+            "job_id": None,
+        }
+
+    try:
+        job = ingestion_pipeline.submit(
+            user_id, saved_file.document_id, version=saved_file.object_key
+        )
+    except IngestionQueueFull as e:
+        if document_id is None:
+            await delete_document(user_id, saved_file.document_id)
+        else:
+            await file_handler.drop_version(user_id, document_id, saved_file.object_key)
+        raise HTTPException(status_code=503, detail=f"File failed to upload: {e}")
+
+    return {
+        "message": f"File uploaded successfully",
+        "document_id": saved_file.document_id,
+        "job_id": job.job_id,
+    }
+
+
+@app.get("/upload-status/{job_id}")
+def upload_status(
+    job_id: str,
+    credentials: JwtAuthorizationCredentials = Security(access_security),
+):
+    user_id = credentials["sub"]
+    job = ingestion_pipeline.get_job(job_id)
+    if job is None or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return job.to_dict()
+
+
+class DeleteFileBody(BaseModel):
+    document_id: str
 
-    await file.close()
-    return {"message": f"File uploaded successfully", "document_id": document_id}
+
+@app.post("/delete-file")
+async def delete_file(
+    body: DeleteFileBody,
+    credentials: JwtAuthorizationCredentials = Security(access_security),
+):
+    user_id = credentials["sub"]
+    if not await file_handler.file_exists(user_id, body.document_id):
+        raise HTTPException(status_code=404, detail="File not found")
+    # A running ingestion would keep upserting vectors after they are deleted
+    cancelled = await ingestion_pipeline.cancel(user_id, body.document_id)
+    await delete_document(user_id, body.document_id)
+    await drop_cancelled_versions(cancelled)
+
+    return {"message": f"File deleted successfully"}
 
 
 @app.post("/delete-files")
-def delete_files(credentials: JwtAuthorizationCredentials = Security(access_security)):
+async def delete_files(
+    credentials: JwtAuthorizationCredentials = Security(access_security),
+):
     user_id = credentials["sub"]
-    file_handler.delete_user_files(user_id)
-    MaterialVectorstore(user_id).delete_vectorstore()
+    cancelled = await ingestion_pipeline.cancel(user_id)
+    await asyncio.to_thread(MaterialVectorstore(user_id).delete_vectorstore)
+    await file_handler.delete_user_files(user_id)
+    await drop_cancelled_versions(cancelled)
 
     return {"message": f"Files deleted successfully"}
 
 
 @app.get("/list-files")
 def list_files(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
     credentials: JwtAuthorizationCredentials = Security(access_security),
 ):
     user_id = credentials["sub"]
-    return file_handler.list_files(user_id)
+    try:
+        files, next_cursor = file_handler.list_files(user_id, limit, cursor)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if next_cursor is not None:
+        # The body stays a plain list, the next page is requested with ?cursor=
+        response.headers["X-Next-Cursor"] = next_cursor
+    return files
+
+
+@app.get("/embedding-cache-stats")
+def embedding_cache_stats():
+    return embedding_cache.stats()
+
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/scheduler-stats")
+def scheduler_stats():
+    return scheduler.stats()
+
+
+def new_stream() -> Stream:
+    return Stream(
+        maxsize=int(os.environ.get("STREAM_MAX_EVENTS", 256)),
+        coalesce_window=float(os.environ.get("STREAM_COALESCE_WINDOW", 0)),
+        max_frame_bytes=int(os.environ.get("STREAM_MAX_FRAME_BYTES", 4096)),
+    )
+
+
+def schedule(
+    user_id: str, model: str, tokens: int, stream: Stream, slots: int = 1
+) -> Ticket:
+    """Queue an LLM-backed request, refusing it with a 429 when overloaded."""
+
+    async def send_position(position: int):
+        await stream.asend({"event": "queue_position", "data": {"position": position}})
+
+    try:
+        return scheduler.enqueue(
+            user_id, model, tokens, on_position=send_position, slots=slots
+        )
+    except SchedulerOverloaded as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+
+
+async def run_scheduled(ticket: Ticket, producer: Awaitable[None]):
+    queued_at = time.perf_counter()
+    async with ticket:
+        observe_stage("queue_wait", time.perf_counter() - queued_at)
+        await producer
+
+
+def stream_response(
+    stream: Stream, producer: Awaitable[None], ticket: Optional[Ticket] = None
+) -> EventSourceResponse:
+    if ticket is not None:
+        producer = run_scheduled(ticket, producer)
+    task = asyncio.ensure_future(stream.run(producer))
+    if ticket is not None:
+        # Frees the slot even if the task is cancelled before the producer starts
+        task.add_done_callback(lambda _: scheduler.release(ticket))
+
+    async def event_publisher():
+        try:
+            async for frame in stream:
+                yield frame
+        finally:
+            # Client disconnected or stream ended, release the producer and buffer
+            task.cancel()
+            stream.abort()
+
+    return EventSourceResponse(event_publisher())
 
 
 class QuestionDocBody(BaseModel):
@@ -125,30 +402,31 @@ async def sse_question_doc(
     credentials: JwtAuthorizationCredentials = Security(access_security),
 ) -> EventSourceResponse:
     user_id = credentials["sub"]
-    stream = Stream()
-    task = asyncio.ensure_future(question_doc(user_id, body, stream))
-
-    async def event_publisher():
-        try:
-            async for event in stream:
-                yield json.dumps(event)
-        except asyncio.CancelledError as e:
-            task.cancel()
-            raise e
-
-    return EventSourceResponse(event_publisher())
+    stream = new_stream()
+    ticket = schedule(
+        user_id,
+        QUESTION_MODEL_NAME,
+        question_doc_token_estimate,
+        stream,
+        slots=question_page_concurrency,
+    )
+    return stream_response(stream, question_doc(user_id, body, stream), ticket)
 
 
 async def question_doc(user_id: str, body: QuestionDocBody, stream: Stream):
     document_id = body.document_id
-    if not file_handler.file_exists(user_id, document_id):
+    if not await file_handler.file_exists(user_id, document_id):
         raise HTTPException(status_code=400, detail="File not found")
 
-    question_filtered_callback = QuestionFilteredAsyncCallbackHandler(stream)
-    await Question(question_filtered_callback).get_questions_and_context(
-        file_handler.get_file(user_id, document_id)
-    )
-    await question_filtered_callback.on_end()
+    file_path = await file_handler.get_file(user_id, document_id)
+    bind_http_session()
+    with span("question_doc"):
+        await Question(stream).get_questions_and_context(
+            file_path,
+            content_hash=await file_handler.get_file_hash(user_id, document_id),
+            source=document_id,
+        )
+    await stream.asend({"event": "end_stream"})
 
 
 class CompletionBody(BaseModel):
@@ -162,18 +440,9 @@ async def sse_completion(
     credentials: JwtAuthorizationCredentials = Security(access_security),
 ) -> EventSourceResponse:
     user_id = credentials["sub"]
-    stream = Stream()
-    task = asyncio.ensure_future(completion(user_id, body, stream))
-
-    async def event_publisher():
-        try:
-            async for event in stream:
-                yield json.dumps(event)
-        except asyncio.CancelledError as e:
-            task.cancel()
-            raise e
-
-    return EventSourceResponse(event_publisher())
+    stream = new_stream()
+    ticket = schedule(user_id, ANSWER_MODEL_NAME, completion_token_estimate, stream)
+    return stream_response(stream, completion(user_id, body, stream), ticket)
 
 
 async def completion(user_id: str, body: CompletionBody, stream: Stream):
@@ -183,9 +452,11 @@ async def completion(user_id: str, body: CompletionBody, stream: Stream):
     prompt_doc = document_from_dict(prompt)
     chat_history = body.chat_history
 
+    bind_http_session()
     unfiltered_callback = NonFilteredAsyncCallbackHandler(stream)
     material = Material(user_id, unfiltered_callback)
-    await material.ask_docs(prompt_doc, chat_history)
+    with span("completion"):
+        await material.ask_docs(prompt_doc, chat_history)
     await unfiltered_callback.on_end()
 
 
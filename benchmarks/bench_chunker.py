@@ -0,0 +1,105 @@
+"""Chunk count, token sizes and throughput of the ingestion chunkers.
+
+Compares the previous RecursiveCharacterTextSplitter (2000 characters, 200
+overlap) with TokenChunker on synthetic lecture notes whose pages have a
+running header, a page number footer, headings, paragraphs, formulas and
+tables. "split blocks" counts tables and formulas that do not end up whole
+in a single chunk.
+
+    python -m benchmarks.bench_chunker --pages 200
+
+Tokens are counted with the encoding downloaded by ``python startup.py``,
+or with the fakes' approximate tokenizer given ``--approximate-tokenizer``.
+"""
+import argparse
+import random
+import statistics
+import time
+
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from benchmarks import fakes
+from material.chunker import TokenChunker
+from utils import count_tokens_batch
+
+WORDS = (
+    "the function converges uniformly on every compact subset so the limit is continuous "
+    "and the integral of the limit equals the limit of the integrals by dominated convergence"
+).split()
+
+
+def make_pages(pages: int, seed: int = 0):
+    rng = random.Random(seed)
+    docs, blocks = [], []
+    for page in range(pages):
+        parts = ["MA 201 Real Analysis - Lecture Notes"]
+        for section in range(rng.randint(1, 3)):
+            parts.append(f"{page + 1}.{section + 1} Uniform Convergence Of Series {section}")
+            for _ in range(rng.randint(1, 4)):
+                parts.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 160))) + ".")
+            if rng.random() < 0.5:
+                formula = "\n".join(
+                    f"f_{index}(x) = sum_(k=0)^(n) a_k x^k / (1 + {index} x^2)" for index in range(4)
+                )
+                parts.append(formula)
+                blocks.append(formula)
+            if rng.random() < 0.3:
+                table = "\n".join(
+                    f"| n = {row} | {rng.random():.4f} | {rng.random():.4f} | {rng.random():.4f} |"
+                    for row in range(12)
+                )
+                parts.append(table)
+                blocks.append(table)
+        parts.append(f"Page {page + 1} of {pages}")
+        docs.append(
+            Document(page_content="\n\n".join(parts), metadata={"source": "notes", "page": page})
+        )
+    return docs, blocks
+
+
+def run(name, splitter, docs, blocks):
+    start = time.perf_counter()
+    chunks = splitter.split_documents(
+        [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in docs]
+    )
+    elapsed = time.perf_counter() - start
+    tokens = count_tokens_batch([chunk.page_content for chunk in chunks])
+    split_blocks = sum(
+        not any(block in chunk.page_content for chunk in chunks) for block in blocks
+    )
+    boilerplate = sum("Lecture Notes" in chunk.page_content for chunk in chunks)
+    print(
+        f"{name:<16} chunks {len(chunks):6d}  tokens embedded {sum(tokens):8d}"
+        f"  per chunk mean {statistics.mean(tokens):6.1f} stdev {statistics.pstdev(tokens):6.1f}"
+        f" max {max(tokens):5d}  split blocks {split_blocks:4d}/{len(blocks)}"
+        f"  chunks with header {boilerplate:5d}  {len(docs) / elapsed:8.1f} pages/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--chunk-tokens", type=int, default=512)
+    parser.add_argument(
+        "--approximate-tokenizer",
+        action="store_true",
+        help="count tokens with the fakes' tokenizer instead of cl100k_base",
+    )
+    args = parser.parse_args()
+
+    if args.approximate_tokenizer:
+        fakes.use_approximate_encoding()
+    docs, blocks = make_pages(args.pages)
+    count_tokens_batch(["warm up the encoding"])
+    run(
+        "character 2000",
+        RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200),
+        docs,
+        blocks,
+    )
+    run(f"token {args.chunk_tokens}", TokenChunker(chunk_tokens=args.chunk_tokens), docs, blocks)
+
+
+if __name__ == "__main__":
+    main()
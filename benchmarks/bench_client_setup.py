@@ -0,0 +1,64 @@
+"""Per-request setup cost of Material and Question.
+
+"cold" clears the client registry before every construction, which is what
+every request paid before clients were shared. "warm" reuses the process-wide
+clients. No network calls are made.
+
+    python -m benchmarks.bench_client_setup --iterations 200
+"""
+import argparse
+import os
+import statistics
+import time
+
+for key in ("OPENAI_API_KEY", "PINECONE_API_KEY", "PINECONE_ENV", "PINECONE_INDEX"):
+    os.environ.setdefault(key, "benchmark")
+
+from clients import reset_clients
+from material import Material
+from material.material import _get_shared_chains
+from question import Question
+from question.question import _get_question_chain
+from streaming_utils import Stream, NonFilteredAsyncCallbackHandler
+
+
+def _clear_registry():
+    reset_clients()
+    _get_shared_chains.cache_clear()
+    _get_question_chain.cache_clear()
+
+
+def _time_setup(build, iterations, cold):
+    timings = []
+    for _ in range(iterations):
+        if cold:
+            _clear_registry()
+        start = time.perf_counter()
+        build()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1000
+    p99 = timings[int(len(timings) * 0.99) - 1] * 1000
+    print(f"{name:<16} p50 {p50:8.3f} ms   p99 {p99:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    builders = {
+        "Material": lambda: Material("benchmark", NonFilteredAsyncCallbackHandler(Stream())),
+        "Question": lambda: Question(Stream()),
+    }
+    for name, build in builders.items():
+        _report(f"{name} cold", _time_setup(build, args.iterations, cold=True))
+        _report(f"{name} warm", _time_setup(build, args.iterations, cold=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Throughput of QuestionFilteredAsyncCallbackHandler over token streams.
+
+Feeds a question extraction response to the previous per-character handler
+and to the current DelimiterScanner based one, in two shapes: split into the
+token boundaries the OpenAI API streams (cl100k_base), and as one token the
+way cached /question_doc results are replayed.
+
+    python -m benchmarks.bench_delimiter_scanner --pages 200
+
+The token boundaries come from the encoding downloaded by ``python
+startup.py``, or from the fakes' approximate tokenizer given
+``--approximate-tokenizer``.
+"""
+import argparse
+import asyncio
+import time
+
+import utils
+from benchmarks import fakes
+from streaming_utils import QuestionFilteredAsyncCallbackHandler
+
+QUESTION = "###QQQ###"
+CONTEXT = "###CCC###"
+
+
+def record_token_stream(pages: int) -> list:
+    lines = [f"{CONTEXT} A table of {pages} measurements is given below. {CONTEXT}"]
+    for index in range(pages):
+        lines.append(
+            f"{QUESTION} Prove: for every n > {index}, the sum of the first n odd "
+            f"numbers equals n^2 (see table row #{index}). {QUESTION}"
+        )
+        lines.append(f"{QUESTION} Answer: what is the derivative of x^{index}? {QUESTION}")
+    encoding = utils._get_encoding()
+    return [encoding.decode([token]) for token in encoding.encode("\n".join(lines))]
+
+
+class NullStream:
+    def __init__(self):
+        self.events = []
+
+    async def asend(self, value: dict) -> None:
+        self.events.append(value)
+
+
+class LegacyQuestionHandler:
+    """The per-character matcher the handler used before DelimiterScanner."""
+
+    def __init__(self, stream, delimiter: str = QUESTION):
+        self.stream = stream
+        self.delimiter = delimiter
+        self.delimiter_index = 0
+        self.send_tokens = False
+        self.token_buffer = ""
+
+    async def on_llm_new_token(self, token: str) -> None:
+        for char in token:
+            if char == self.delimiter[self.delimiter_index]:
+                self.delimiter_index += 1
+                if self.delimiter_index == len(self.delimiter):
+                    self.delimiter_index = 0
+                    self.send_tokens = not self.send_tokens
+                    if not self.send_tokens:
+                        await self.stream.asend(
+                            {
+                                "event": "new_token",
+                                "data": {"token": self.token_buffer, "delimiter": True},
+                            }
+                        )
+                        self.token_buffer = ""
+            else:
+                if self.send_tokens:
+                    self.token_buffer += self.delimiter[: self.delimiter_index]
+                    self.token_buffer += char
+                self.delimiter_index = 0
+        if self.send_tokens and self.token_buffer:
+            await self.stream.asend(
+                {"event": "new_token", "data": {"token": self.token_buffer}}
+            )
+            self.token_buffer = ""
+
+
+async def _replay(handler, tokens: list) -> float:
+    start = time.perf_counter()
+    for token in tokens:
+        await handler.on_llm_new_token(token)
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--approximate-tokenizer",
+        action="store_true",
+        help="split the stream with the fakes' tokenizer instead of cl100k_base",
+    )
+    args = parser.parse_args()
+
+    if args.approximate_tokenizer:
+        fakes.use_approximate_encoding()
+    tokens = record_token_stream(args.pages)
+    scenarios = {"streamed": tokens, "replayed": ["".join(tokens)]}
+    handlers = {
+        "legacy": lambda stream: LegacyQuestionHandler(stream),
+        "scanner": lambda stream: QuestionFilteredAsyncCallbackHandler(stream),
+    }
+    characters = sum(map(len, tokens))
+    for scenario, scenario_tokens in scenarios.items():
+        print(f"{scenario}: {len(scenario_tokens)} tokens, {characters} characters")
+        for name, build in handlers.items():
+            best = float("inf")
+            for _ in range(args.repeat):
+                stream = NullStream()
+                best = min(best, await _replay(build(stream), scenario_tokens))
+            questions = sum(
+                1
+                for event in stream.events
+                if event["data"].get("delimiter")
+                and event["data"].get("type", "question") == "question"
+            )
+            print(
+                f"  {name:<8} {best * 1000:8.2f} ms   "
+                f"{characters / best / 1e6:8.2f} M chars/s   {questions} questions"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
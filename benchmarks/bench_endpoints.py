@@ -0,0 +1,285 @@
+"""Load test of /upload, /completion and /question_doc against local fakes.
+
+Starts the server in-process on a free port with the OpenAI, Pinecone and
+Translator stand-ins from benchmarks.fakes, then runs each scenario with
+``--concurrency`` clients, one user each, over real HTTP and SSE. Reports
+throughput, p50/p99 latency, p50/p99 time to first token and the process's
+peak RSS, which includes the server.
+
+Uploads are measured to the response and to the end of their ingestion.
+/question_doc results are cached per document, so requests beyond the
+number of uploaded documents replay the cache.
+
+    python -m benchmarks.bench_endpoints --requests 50 --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import tempfile
+import time
+from typing import Optional
+
+_workdir = tempfile.mkdtemp(prefix="papyrion-benchmark-")
+for key, path in {
+    "DOCUMENT_INDEX_PATH": "documents.sqlite3",
+    "EMBEDDING_CACHE_PATH": "embeddings.sqlite3",
+    "FILE_CACHE_PATH": "files",
+    "LOCAL_VECTOR_INDEX_PATH": "vectors",
+    "QUESTION_CACHE_PATH": "questions.sqlite3",
+    "STORAGE_PATH": "objects",
+    "TRANSLATION_CACHE_PATH": "translations.sqlite3",
+}.items():
+    os.environ[key] = os.path.join(_workdir, path)
+os.environ["VECTOR_BACKEND"] = "local"
+os.environ["STORAGE_BACKEND"] = "local"
+for key in ("OPENAI_API_KEY", "JWT_ACCESS_SECRET", "JWT_REFRESH_SECRET"):
+    os.environ.setdefault(key, "benchmark")
+# The scheduler is left out of the way unless its limits are set explicitly
+os.environ.setdefault("USER_REQUESTS_PER_MINUTE", "1000000")
+os.environ.setdefault("USER_TOKENS_PER_MINUTE", "1000000000")
+os.environ.setdefault(
+    "MODEL_LIMITS",
+    json.dumps(
+        {
+            model: {
+                "requests_per_minute": 1000000,
+                "tokens_per_minute": 1000000000,
+                "max_concurrent": 10000,
+            }
+            for model in ("gpt-3.5-turbo", "gpt-4")
+        }
+    ),
+)
+os.environ.setdefault("SCHEDULER_MAX_QUEUE_SIZE", "100000")
+os.environ.setdefault("SCHEDULER_MAX_USER_QUEUE_SIZE", "100000")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import aiohttp
+import uvicorn
+
+import app as server
+from benchmarks import fakes
+
+WORDS = (
+    "derivative integral limit function matrix vector theorem proof lemma series "
+    "convergence probability distribution variance entropy gradient algorithm graph"
+).split()
+
+
+class Result:
+    def __init__(self, latency: float, ok: bool, first_token: Optional[float] = None):
+        self.latency = latency
+        self.ok = ok
+        self.first_token = first_token
+
+
+def _document(seed: int, words: int) -> bytes:
+    rng = random.Random(seed)
+    paragraphs = []
+    for start in range(0, words, 80):
+        paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(min(80, words - start))))
+    return "\n\n".join(paragraphs).encode()
+
+
+async def _auth(session: aiohttp.ClientSession, base_url: str) -> dict:
+    async with session.post(f"{base_url}/auth") as response:
+        token = (await response.json())["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def _read_sse(response: aiohttp.ClientResponse, started_at: float):
+    """Time of the first token event and whether the stream ended without error."""
+    first_token = None
+    ok = response.status == 200
+    async for line in response.content:
+        if not line.startswith(b"data:"):
+            continue
+        event = json.loads(line[5:])
+        if event.get("event") == "new_token" and first_token is None:
+            first_token = time.perf_counter() - started_at
+        elif event.get("event") == "error":
+            ok = False
+    return first_token, ok
+
+
+async def _upload(session, base_url, headers, seed, words, wait_for_ingestion):
+    data = aiohttp.FormData()
+    data.add_field("file", _document(seed, words), filename=f"notes-{seed}.txt")
+    started_at = time.perf_counter()
+    async with session.post(f"{base_url}/upload", data=data, headers=headers) as response:
+        body = await response.json()
+        ok = response.status == 200
+    if not ok or not wait_for_ingestion or body["job_id"] is None:
+        return Result(time.perf_counter() - started_at, ok), body.get("document_id")
+    while True:
+        async with session.get(
+            f"{base_url}/upload-status/{body['job_id']}", headers=headers
+        ) as response:
+            status = await response.json()
+        if status["stage"] in ("done", "failed"):
+            break
+        await asyncio.sleep(0.02)
+    ok = status["stage"] == "done"
+    return Result(time.perf_counter() - started_at, ok), body["document_id"]
+
+
+async def _completion(session, base_url, headers, history_turns):
+    chat_history = []
+    for turn in range(history_turns):
+        chat_history += [f"What does theorem {turn} say?", f"Theorem {turn} bounds the variance."]
+    payload = {
+        "prompt": {"page_content": "Explain the convergence proof of the series in my notes."},
+        "chat_history": chat_history,
+    }
+    started_at = time.perf_counter()
+    async with session.post(f"{base_url}/completion", json=payload, headers=headers) as response:
+        first_token, ok = await _read_sse(response, started_at)
+    return Result(time.perf_counter() - started_at, ok, first_token)
+
+
+async def _question_doc(session, base_url, headers, document_id):
+    started_at = time.perf_counter()
+    async with session.post(
+        f"{base_url}/question_doc", json={"document_id": document_id}, headers=headers
+    ) as response:
+        first_token, ok = await _read_sse(response, started_at)
+    return Result(time.perf_counter() - started_at, ok, first_token)
+
+
+async def _run_scenario(name, requests, concurrency, request):
+    """Run ``request(index)`` ``requests`` times from ``concurrency`` clients."""
+    queue = asyncio.Queue()
+    for index in range(requests):
+        queue.put_nowait(index)
+    results = []
+
+    async def client():
+        while not queue.empty():
+            results.append(await request(queue.get_nowait()))
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    _report(name, results, time.perf_counter() - started_at)
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _report(name, results, elapsed):
+    ok = [result for result in results if result.ok]
+    line = f"{name:<18} {len(ok) / elapsed:7.2f} req/s  errors {len(results) - len(ok):3d}"
+    if ok:
+        latencies = [result.latency * 1000 for result in ok]
+        line += (
+            f"  latency p50 {statistics.median(latencies):8.1f} ms"
+            f" p99 {_percentile(latencies, 0.99):8.1f} ms"
+        )
+        first_tokens = [result.first_token * 1000 for result in ok if result.first_token]
+        if first_tokens:
+            line += (
+                f"  ttft p50 {statistics.median(first_tokens):8.1f} ms"
+                f" p99 {_percentile(first_tokens, 0.99):8.1f} ms"
+            )
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{line}  peak rss {peak_rss:7.1f} MiB")
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def _main(args):
+    fakes.install(
+        chat_latency=args.chat_latency,
+        tokens_per_second=args.tokens_per_second,
+        embedding_latency=args.embedding_latency,
+        index_latency=args.index_latency,
+    )
+    port = _free_port()
+    uvicorn_server = uvicorn.Server(
+        uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    serve = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.01)
+    base_url = f"http://127.0.0.1:{port}"
+
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        users = [await _auth(session, base_url) for _ in range(args.concurrency)]
+        documents = {index: [] for index in range(args.concurrency)}
+
+        async def upload(index):
+            user = index % args.concurrency
+            result, _ = await _upload(
+                session, base_url, users[user], index, args.document_words, False
+            )
+            return result
+
+        async def upload_and_ingest(index):
+            user = index % args.concurrency
+            result, document_id = await _upload(
+                session, base_url, users[user], args.requests + index, args.document_words, True
+            )
+            if result.ok:
+                documents[user].append(document_id)
+            return result
+
+        async def completion(index):
+            return await _completion(
+                session, base_url, users[index % args.concurrency], args.history_turns
+            )
+
+        async def question_doc(index):
+            user = index % args.concurrency
+            user_documents = documents[user]
+            if not user_documents:
+                return Result(0.0, False)
+            document_id = user_documents[(index // args.concurrency) % len(user_documents)]
+            return await _question_doc(session, base_url, users[user], document_id)
+
+        scenarios = {
+            "upload": upload,
+            "upload+ingest": upload_and_ingest,
+            "completion": completion,
+            "question_doc": question_doc,
+        }
+        for name in args.scenarios:
+            await _run_scenario(name, args.requests, args.concurrency, scenarios[name])
+
+    uvicorn_server.should_exit = True
+    await serve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=["upload", "upload+ingest", "completion", "question_doc"],
+        choices=["upload", "upload+ingest", "completion", "question_doc"],
+    )
+    parser.add_argument("--document-words", type=int, default=5000)
+    parser.add_argument("--history-turns", type=int, default=2)
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--embedding-latency", type=float, default=0.05)
+    parser.add_argument("--index-latency", type=float, default=0.01)
+    args = parser.parse_args()
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""Local stand-ins for OpenAI, Pinecone, the Azure Translator and tiktoken.
+
+``install`` swaps them into the modules that build clients, so the server
+runs its real request paths without network calls. Latencies are simulated
+with sleeps, the fakes themselves cost next to no CPU.
+"""
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain.chat_models.base import BaseChatModel
+from langchain.embeddings.base import Embeddings
+from langchain.schema import AIMessage, BaseMessage, ChatGeneration, ChatResult
+
+from vector_index import VectorIndex, _vector_tuple
+
+# Question extraction responses carry both block kinds the question stream filters for
+DEFAULT_RESPONSE = (
+    "###CCC### The page defines the derivative as the limit of difference quotients. ###CCC###\n"
+    "###QQQ### What is the derivative of x squared with respect to x? ###QQQ###\n"
+    "###QQQ### Why does the limit definition need h to approach zero? ###QQQ###\n"
+    "The derivative measures the rate of change of a function at a point, "
+    "see the SOURCES for the worked examples."
+)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers every prompt with ``response``.
+
+    The first token arrives after ``latency`` seconds and the following ones
+    at ``tokens_per_second``. Words stand in for tokens.
+    """
+
+    model_name: str = "fake"
+    streaming: bool = False
+    response: str = DEFAULT_RESPONSE
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _tokens(self) -> List[str]:
+        words = self.response.split(" ")
+        return [words[0]] + [" " + word for word in words[1:]]
+
+    def _result(self, messages: List[BaseMessage], streamed: bool) -> ChatResult:
+        llm_output = None
+        if not streamed:
+            prompt_tokens = sum(len(message.content.split()) for message in messages)
+            llm_output = {
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(self._tokens()),
+                },
+                "model_name": self.model_name,
+            }
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=self.response))],
+            llm_output=llm_output,
+        )
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> ChatResult:
+        time.sleep(self.latency)
+        if self.streaming:
+            for token in self._tokens():
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+                time.sleep(1 / self.tokens_per_second)
+        else:
+            time.sleep(len(self._tokens()) / self.tokens_per_second)
+        return self._result(messages, self.streaming)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+    ) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        if self.streaming:
+            started_at = time.perf_counter()
+            for index, token in enumerate(self._tokens()):
+                if run_manager:
+                    await run_manager.on_llm_new_token(token)
+                # Sleep to the token's due time, so slow consumers do not lower the rate
+                delay = started_at + (index + 1) / self.tokens_per_second - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(len(self._tokens()) / self.tokens_per_second)
+        return self._result(messages, self.streaming)
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic unit vectors derived from the text's hash."""
+
+    def __init__(self, dimension: int = 1536, latency: float = 0.05):
+        self.model = "fake-embedding"
+        self.dimension = dimension
+        self.latency = latency
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class InMemoryVectorIndex(VectorIndex):
+    """Pinecone-compatible index held in dicts, searched by brute force."""
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self._namespaces: Dict[str, Dict[str, tuple]] = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: Sequence[tuple], namespace: str = "", batch_size=None, **kwargs):
+        time.sleep(self.latency)
+        items = [_vector_tuple(vector) for vector in vectors]
+        with self._lock:
+            store = self._namespaces.setdefault(namespace, {})
+            for vector_id, values, metadata in items:
+                store[vector_id] = (np.asarray(values, dtype=np.float32), dict(metadata))
+        return {"upserted_count": len(items)}
+
+    def query(
+        self,
+        vector: Optional[List[float]] = None,
+        top_k: int = 10,
+        namespace: str = "",
+        include_metadata: bool = False,
+        include_values: bool = False,
+        **kwargs,
+    ) -> dict:
+        time.sleep(self.latency)
+        if vector and isinstance(vector[0], (list, tuple)):
+            vector = vector[0]
+        with self._lock:
+            items = list(self._namespaces.get(namespace, {}).items())
+        if not items:
+            return {"matches": [], "namespace": namespace}
+        matrix = np.stack([values for _, (values, _) in items])
+        scores = matrix @ np.asarray(vector, dtype=np.float32)
+        matches = []
+        for row in np.argsort(-scores)[:top_k]:
+            vector_id, (values, metadata) = items[row]
+            match = {"id": vector_id, "score": float(scores[row])}
+            if include_metadata:
+                match["metadata"] = dict(metadata)
+            if include_values:
+                match["values"] = values.tolist()
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+    def fetch(self, ids: List[str], namespace: str = "") -> dict:
+        with self._lock:
+            store = self._namespaces.get(namespace, {})
+            return {
+                "vectors": {
+                    vector_id: {
+                        "id": vector_id,
+                        "values": store[vector_id][0].tolist(),
+                        "metadata": dict(store[vector_id][1]),
+                    }
+                    for vector_id in ids
+                    if vector_id in store
+                },
+                "namespace": namespace,
+            }
+
+    def delete(
+        self, ids: Optional[List[str]] = None, delete_all: bool = False, namespace: str = "", **kwargs
+    ):
+        time.sleep(self.latency)
+        with self._lock:
+            store = self._namespaces.setdefault(namespace, {})
+            if delete_all:
+                store.clear()
+            for vector_id in ids or ():
+                store.pop(vector_id, None)
+        return {}
+
+
+class ApproximateEncoding:
+    """Stand-in for the cl100k_base encoding, for runs without ``python startup.py``.
+
+    Words with their leading space, punctuation runs and whitespace runs are
+    one token each, close to cl100k counts for English prose. Tokens are
+    the text pieces themselves.
+    """
+
+    _pattern = re.compile(r" ?\w+| ?[^\w\s]+|\s+")
+
+    def encode(self, text: str, disallowed_special=()) -> List[str]:
+        return self._pattern.findall(text)
+
+    def encode_batch(self, texts: List[str], disallowed_special=()) -> List[List[str]]:
+        return [self.encode(text) for text in texts]
+
+    def decode(self, tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+
+class StubTranslator:
+    """Reports every text as English, so nothing is translated."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def translate(self, texts: List[str]) -> List[str]:
+        return self.translate_and_detect(texts)[0]
+
+    def translate_and_detect(self, texts: List[str]):
+        time.sleep(self.latency)
+        return list(texts), ["en"] * len(texts)
+
+
+def use_approximate_encoding() -> None:
+    """Count tokens with ApproximateEncoding instead of the downloaded encoding."""
+    import utils
+
+    encoding = ApproximateEncoding()
+    utils._get_encoding = lambda: encoding
+
+
+def install(
+    chat_latency: float = 0.5,
+    tokens_per_second: float = 50.0,
+    response: str = DEFAULT_RESPONSE,
+    embedding_latency: float = 0.05,
+    index_latency: float = 0.01,
+    translation_latency: float = 0.0,
+) -> None:
+    """Make the server build the fakes instead of the real clients."""
+    import clients
+    import material.material
+    import question.question
+    import text_extractor.extractors
+    import utils
+
+    use_approximate_encoding()
+    embeddings = FakeEmbeddings(latency=embedding_latency)
+    index = InMemoryVectorIndex(latency=index_latency)
+    chat_models = {}
+
+    def get_chat_model(model_name, temperature, streaming=False, request_timeout=None):
+        key = (model_name, streaming)
+        if key not in chat_models:
+            chat_models[key] = FakeChatModel(
+                model_name=model_name,
+                streaming=streaming,
+                response=response,
+                latency=chat_latency,
+                tokens_per_second=tokens_per_second,
+            )
+        return chat_models[key]
+
+    for module in (clients, material.material, question.question):
+        for name, fake in (
+            ("get_embeddings", lambda: embeddings),
+            ("get_index", lambda: index),
+            ("get_chat_model", get_chat_model),
+        ):
+            if hasattr(module, name):
+                setattr(module, name, fake)
+    material.material._get_shared_chains.cache_clear()
+    material.material._get_history_compressor.cache_clear()
+    question.question._get_question_chain.cache_clear()
+    text_extractor.extractors.translator = StubTranslator(translation_latency)
@@ -0,0 +1,93 @@
+import functools
+import os
+from typing import Optional
+
+import aiohttp
+import openai
+import pinecone
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+from vector_index import LocalVectorIndex, VectorIndex
+
+# Process-wide clients, built on first use and shared by every request.
+# Callback handlers are passed per call so the clients never hold request state.
+
+
+@functools.lru_cache(maxsize=None)
+def get_embeddings() -> OpenAIEmbeddings:
+    return OpenAIEmbeddings()
+
+
+def uses_pinecone() -> bool:
+    return os.environ.get("VECTOR_BACKEND", "pinecone") == "pinecone"
+
+
+@functools.lru_cache(maxsize=None)
+def get_index() -> VectorIndex:
+    if not uses_pinecone():
+        return LocalVectorIndex(
+            os.environ.get("LOCAL_VECTOR_INDEX_PATH", "vectors"),
+            max_open_namespaces=int(os.environ.get("LOCAL_VECTOR_INDEX_MAX_OPEN", 128)),
+        )
+    # One index client keeps one urllib3 connection pool for all requests
+    return pinecone.Index(os.environ["PINECONE_INDEX"])
+
+
+@functools.lru_cache(maxsize=None)
+def get_chat_model(
+    model_name: str,
+    temperature: float,
+    streaming: bool = False,
+    request_timeout: Optional[float] = None,
+) -> ChatOpenAI:
+    return ChatOpenAI(
+        model_name=model_name,
+        temperature=temperature,
+        streaming=streaming,
+        request_timeout=request_timeout,
+    )
+
+
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def bind_http_session() -> None:
+    """Make async OpenAI calls in the current task reuse the pooled session.
+
+    openai creates a new aiohttp session, and so a new TLS connection, for
+    every async call unless ``openai.aiosession`` is set. It is a context
+    variable, so it has to be set inside each request task.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=int(os.environ.get("OPENAI_MAX_CONNECTIONS", 100)),
+                keepalive_timeout=60,
+            )
+        )
+    openai.aiosession.set(_http_session)
+
+
+async def close_http_session() -> None:
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def close_index() -> None:
+    """Close the files of the local vector index, Pinecone keeps none open."""
+    if uses_pinecone():
+        return
+    index = get_index()
+    if isinstance(index, LocalVectorIndex):
+        index.close()
+
+
+def reset_clients() -> None:
+    """Drop the cached clients, the next use builds new ones."""
+    get_embeddings.cache_clear()
+    get_index.cache_clear()
+    get_chat_model.cache_clear()
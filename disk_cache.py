@@ -0,0 +1,138 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class DiskCache:
+    """SQLite-backed key/value store with least-recently-used eviction.
+
+    Safe to share between threads. Entries are evicted oldest-access first
+    once the stored values exceed ``max_bytes``.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._total_bytes = 0
+
+    def _open(self) -> sqlite3.Connection:
+        """Open the database on first use, so defining a cache creates no files.
+
+        Called with the lock held.
+        """
+        if self._conn is not None:
+            return self._conn
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        self._total_bytes = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+        self._conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            conn = self._open()
+            # Stay below SQLite's bound parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(
+                    conn.execute(
+                        f"SELECT key, value FROM entries WHERE key IN ({placeholders})",
+                        batch,
+                    ).fetchall()
+                )
+            if found:
+                now = time.time()
+                conn.executemany(
+                    "UPDATE entries SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, value: bytes) -> None:
+        self.set_many([(key, value)])
+
+    def set_many(self, items: List[Tuple[str, bytes]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._open()
+            conn.execute("BEGIN")
+            for key, value in items:
+                previous = conn.execute(
+                    "SELECT size FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if previous:
+                    self._total_bytes -= previous[0]
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, accessed_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, value, len(value), now),
+                )
+                self._total_bytes += len(value)
+            conn.execute("COMMIT")
+            self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            conn = self._open()
+            row = conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._total_bytes -= row[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._open()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "bytes": self._total_bytes,
+        }
+
+    def _evict(self) -> None:
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Evict down to 90% so eviction does not run on every write
+        to_free = self._total_bytes - int(self.max_bytes * 0.9)
+        evicted = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at"
+        ).fetchall():
+            evicted.append((key,))
+            to_free -= size
+            self._total_bytes -= size
+            if to_free <= 0:
+                break
+        self._conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
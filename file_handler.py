@@ -1,62 +1,450 @@
+import asyncio
+import hashlib
+import logging
 import os
-import shutil
+import sqlite3
+import tempfile
 import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Mapping, Optional, Tuple
 
-from fastapi import UploadFile
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
 from werkzeug.utils import secure_filename
 
+from storage import DocumentIndex, FileCache, StorageBackend
+from utils import hash_file
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+class MultipartUpload:
+    """The file of a multipart/form-data request, read from the body as it arrives.
+
+    An UploadFile parameter is only handed to the endpoint once Starlette
+    has spooled the whole file to a temporary file, which save_file would
+    then copy again. ``open()`` reads the body up to the headers of the
+    ``field`` file part and returns its name, ``chunks()`` then yields its
+    content as it is received. Raises InvalidUpload if the body is not
+    multipart or has no such file.
+    """
+
+    def __init__(self, headers: Mapping[str, str], body: AsyncIterator[bytes], field: str = "file"):
+        self.field = field
+        self.filename: Optional[str] = None
+        self._body = body.__aiter__()
+        content_type, options = parse_options_header(headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in options:
+            raise InvalidUpload("Expected a multipart/form-data body")
+        self._parser = MultipartParser(
+            options[b"boundary"],
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._in_file = False
+        self._file_ended = False
+        self._data: deque = deque()
+
+    async def open(self) -> str:
+        while self.filename is None:
+            if not await self._feed():
+                raise InvalidUpload(f"No {self.field} file in the upload")
+        return self.filename
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        while True:
+            while self._data:
+                yield self._data.popleft()
+            if self._file_ended:
+                break
+            if not await self._feed():
+                raise InvalidUpload("The upload ended in the middle of the file")
+        # The fields after the file are not used, but the body is read to its end
+        while await self._feed():
+            pass
+
+    async def _feed(self) -> bool:
+        """Parse the next piece of the body, False once it has all been read."""
+        try:
+            chunk = await self._body.__anext__()
+        except StopAsyncIteration:
+            chunk = None
+        try:
+            if chunk is None:
+                self._parser.finalize()
+                return False
+            self._parser.write(chunk)
+        except MultipartParseError as e:
+            raise InvalidUpload(f"Malformed multipart body: {e}") from e
+        return True
+
+    def _on_part_begin(self) -> None:
+        self._disposition = b""
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        if (
+            self.filename is None
+            and options.get(b"name") == self.field.encode()
+            and b"filename" in options
+        ):
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._data.append(bytes(data[start:end]))
+
+    def _on_part_end(self) -> None:
+        if self._in_file:
+            self._in_file = False
+            self._file_ended = True
+
+
+class SavedFile:
+    def __init__(
+        self,
+        document_id: str,
+        content_hash: str,
+        size: int,
+        duplicate: bool,
+        object_key: Optional[str] = None,
+    ):
+        self.document_id = document_id
+        self.content_hash = content_hash
+        self.size = size
+        # The user had already uploaded the same content as document_id
+        self.duplicate = duplicate
+        self.object_key = object_key
+
 
 class FileHandler:
-    def __init__(self, uploads_folder="uploads"):
-        self.uploads_folder = uploads_folder
-
-    def save_file(self, file: UploadFile, user_id):
-        filename = secure_filename(file.filename)
-        file_parent_path = os.path.join(self.uploads_folder, user_id)
-        if not os.path.exists(file_parent_path):
-            os.makedirs(file_parent_path)
-
-        file_extension = filename.rsplit(".", 1)[1].lower()
-        document_id = (
-            filename[: -len(file_extension) - 1]
-            + "-"
-            + str(uuid.uuid4())
-            + "."
-            + file_extension
+    """User documents on top of a content-addressed storage backend.
+
+    Each distinct content is stored once under its SHA-256 and the user's
+    documents are rows in the document index pointing at it, so identical
+    uploads, by the same user or by different users, share the object.
+    Objects of remote backends are read through a local file cache.
+    Storing an object and releasing it are serialized per object, so an
+    upload cannot be recorded against an object that is being deleted. The
+    lock only covers this process.
+    """
+
+    def __init__(self, storage: StorageBackend, index: DocumentIndex, cache: FileCache):
+        self.storage = storage
+        self.index = index
+        self.cache = cache
+        # Object key -> (lock, number of tasks holding or waiting for it)
+        self._object_locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+    async def save_file(
+        self,
+        filename: str,
+        chunks: AsyncIterator[bytes],
+        user_id: str,
+        max_bytes: Optional[int] = None,
+        document_id: Optional[str] = None,
+    ) -> SavedFile:
+        """Stream an upload into storage, hashing it on the way.
+
+        Chunks, such as those of a MultipartUpload, are hashed as they are
+        received and written to a staging file from a worker thread so the
+        event loop is never blocked on disk, and the file is fsynced once at
+        the end. The staging file is then moved into storage. Raises
+        FileTooLarge as soon as more than ``max_bytes`` have been read.
+        With ``document_id`` the upload is a new version of that document. It
+        stays pending, and the document serves its current version, until
+        the new one is promoted or dropped.
+        """
+        filename = secure_filename(filename)
+        if document_id is None:
+            new_document_id = _new_document_id(filename)
+        else:
+            previous = await self._get_document(user_id, document_id)
+            new_document_id = document_id
+
+        file_hash = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.cache.path, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                pending = bytearray()
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise FileTooLarge(f"File is larger than {max_bytes} bytes")
+                    file_hash.update(chunk)
+                    # Request bodies arrive in small pieces, write them in larger ones
+                    pending += chunk
+                    if len(pending) >= UPLOAD_CHUNK_BYTES:
+                        await asyncio.to_thread(temp_file.write, pending)
+                        pending = bytearray()
+                await asyncio.to_thread(temp_file.write, pending)
+                await asyncio.to_thread(_flush_and_sync, temp_file)
+            content_hash = file_hash.hexdigest()
+
+            if document_id is None:
+                existing = await asyncio.to_thread(
+                    self.index.find_by_hash, user_id, content_hash
+                )
+            else:
+                latest_hash = previous["pending_content_hash"] or previous["content_hash"]
+                existing = previous if latest_hash == content_hash else None
+            if existing is not None:
+                return SavedFile(existing["document_id"], content_hash, size, duplicate=True)
+
+            # The extension is part of the key, loaders pick the parser by it
+            object_key = content_hash + os.path.splitext(filename)[1].lower()
+            async with self._object_lock(object_key):
+                if document_id is None:
+                    await asyncio.to_thread(
+                        self.index.add, user_id, new_document_id, content_hash, object_key, size
+                    )
+                else:
+                    await asyncio.to_thread(
+                        self.index.add_version,
+                        user_id,
+                        document_id,
+                        content_hash,
+                        object_key,
+                        size,
+                    )
+                if not await self.storage.exists(object_key):
+                    await self.storage.put_file(object_key, temp_path)
+            if os.path.exists(temp_path) and self.storage.local_path(object_key) is None:
+                # Ingestion reads the file right away, keep it instead of downloading
+                await asyncio.to_thread(self.cache.add, object_key, temp_path)
+            return SavedFile(
+                new_document_id, content_hash, size, duplicate=False, object_key=object_key
+            )
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def get_file(self, user_id, document_id, object_key: Optional[str] = None) -> str:
+        """Local path of a document, or of its version ``object_key``, fetched if needed."""
+        if object_key is None:
+            object_key = (await self._get_document(user_id, document_id))["object_key"]
+        local_path = self.storage.local_path(object_key)
+        if local_path is not None:
+            return local_path
+        return await self.cache.get(object_key, self.storage)
+
+    async def read_range(self, user_id, document_id, start: int, length: int) -> bytes:
+        object_key = (await self._get_document(user_id, document_id))["object_key"]
+        return await self.storage.read_range(object_key, start, length)
+
+    async def get_file_hash(self, user_id, document_id) -> str:
+        return (await self._get_document(user_id, document_id))["content_hash"]
+
+    async def promote_version(
+        self, user_id, document_id, content_hash: str, object_key: str, size: int
+    ) -> None:
+        """Serve an ingested version, dropping the object it replaces."""
+        replaced = await asyncio.to_thread(
+            self.index.promote_version, user_id, document_id, content_hash, object_key, size
         )
-        filepath = os.path.join(self.uploads_folder, user_id, document_id)
-        with open(filepath, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
-
-        return document_id
-
-    def delete_file(self, user_id, document_id):
-        filepath = os.path.join(self.uploads_folder, user_id, document_id)
-        if os.path.exists(filepath):
-            os.remove(filepath)
-
-    def delete_user_files(self, user_id):
-        user_folder_path = os.path.join(self.uploads_folder, user_id)
-        if os.path.exists(user_folder_path):
-            shutil.rmtree(user_folder_path)
-
-    def file_exists(self, user_id, document_id):
-        filepath = os.path.join(self.uploads_folder, user_id, document_id)
-        return os.path.exists(filepath)
-
-    def get_file(self, user_id, document_id):
-        filepath = os.path.join(self.uploads_folder, user_id, document_id)
-        return filepath
-
-    def list_files(self, user_id):
-        file_parent_path = os.path.join(self.uploads_folder, user_id)
-        if not os.path.exists(file_parent_path):
-            return []
-        filepaths = os.listdir(file_parent_path)
-        return [
+        if replaced is not None and replaced != object_key:
+            await self._release_object(replaced)
+
+    async def drop_version(self, user_id, document_id, object_key: str) -> None:
+        """Discard a version that will not be served, keeping the current one."""
+        await asyncio.to_thread(self.index.drop_version, user_id, document_id, object_key)
+        await self._release_object(object_key)
+
+    async def delete_file(self, user_id, document_id):
+        document = await asyncio.to_thread(self.index.delete, user_id, document_id)
+        if document is not None:
+            for object_key in _object_keys([document]):
+                await self._release_object(object_key)
+
+    async def delete_user_files(self, user_id):
+        documents = await asyncio.to_thread(self.index.delete_user, user_id)
+        for object_key in _object_keys(documents):
+            await self._release_object(object_key)
+
+    async def file_exists(self, user_id, document_id):
+        return await asyncio.to_thread(self.index.get, user_id, document_id) is not None
+
+    def list_files(self, user_id, limit: Optional[int] = None, cursor: Optional[str] = None):
+        """A page of the user's files and the cursor of the next page."""
+        documents, next_cursor = self.index.list(user_id, limit, cursor)
+        files = [
             {
-                "name": filepath,
-                "size": os.path.getsize(os.path.join(file_parent_path, filepath)),
+                "name": document["document_id"],
+                "size": document["size"],
+                "status": document["status"],
+                "pages": document["page_count"],
+                "chunks": document["chunk_count"],
+                "language": document["language"],
+                "content_hash": document["content_hash"],
+                "uploaded_at": document["created_at"],
             }
-            for filepath in filepaths
+            for document in documents
         ]
+        return files, next_cursor
+
+    async def migrate_legacy_uploads(self, uploads_folder: str) -> int:
+        """Move documents of the ``<uploads_folder>/<user>/<document>`` layout into storage.
+
+        Each migrated file is removed from the old layout, so this only finds
+        work the first time it runs. The documents keep their ids and are
+        marked ready, their vectors were added when they were uploaded. Their
+        vector ids were never recorded, so deleting one of them on its own
+        leaves its vectors until the user's files are all deleted. They are
+        marked legacy, as they have no keyword index entries either.
+        """
+        skip = {
+            os.path.realpath(path)
+            for path in (self.cache.path, getattr(self.storage, "root", None))
+            if path
+        }
+        legacy_files = await asyncio.to_thread(_find_legacy_uploads, uploads_folder, skip)
+        failed = 0
+        for user_id, document_id, path in legacy_files:
+            try:
+                await self._migrate_legacy_file(user_id, document_id, path)
+            except Exception as e:
+                failed += 1
+                logger.warning("Failed to migrate %s: %s", path, e)
+        if legacy_files:
+            logger.info("Migrated %d legacy uploads", len(legacy_files) - failed)
+        return len(legacy_files) - failed
+
+    async def _migrate_legacy_file(self, user_id: str, document_id: str, path: str) -> None:
+        content_hash, size = await asyncio.to_thread(hash_file, path)
+        object_key = content_hash + os.path.splitext(document_id)[1].lower()
+        async with self._object_lock(object_key):
+            if await asyncio.to_thread(self.index.get, user_id, document_id) is None:
+                try:
+                    await asyncio.to_thread(
+                        self.index.add,
+                        user_id,
+                        document_id,
+                        content_hash,
+                        object_key,
+                        size,
+                        legacy=True,
+                    )
+                except sqlite3.IntegrityError:
+                    # Another instance migrated it first
+                    pass
+                else:
+                    await asyncio.to_thread(
+                        self.index.update_status, user_id, document_id, "ready"
+                    )
+            if not await self.storage.exists(object_key):
+                await self.storage.put_file(object_key, path)
+        if os.path.exists(path):
+            os.remove(path)
+            try:
+                # The user's folder, once its last document has moved
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    async def _get_document(self, user_id: str, document_id: str) -> dict:
+        document = await asyncio.to_thread(self.index.get, user_id, document_id)
+        if document is None:
+            raise FileNotFoundError(f"No document {document_id}")
+        return document
+
+    async def _release_object(self, object_key: str) -> None:
+        # Drop the object once no document references it anymore
+        async with self._object_lock(object_key):
+            if await asyncio.to_thread(self.index.object_references, object_key) == 0:
+                await self.storage.delete(object_key)
+                await asyncio.to_thread(self.cache.discard, object_key)
+
+    @asynccontextmanager
+    async def _object_lock(self, object_key: str):
+        lock, users = self._object_locks.get(object_key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._object_locks[object_key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._object_locks[object_key]
+            if users == 1:
+                del self._object_locks[object_key]
+            else:
+                self._object_locks[object_key] = (lock, users - 1)
+
+
+def _new_document_id(filename: str) -> str:
+    file_extension = filename.rsplit(".", 1)[1].lower()
+    return (
+        filename[: -len(file_extension) - 1]
+        + "-"
+        + str(uuid.uuid4())
+        + "."
+        + file_extension
+    )
+
+
+def _flush_and_sync(file_object) -> None:
+    file_object.flush()
+    os.fsync(file_object.fileno())
+
+
+def _object_keys(documents: List[dict]) -> set:
+    """Objects of the documents' served and pending versions."""
+    return {
+        object_key
+        for document in documents
+        for object_key in (document["object_key"], document["pending_object_key"])
+        if object_key is not None
+    }
+
+
+def _find_legacy_uploads(uploads_folder: str, skip: set) -> List[Tuple[str, str, str]]:
+    """(user id, document id, path) of the files in per-user upload folders."""
+    if not os.path.isdir(uploads_folder):
+        return []
+    legacy_files = []
+    for user_entry in os.scandir(uploads_folder):
+        if (
+            not user_entry.is_dir()
+            or user_entry.name.startswith(".")
+            or os.path.realpath(user_entry.path) in skip
+        ):
+            continue
+        for entry in os.scandir(user_entry.path):
+            if entry.is_file() and "." in entry.name:
+                legacy_files.append((user_entry.name, entry.name, entry.path))
+    return legacy_files
@@ -0,0 +1 @@
+from ingestion.ingestion import *
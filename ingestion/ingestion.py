@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionQueueFull(Exception):
+    pass
+
+
+class IngestionCancelled(Exception):
+    """Raised by an ingestion that stops because its job was cancelled."""
+
+
+class IngestionJob:
+    def __init__(self, user_id: str, document_id: str, version: Optional[str] = None):
+        self.job_id = str(uuid4())
+        self.user_id = user_id
+        self.document_id = document_id
+        # Identifies the uploaded version of the document to ingest
+        self.version = version
+        self.stage = "queued"
+        self.progress = 0.0
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # Set to ask a running ingestion to stop before its next write
+        self.cancelled = asyncio.Event()
+        self._started = False
+        self._stopped = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.stage in ("done", "failed", "cancelled")
+
+    def update(self, stage: str, progress: Optional[float] = None) -> None:
+        self.stage = stage
+        if progress is not None:
+            self.progress = progress
+        self.updated_at = time.time()
+
+    def fail(self, error: Exception) -> None:
+        self.error = str(error)
+        self.update("failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "document_id": self.document_id,
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+        }
+
+
+class IngestionPipeline:
+    """Bounded queue of ingestion jobs drained by a fixed pool of workers.
+
+    Each worker awaits one job at a time, so at most ``workers`` documents
+    are extracted, embedded and upserted concurrently while uploads return
+    immediately. Jobs of the same document run one after the other, with
+    their failure handling.
+    """
+
+    def __init__(
+        self,
+        ingest: Callable[[IngestionJob], Awaitable[None]],
+        on_failure: Optional[Callable[[IngestionJob], Awaitable[None]]] = None,
+        workers: int = 2,
+        max_queue_size: int = 100,
+        job_ttl: float = 3600,
+    ):
+        self._ingest = ingest
+        self._on_failure = on_failure
+        self._num_workers = workers
+        self._max_queue_size = max_queue_size
+        self._job_ttl = job_ttl
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        self._jobs: Dict[str, IngestionJob] = {}
+        # (user id, document id) -> lock and the number of jobs holding or awaiting it
+        self._document_locks: Dict[Tuple[str, str], list] = {}
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self._max_queue_size)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self._num_workers)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(
+        self, user_id: str, document_id: str, version: Optional[str] = None
+    ) -> IngestionJob:
+        self._prune_jobs()
+        job = IngestionJob(user_id, document_id, version)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise IngestionQueueFull("Ingestion queue is full, try again later")
+        self._jobs[job.job_id] = job
+        return job
+
+    def get_job(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    async def cancel(
+        self, user_id: str, document_id: Optional[str] = None
+    ) -> List[IngestionJob]:
+        """Cancel the unfinished jobs of a document, or of all the user's documents.
+
+        Queued jobs are dropped. Running jobs stop before their next write
+        and are waited for, so nothing is written for the document once
+        this returns. Returns the cancelled jobs.
+        """
+        cancelled = []
+        running = []
+        for job in list(self._jobs.values()):
+            if job.user_id != user_id or job.finished:
+                continue
+            if document_id is not None and job.document_id != document_id:
+                continue
+            job.cancelled.set()
+            cancelled.append(job)
+            if job._started:
+                running.append(job)
+            else:
+                job.update("cancelled")
+        for job in running:
+            await job._stopped.wait()
+        return cancelled
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.cancelled.is_set():
+                    continue
+                job._started = True
+                async with self._document_lock(job):
+                    await self._run(job)
+            finally:
+                job._stopped.set()
+                self._queue.task_done()
+
+    async def _run(self, job: IngestionJob) -> None:
+        try:
+            if job.cancelled.is_set():
+                job.update("cancelled")
+                return
+            await self._ingest(job)
+            job.update("done", 1.0)
+        except Exception as e:
+            if job.cancelled.is_set():
+                # Whoever cancelled the job cleans up after it
+                job.update("cancelled")
+                return
+            logger.error("Exception while ingesting %s: %s", job.document_id, e)
+            job.fail(e)
+            if self._on_failure:
+                try:
+                    await self._on_failure(job)
+                except Exception as e:
+                    logger.error("Exception while cleaning up %s: %s", job.document_id, e)
+
+    @asynccontextmanager
+    async def _document_lock(self, job: IngestionJob):
+        key = (job.user_id, job.document_id)
+        entry = self._document_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._document_locks[key]
+
+    def _prune_jobs(self) -> None:
+        expired_before = time.time() - self._job_ttl
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.updated_at < expired_before:
+                del self._jobs[job_id]
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+from langchain.schema import Document
+
+
+def context_key(docs: List[Document], prompt_version: str) -> str:
+    """Identifies the retrieved chunks, in any order, and the prompt they were answered with.
+
+    Chunks are identified by their text, so users of the same material share
+    entries while no answer is replayed against different context.
+    """
+    chunk_hashes = sorted(hashlib.sha256(doc.page_content.encode()).hexdigest() for doc in docs)
+    return hashlib.sha256("\0".join([prompt_version] + chunk_hashes).encode()).hexdigest()
+
+
+class SemanticAnswerCache:
+    """LRU cache of answers looked up by question similarity within the same context.
+
+    An answer is returned for a question whose embedding has a cosine
+    similarity of at least ``threshold`` with a cached question's, and whose
+    retrieved chunks and prompt version (the context key) are the same.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        # entry id -> (context key, normalized embedding, answer, expiry)
+        self._entries = OrderedDict()
+        self._contexts: Dict[str, Set[int]] = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def get(self, context: str, embedding: List[float]) -> Optional[str]:
+        query = _normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._contexts.get(context, ())):
+                _, cached_embedding, _, expires_at = self._entries[entry_id]
+                if expires_at < now:
+                    self._remove(entry_id)
+                    continue
+                score = float(cached_embedding @ query)
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return self._entries[best_id][2]
+
+    def set(self, context: str, embedding: List[float], answer: str) -> None:
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (
+                context, _normalize(embedding), answer, time.monotonic() + self.ttl
+            )
+            self._contexts.setdefault(context, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._contexts.clear()
+
+    def _remove(self, entry_id: int) -> None:
+        context = self._entries.pop(entry_id)[0]
+        entry_ids = self._contexts[context]
+        entry_ids.discard(entry_id)
+        if not entry_ids:
+            del self._contexts[context]
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+answer_cache = SemanticAnswerCache(
+    max_entries=int(os.environ.get("ANSWER_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("ANSWER_CACHE_TTL", 24 * 3600)),
+    threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", 0.97)),
+)
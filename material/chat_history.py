@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+from typing import List, Optional
+
+from langchain import LLMChain
+from langchain.callbacks.manager import Callbacks
+
+from material.retrieval_cache import TTLCache
+from utils import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Prefix of each turn, chat_history alternates between the two starting with the user
+ROLES = ("Human", "Assistant")
+
+history_summary_cache = TTLCache(
+    max_entries=int(os.environ.get("HISTORY_SUMMARY_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("HISTORY_SUMMARY_CACHE_TTL", 24 * 3600)),
+)
+
+
+def format_chat_history(chat_history: List[str]) -> List[str]:
+    return [
+        f"{ROLES[index % 2]}: {turn}" for index, turn in enumerate(chat_history)
+    ]
+
+
+class ChatHistoryCompressor:
+    """Fits the chat history into a token budget for the condense-question prompt.
+
+    Recent turns are kept verbatim. Older turns are folded into a running
+    summary, cached by a hash chain over the turns, so each request only
+    summarizes the turns that left the verbatim window since the last one.
+    """
+
+    def __init__(
+        self,
+        summary_chain: LLMChain,
+        token_budget: int = 1500,
+        summary_tokens: int = 300,
+        summarize_chunk_tokens: int = 2000,
+        cache: TTLCache = history_summary_cache,
+    ):
+        self.summary_chain = summary_chain
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.summarize_chunk_tokens = summarize_chunk_tokens
+        self.cache = cache
+
+    async def acompress(
+        self, chat_history: Optional[List[str]], callbacks: Callbacks = None
+    ) -> str:
+        """The history as prompt text, its summary calls reported to ``callbacks``."""
+        lines = format_chat_history(chat_history or [])
+        line_tokens = [count_tokens(line) for line in lines]
+        if sum(line_tokens) <= self.token_budget:
+            return "\n".join(lines)
+
+        # Keep the most recent turns that fit next to the summary
+        recent_budget = self.token_budget - self.summary_tokens
+        split, recent_tokens = len(lines), 0
+        while split > 0 and recent_tokens + line_tokens[split - 1] <= recent_budget:
+            split -= 1
+            recent_tokens += line_tokens[split]
+        if split == len(lines):
+            # The last turn alone is over budget, keep its end
+            lines[-1] = truncate_tokens(lines[-1], recent_budget)
+            split -= 1
+        if split == 0:
+            return "\n".join(lines)
+
+        try:
+            summary = await self._asummarize(lines[:split], line_tokens[:split], callbacks)
+        except Exception as e:
+            logger.warning("Exception while summarizing chat history: %s", e)
+            return "\n".join(lines[split:])
+        return "\n".join([f"Summary of the earlier conversation: {summary}"] + lines[split:])
+
+    async def _asummarize(
+        self, lines: List[str], line_tokens: List[int], callbacks: Callbacks = None
+    ) -> str:
+        # prefix_keys[i] identifies the conversation up to and including line i
+        prefix_keys = []
+        key = ""
+        for line in lines:
+            key = hashlib.sha256(f"{key}\0{line}".encode()).hexdigest()
+            prefix_keys.append(key)
+
+        summarized, summary = 0, ""
+        for end in range(len(lines), 0, -1):
+            cached = self.cache.get(prefix_keys[end - 1])
+            if cached is not None:
+                summarized, summary = end, cached
+                break
+
+        while summarized < len(lines):
+            # Fold the remaining lines in chunks the summary model can take
+            end, chunk_tokens = summarized, 0
+            while end < len(lines) and (
+                end == summarized or chunk_tokens + line_tokens[end] <= self.summarize_chunk_tokens
+            ):
+                chunk_tokens += line_tokens[end]
+                end += 1
+            new_lines = "\n".join(lines[summarized:end])
+            summary = await self.summary_chain.arun(
+                summary=summary or "(none)",
+                new_lines=truncate_tokens(new_lines, self.summarize_chunk_tokens),
+                callbacks=callbacks,
+            )
+            summary = summary.strip()
+            self.cache.set(prefix_keys[end - 1], summary)
+            summarized = end
+        return summary
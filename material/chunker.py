@@ -0,0 +1,212 @@
+import re
+from collections import Counter
+from typing import List, Optional, Set, Tuple
+
+from langchain.schema import Document
+
+import utils
+
+# Lines this close to the top or bottom of a page are header or footer candidates
+BOILERPLATE_EDGE_LINES = 2
+HEADING_MAX_CHARS = 80
+_HEADING = re.compile(
+    r"#{1,6}\s+\S"  # Markdown
+    r"|(\d+(\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.)\s+[A-Z]"  # Numbered sections
+    r"|(chapter|section|part|slide|appendix)\s+\w+",
+    re.IGNORECASE,
+)
+_BLOCK_SEPARATOR = re.compile(r"\n\s*\n")
+# "12", "- 12 -", "Page 12", "Slide 12 of 40", "p. 12", "12 / 40"
+_PAGE_NUMBER = re.compile(
+    r"[-\u2013\u2014]?\s*((page|slide|p\.)\s*)?\d+(\s*(/|of)\s*\d+)?\s*[-\u2013\u2014]?",
+    re.IGNORECASE,
+)
+
+
+class TokenChunker:
+    """Splits documents into chunks of at most ``chunk_tokens`` tiktoken tokens.
+
+    Each loader document (a page, a slide, a file) is chunked on its own. A
+    document is cut into blocks at blank lines, and blocks are packed whole
+    into chunks, so tables and formulas are only split when a single block is
+    over the limit. A heading starts a new chunk once the current one has
+    ``min_chunk_tokens``, and never ends one. Lines repeated at the top or
+    bottom of most pages of a source, like running headers, footers and page
+    numbers, are dropped before chunking, unless they are most of a page.
+    """
+
+    def __init__(
+        self,
+        chunk_tokens: int = 512,
+        overlap_tokens: int = 0,
+        min_chunk_tokens: Optional[int] = None,
+        boilerplate_min_pages: int = 3,
+        boilerplate_min_ratio: float = 0.5,
+    ):
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        # By default a heading only starts a new chunk past half the chunk size
+        self.min_chunk_tokens = min_chunk_tokens or chunk_tokens // 2
+        self.boilerplate_min_pages = boilerplate_min_pages
+        self.boilerplate_min_ratio = boilerplate_min_ratio
+
+    def split_documents(
+        self, docs: List[Document], boilerplate: Optional[Set[Tuple[str, str]]] = None
+    ) -> List[Document]:
+        """Chunk the docs, without the lines of ``boilerplate``.
+
+        By default boilerplate is found among the docs themselves. Pass what
+        ``find_boilerplate`` found over the whole source when chunking it in
+        batches.
+        """
+        if boilerplate is None:
+            boilerplate = self.find_boilerplate(docs)
+        doc_blocks = [_split_blocks(_remove_lines(doc, boilerplate)) for doc in docs]
+        # One batched encode for the blocks of every document
+        counts = iter(
+            utils.count_tokens_batch([block for blocks in doc_blocks for block in blocks])
+        )
+        chunks = []
+        for doc, blocks in zip(docs, doc_blocks):
+            sized_blocks = []
+            heading_tokens = 0
+            for block in blocks:
+                # Leaves room for the headings that go with the block's first piece
+                limit = max(self.chunk_tokens - heading_tokens, self.chunk_tokens // 2)
+                pieces = self._fit(block, next(counts), limit)
+                sized_blocks += pieces
+                if pieces[-1][2]:
+                    heading_tokens += pieces[-1][1] + 1
+                else:
+                    heading_tokens = 0
+            for text in self._pack(sized_blocks):
+                chunks.append(Document(page_content=text, metadata=dict(doc.metadata)))
+        return chunks
+
+    def find_boilerplate(self, docs: List[Document]) -> Set[Tuple[str, str]]:
+        """(source, line) of the header and footer lines of the docs' sources.
+
+        A line is boilerplate when it is at the top or bottom of at least
+        ``boilerplate_min_pages`` pages and ``boilerplate_min_ratio`` of its
+        source's pages. Lines must be identical, except for lines that are
+        only a page number, which match each other.
+        """
+        pages_by_source = Counter(doc.metadata.get("source") for doc in docs)
+        edge_lines = Counter()
+        for doc in docs:
+            source = doc.metadata.get("source")
+            if pages_by_source[source] >= self.boilerplate_min_pages:
+                lines = doc.page_content.splitlines()
+                edge_lines.update(
+                    {(source, _line_key(lines[index])) for index in _edge_indexes(lines)}
+                )
+        return {
+            (source, key)
+            for (source, key), count in edge_lines.items()
+            if count >= self.boilerplate_min_pages
+            and count >= self.boilerplate_min_ratio * pages_by_source[source]
+        }
+
+    def _fit(self, block: str, tokens: int, limit: int) -> List[Tuple[str, int, bool]]:
+        """The block as (text, tokens, is_heading) pieces of at most ``limit`` tokens."""
+        if tokens <= limit:
+            return [(block, tokens, _is_heading(block))]
+        pieces = []
+        lines = block.splitlines()
+        for line, line_tokens in zip(lines, utils.count_tokens_batch(lines)):
+            if line_tokens > limit:
+                pieces += [
+                    (piece, limit, False) for piece in utils.split_tokens(line, limit)
+                ]
+            elif pieces and pieces[-1][1] + line_tokens + 1 <= limit:
+                text, piece_tokens, _ = pieces[-1]
+                pieces[-1] = (f"{text}\n{line}", piece_tokens + line_tokens + 1, False)
+            else:
+                pieces.append((line, line_tokens, False))
+        return pieces
+
+    def _pack(self, blocks: List[Tuple[str, int, bool]]) -> List[str]:
+        chunks = []
+        current: List[Tuple[str, int, bool]] = []
+        for block in blocks:
+            text, tokens, is_heading = block
+            current_tokens = _size(current)
+            # Blocks are joined by a blank line, about one token
+            full = current and current_tokens + tokens > self.chunk_tokens
+            section_start = is_heading and current_tokens >= self.min_chunk_tokens
+            if full or section_start:
+                # Headings go with the content after them
+                carried = []
+                while (
+                    current
+                    and current[-1][2]
+                    and _size(carried) + current[-1][1] + 1 + tokens <= self.chunk_tokens
+                ):
+                    carried.insert(0, current.pop())
+                overlap = []
+                if current:
+                    chunks.append("\n\n".join(text for text, _, _ in current))
+                    overlap = self._overlap(current)
+                # Overlap only goes in front of what fits
+                while overlap and _size(overlap + carried) + tokens > self.chunk_tokens:
+                    overlap.pop(0)
+                current = overlap + carried
+            current.append(block)
+        if current:
+            chunks.append("\n\n".join(text for text, _, _ in current))
+        return chunks
+
+    def _overlap(self, blocks: List[Tuple[str, int, bool]]) -> List[Tuple[str, int, bool]]:
+        """The last whole blocks that fit in ``overlap_tokens``."""
+        overlap = []
+        tokens = 0
+        for block in reversed(blocks):
+            tokens += block[1] + 1
+            if tokens > self.overlap_tokens:
+                break
+            overlap.insert(0, block)
+        return overlap
+
+
+def _split_blocks(text: str) -> List[str]:
+    return [block.strip() for block in _BLOCK_SEPARATOR.split(text) if block.strip()]
+
+
+def _is_heading(block: str) -> bool:
+    if "\n" in block or len(block) > HEADING_MAX_CHARS or block.endswith((".", ",", ";")):
+        return False
+    return bool(_HEADING.match(block)) or (block.isupper() and any(c.isalpha() for c in block))
+
+
+def _size(blocks: List[Tuple[str, int, bool]]) -> int:
+    """Tokens of the blocks with the separator after each of them."""
+    return sum(tokens + 1 for _, tokens, _ in blocks)
+
+
+def _line_key(line: str) -> str:
+    line = " ".join(line.split())
+    # Page numbers differ between pages, they all share one key
+    return "<page number>" if _PAGE_NUMBER.fullmatch(line) else line
+
+
+def _edge_indexes(lines: List[str]) -> set:
+    non_empty = [index for index, line in enumerate(lines) if line.strip()]
+    return set(non_empty[:BOILERPLATE_EDGE_LINES] + non_empty[-BOILERPLATE_EDGE_LINES:])
+
+
+def _remove_lines(doc: Document, boilerplate: Set[Tuple[str, str]]) -> str:
+    """The doc's text without its boilerplate edge lines, unless one is most of its text."""
+    if not boilerplate:
+        return doc.page_content
+    source = doc.metadata.get("source")
+    lines = doc.page_content.splitlines()
+    text_chars = sum(len(line.strip()) for line in lines)
+    removed = {
+        index
+        for index in _edge_indexes(lines)
+        if (source, _line_key(lines[index])) in boilerplate
+        and 2 * len(lines[index].strip()) <= text_chars
+    }
+    if not removed:
+        return doc.page_content
+    return "\n".join(line for index, line in enumerate(lines) if index not in removed)
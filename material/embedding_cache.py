@@ -0,0 +1,58 @@
+import hashlib
+import os
+from array import array
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+
+from disk_cache import DiskCache
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends unseen texts to the embedding API.
+
+    Vectors are stored as float32 under the hash of the model name and text,
+    so identical chunks uploaded by different users are embedded once.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: DiskCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode()).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_entries = [
+                (key, array("f", vector).tobytes())
+                for key, vector in zip(missing.keys(), vectors)
+            ]
+            self.cache.set_many(new_entries)
+            cached.update(new_entries)
+
+        return [_vector_from_bytes(cached[key]) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _vector_from_bytes(value: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(value)
+    return vector.tolist()
+
+
+embedding_cache = DiskCache(
+    os.environ.get("EMBEDDING_CACHE_PATH", "cache/embeddings.sqlite3"),
+    max_bytes=int(os.environ.get("EMBEDDING_CACHE_MAX_BYTES", 1024**3)),
+)
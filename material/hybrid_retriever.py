@@ -0,0 +1,148 @@
+from typing import Callable, Dict, List, Tuple
+
+from langchain.schema import Document
+
+from material.keyword_index import KeywordIndex
+from material.retrieval_cache import NamespaceRetriever, normalize_query, retrieval_cache
+from storage import DocumentIndex
+from telemetry import span
+from utils import count_tokens
+from vector_index import VectorIndex
+
+
+class HybridRetriever(NamespaceRetriever):
+    """Retrieves by vector similarity and BM25 keyword match, fused by rank.
+
+    Both searches return ``candidate_k`` chunks. Vector matches whose cosine
+    similarity is more than ``max_vector_score_gap`` below the best one are
+    dropped, embedding similarities sit in a narrow band so a ratio of the
+    best would keep them all. Keyword matches whose BM25 score is below
+    ``min_keyword_score_ratio`` of the best one are dropped. The rest are
+    ranked by reciprocal rank fusion, which only sees ranks, and taken in
+    order while they fit in ``token_budget`` tokens, at most ``max_k`` of
+    them. Users with legacy documents, which have no keyword entries, are
+    searched by vector only.
+    """
+
+    def __init__(
+        self,
+        index: VectorIndex,
+        embed_query: Callable[[str], List[float]],
+        namespace: str,
+        keyword_index: KeywordIndex,
+        document_index: DocumentIndex,
+        candidate_k: int = 20,
+        max_k: int = 6,
+        token_budget: int = 2000,
+        max_vector_score_gap: float = 0.1,
+        min_keyword_score_ratio: float = 0.5,
+        rrf_k: int = 60,
+        text_key: str = "text",
+    ):
+        super().__init__(index, embed_query, namespace, k=max_k, text_key=text_key)
+        self.keyword_index = keyword_index
+        self.document_index = document_index
+        self.candidate_k = candidate_k
+        self.token_budget = token_budget
+        self.max_vector_score_gap = max_vector_score_gap
+        self.min_keyword_score_ratio = min_keyword_score_ratio
+        self.rrf_k = rrf_k
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        with span("retrieval"):
+            return self._get_relevant_documents(query)
+
+    def _get_relevant_documents(self, query: str) -> List[Document]:
+        normalized_query = normalize_query(query)
+        embedding, embedding_key = self._embed(normalized_query)
+        cache_key = (
+            "hybrid",
+            self.k,
+            self.token_budget,
+            self.max_vector_score_gap,
+            self.min_keyword_score_ratio,
+        )
+        docs, generation = retrieval_cache.get(self.namespace, embedding_key, cache_key)
+        if docs is not None:
+            return docs
+
+        results = self.index.query(
+            vector=embedding,
+            top_k=self.candidate_k,
+            include_metadata=True,
+            namespace=self.namespace,
+        )
+        vector_matches = []
+        for match in results["matches"]:
+            metadata = dict(match["metadata"])
+            if self.text_key in metadata:
+                text = metadata.pop(self.text_key)
+                vector_matches.append(
+                    (match["id"], match["score"], Document(page_content=text, metadata=metadata))
+                )
+        if self.document_index.has_legacy_documents(self.namespace):
+            # A keyword search would only see the newer documents
+            keyword_matches = []
+        else:
+            keyword_matches = self.keyword_index.search(
+                self.namespace, normalized_query, self.candidate_k
+            )
+
+        docs = self._select(
+            self._fuse(
+                [self._filter_vector(vector_matches), self._filter_keyword(keyword_matches)]
+            )
+        )
+        retrieval_cache.set(self.namespace, embedding_key, cache_key, docs, generation)
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in docs]
+
+    def merge(self, results: List[List[Document]]) -> List[Document]:
+        """Fuse the results of several queries within the same chunk and token limits."""
+        rankings = [[(doc.page_content, doc) for doc in docs] for docs in results]
+        return self._select(self._fuse(rankings))
+
+    def _filter_vector(
+        self, matches: List[Tuple[str, float, Document]]
+    ) -> List[Tuple[str, Document]]:
+        """The vector ranking without its matches far below the best similarity."""
+        best_score = max((score for _, score, _ in matches), default=0.0)
+        min_score = best_score - self.max_vector_score_gap
+        return [(chunk_id, doc) for chunk_id, score, doc in matches if score >= min_score]
+
+    def _filter_keyword(
+        self, matches: List[Tuple[str, float, Document]]
+    ) -> List[Tuple[str, Document]]:
+        """The keyword ranking without its matches far below the best BM25 score."""
+        best_score = max((score for _, score, _ in matches), default=0.0)
+        if best_score <= 0:
+            return [(chunk_id, doc) for chunk_id, _, doc in matches]
+        min_score = self.min_keyword_score_ratio * best_score
+        return [(chunk_id, doc) for chunk_id, score, doc in matches if score >= min_score]
+
+    def _fuse(
+        self, rankings: List[List[Tuple[str, Document]]]
+    ) -> List[Tuple[float, Document]]:
+        scores: Dict[str, float] = {}
+        docs: Dict[str, Document] = {}
+        for ranking in rankings:
+            for rank, (chunk_id, doc) in enumerate(ranking):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (self.rrf_k + rank + 1)
+                docs.setdefault(chunk_id, doc)
+        return sorted(
+            ((score, docs[chunk_id]) for chunk_id, score in scores.items()),
+            key=lambda item: item[0],
+            reverse=True,
+        )
+
+    def _select(self, scored_docs: List[Tuple[float, Document]]) -> List[Document]:
+        selected = []
+        tokens = 0
+        for _, doc in scored_docs:
+            if len(selected) == self.k:
+                break
+            doc_tokens = count_tokens(doc.page_content)
+            if selected and tokens + doc_tokens > self.token_budget:
+                break
+            selected.append(doc)
+            tokens += doc_tokens
+        return selected
@@ -0,0 +1,125 @@
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Iterable, List, Tuple
+
+from langchain.schema import Document
+
+# Query terms beyond this are ignored, long prompts gain little from them
+MAX_QUERY_TERMS = 32
+
+
+class KeywordIndex:
+    """BM25 full-text index of chunks in SQLite FTS5, shared by all namespaces.
+
+    A search only matches its namespace's chunks, but the BM25 statistics,
+    how many chunks contain each term and the average chunk length, are those
+    of the whole table. Scores therefore rank one namespace's chunks for a
+    query, and are not comparable across namespaces. Chunks are stored with
+    their vector id and metadata so keyword matches can be returned without
+    a round trip to the vector index. The table lives in the document
+    index's database, so the workers sharing it see the same entries.
+    """
+
+    def __init__(self, path: str):
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # The namespace is an indexed column so a search only visits its own rows
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS keyword_chunks USING fts5("
+            " text, namespace, chunk_id UNINDEXED, metadata UNINDEXED)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS keyword_rows ("
+            " namespace TEXT NOT NULL,"
+            " chunk_id TEXT NOT NULL,"
+            " fts_rowid INTEGER NOT NULL,"
+            " PRIMARY KEY (namespace, chunk_id))"
+        )
+
+    def add(self, namespace: str, chunks: Iterable[Tuple[str, Document]]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for chunk_id, doc in chunks:
+                if self._conn.execute(
+                    "SELECT 1 FROM keyword_rows WHERE namespace = ? AND chunk_id = ?",
+                    (namespace, chunk_id),
+                ).fetchone():
+                    continue
+                cursor = self._conn.execute(
+                    "INSERT INTO keyword_chunks VALUES (?, ?, ?, ?)",
+                    (doc.page_content, _namespace_term(namespace), chunk_id, json.dumps(doc.metadata)),
+                )
+                self._conn.execute(
+                    "INSERT INTO keyword_rows VALUES (?, ?, ?)",
+                    (namespace, chunk_id, cursor.lastrowid),
+                )
+            self._conn.execute("COMMIT")
+
+    def delete(self, namespace: str, chunk_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for chunk_id in chunk_ids:
+                row = self._conn.execute(
+                    "DELETE FROM keyword_rows WHERE namespace = ? AND chunk_id = ? RETURNING fts_rowid",
+                    (namespace, chunk_id),
+                ).fetchall()
+                if row:
+                    self._conn.execute("DELETE FROM keyword_chunks WHERE rowid = ?", (row[0][0],))
+            self._conn.execute("COMMIT")
+
+    def delete_namespace(self, namespace: str) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            rows = self._conn.execute(
+                "DELETE FROM keyword_rows WHERE namespace = ? RETURNING fts_rowid", (namespace,)
+            ).fetchall()
+            self._conn.executemany("DELETE FROM keyword_chunks WHERE rowid = ?", rows)
+            self._conn.execute("COMMIT")
+
+    def search(self, namespace: str, query: str, k: int) -> List[Tuple[str, float, Document]]:
+        """Best ``k`` chunks for any of the query's terms, as (id, score, doc).
+
+        Higher scores are better.
+        """
+        terms = list(dict.fromkeys(re.findall(r"\w+", query.lower())))[:MAX_QUERY_TERMS]
+        if not terms:
+            return []
+        match = (
+            f'namespace : "{_namespace_term(namespace)}"'
+            f" AND text : ({' OR '.join(_quote(term) for term in terms)})"
+        )
+        with self._lock:
+            rows = self._conn.execute(
+                # Only the text column counts towards the score
+                "SELECT chunk_id, bm25(keyword_chunks, 1.0, 0.0), text, metadata FROM keyword_chunks"
+                " WHERE keyword_chunks MATCH ? ORDER BY bm25(keyword_chunks, 1.0, 0.0) LIMIT ?",
+                (match, k),
+            ).fetchall()
+        return [
+            (chunk_id, -score, Document(page_content=text, metadata=json.loads(metadata)))
+            for chunk_id, score, text, metadata in rows
+        ]
+
+
+def _namespace_term(namespace: str) -> str:
+    # A single token, so matching the namespace never matches a prefix of another
+    return "ns" + namespace.encode().hex()
+
+
+def _quote(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+@functools.lru_cache(maxsize=None)
+def get_keyword_index() -> KeywordIndex:
+    """The process's keyword index, opened on first use next to the document index."""
+    return KeywordIndex(os.environ.get("DOCUMENT_INDEX_PATH", "uploads/documents.sqlite3"))
@@ -1,48 +1,377 @@
+import asyncio
+import functools
+import hashlib
+import itertools
+import json
+import logging
 import os
-from typing import List
+import re
+from collections import Counter
+from typing import Callable, Iterable, List, Optional, Set, Tuple
 
-import pinecone
 from langchain import LLMChain
 from langchain.chains import ConversationalRetrievalChain
 from langchain.chains.chat_vector_db.prompts import CONDENSE_QUESTION_PROMPT
 from langchain.chains.combine_documents.map_reduce import MapReduceDocumentsChain
 from langchain.chains.combine_documents.stuff import StuffDocumentsChain
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.schema import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Pinecone
 from langchain.callbacks.base import AsyncCallbackHandler
 
-from material.material_prompt import EACH_DOC_PROMPT, COMBINE_PROMPT, DOCUMENT_PROMPT
+from clients import get_chat_model, get_embeddings, get_index
+from ingestion import IngestionCancelled
+from material.embedding_cache import CachedEmbeddings, embedding_cache
+from material.material_prompt import (
+    EACH_DOC_PROMPT,
+    COMBINE_PROMPT,
+    DOCUMENT_PROMPT,
+    SUMMARY_PROMPT,
+)
+from material.answer_cache import answer_cache, context_key
+from material.chat_history import ChatHistoryCompressor
+from material.chunker import TokenChunker
+from material.hybrid_retriever import HybridRetriever
+from material.keyword_index import get_keyword_index
+from material.retrieval_cache import retrieval_cache
+from storage import DocumentIndex, get_document_index
+from telemetry import span
 import text_extractor
 
+logger = logging.getLogger(__name__)
+
+
+ANSWER_MODEL_NAME = "gpt-3.5-turbo"
+# Cached answers are only replayed for the prompts and model that produced them
+ANSWER_PROMPT_VERSION = hashlib.sha256(
+    "\0".join(
+        [ANSWER_MODEL_NAME, COMBINE_PROMPT.template, DOCUMENT_PROMPT.template, EACH_DOC_PROMPT.template]
+    ).encode()
+).hexdigest()[:16]
+
+text_splitter = TokenChunker(
+    chunk_tokens=int(os.environ.get("CHUNK_TOKENS", 512)),
+    overlap_tokens=int(os.environ.get("CHUNK_OVERLAP_TOKENS", 0)),
+)
+
+
+# Pinecone accepts at most 1000 ids per delete request
+DELETE_BATCH_SIZE = 1000
+
 
 class MaterialVectorstore:
-    def __init__(self, user_id):
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=2000,
-            chunk_overlap=200,
-        )
-        embedding = OpenAIEmbeddings()
+    def __init__(self, user_id, document_index: Optional[DocumentIndex] = None):
+        # Records the vector ids of each document so it can be deleted on its own
+        self.document_index = document_index
+        self.text_splitter = text_splitter
+        embedding = get_embeddings()
+        # Part of the chunk ids, a new model gives every chunk a new vector
+        self.embedding_model = getattr(embedding, "model", "")
+        # Document embeddings go through the content-addressed cache
+        self.document_embedding = CachedEmbeddings(embedding, embedding_cache)
         self.user_id = user_id
+        self.embedding_batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", 64))
+        self.ingestion_concurrency = int(os.environ.get("INGESTION_CONCURRENCY", 4))
+        # Pages kept in memory to find a document's headers and footers
+        self.boilerplate_sample_pages = int(os.environ.get("BOILERPLATE_SAMPLE_PAGES", 50))
+
+        self.index = get_index()
+        # BM25 index kept next to the vectors for hybrid retrieval
+        self.keyword_index = get_keyword_index()
+        self.retriever = HybridRetriever(
+            index=self.index,
+            embed_query=embedding.embed_query,
+            namespace=self.user_id,
+            keyword_index=self.keyword_index,
+            document_index=document_index or get_document_index(),
+            candidate_k=int(os.environ.get("RETRIEVAL_CANDIDATES", 20)),
+            max_k=int(os.environ.get("RETRIEVAL_MAX_CHUNKS", 6)),
+            token_budget=int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", 2000)),
+            max_vector_score_gap=float(os.environ.get("RETRIEVAL_MAX_VECTOR_SCORE_GAP", 0.1)),
+            min_keyword_score_ratio=float(
+                os.environ.get("RETRIEVAL_MIN_KEYWORD_SCORE_RATIO", 0.5)
+            ),
+        )
+
+    async def aadd_docs_from_file(
+        self,
+        file_path: str,
+        progress_callback: Optional[Callable[[str, float], None]] = None,
+        pages_per_batch: int = 20,
+        document_id: Optional[str] = None,
+        cancelled: Optional[asyncio.Event] = None,
+    ):
+        """Ingest a file, or a new version of it when document_id is known.
+
+        Chunk ids are derived from their content, so chunks the document's
+        previous version already has are skipped and only new ones are
+        embedded and upserted. Chunks the new version no longer has are
+        deleted at the end. If ingestion fails, the chunks it added are
+        deleted again and the previous version's chunks are left as they
+        were. Once ``cancelled`` is set, IngestionCancelled is raised before
+        the next write.
+        """
+        if progress_callback:
+            progress_callback("extracting", 0.0)
+        tracked = self.document_index is not None and document_id is not None
+        stored_ids = set()
+        if tracked:
+            stored_ids = set(
+                await asyncio.to_thread(
+                    self.document_index.get_chunks, self.user_id, document_id
+                )
+            )
+        page_count = await asyncio.to_thread(text_extractor.count_pages, file_path)
+        pages = text_extractor.iter_docs(file_path, document_id)
+        pages_done = 0
+        languages = Counter()
+        chunk_ids = set()
+        try:
+            # Headers and footers are found on the first pages and removed from all of them
+            sample = await asyncio.to_thread(
+                list, itertools.islice(pages, max(pages_per_batch, self.boilerplate_sample_pages))
+            )
+            boilerplate = await asyncio.to_thread(self.text_splitter.find_boilerplate, sample)
+            pages = itertools.chain(sample, pages)
+            while True:
+                # The extraction pool keeps parsing later pages while a batch is embedded
+                batch = await asyncio.to_thread(list, itertools.islice(pages, pages_per_batch))
+                if not batch:
+                    break
+                chunk_ids |= await self.aadd_docs(
+                    batch,
+                    document_id,
+                    skip_ids=stored_ids | chunk_ids,
+                    cancelled=cancelled,
+                    boilerplate=boilerplate,
+                )
+                pages_done += len(batch)
+                languages.update(
+                    doc.metadata["language"] for doc in batch if "language" in doc.metadata
+                )
+                if progress_callback and page_count:
+                    progress_callback("embedding", min(pages_done / page_count, 1.0))
+            if tracked:
+                _check_cancelled(cancelled)
+        except Exception:
+            if tracked:
+                await self._arollback_chunks(document_id, stored_ids)
+            raise
+
+        if tracked:
+            stale_ids = stored_ids - chunk_ids
+            if stale_ids:
+                try:
+                    await self._adelete_chunks(document_id, list(stale_ids))
+                except Exception as e:
+                    # The new version is complete, ids left over are retried by the next one
+                    logger.warning("Failed to delete stale chunks of %s: %s", document_id, e)
+            language = languages.most_common(1)[0][0] if languages else None
+            await asyncio.to_thread(
+                self.document_index.update_status,
+                self.user_id,
+                document_id,
+                "ready",
+                page_count=pages_done,
+                language=language,
+            )
+
+    async def aadd_docs(
+        self,
+        docs: List[Document],
+        document_id: Optional[str] = None,
+        skip_ids: Iterable[str] = (),
+        cancelled: Optional[asyncio.Event] = None,
+        boilerplate: Optional[Set[Tuple[str, str]]] = None,
+    ) -> Set[str]:
+        """Embed and upsert docs in batches with bounded concurrency.
+
+        A batch's upsert runs while the following batches are embedded, and a
+        failing batch is retried on its own. The vector ids are recorded under
+        ``document_id`` before they are upserted, so a failed ingestion can
+        still be cleaned up. Chunks whose id is in ``skip_ids`` are already
+        stored and are left out. Batches stop before their next write once
+        ``cancelled`` is set. ``boilerplate`` is passed to the chunker when
+        the docs are a part of their source. Returns the ids of all the
+        docs' chunks.
+        """
+        if not docs:
+            return set()
+        skip_ids = set(skip_ids)
+        with span("splitting"):
+            # Tokenizing and hashing are CPU work, kept off the event loop
+            chunks = await asyncio.to_thread(self._split, docs, boilerplate)
+        chunk_ids = {chunk_id for chunk_id, _ in chunks}
+        new_chunks = {}
+        for chunk_id, sub_doc in chunks:
+            if chunk_id not in skip_ids:
+                new_chunks.setdefault(chunk_id, sub_doc)
+        new_chunks = list(new_chunks.items())
+        batches = [
+            new_chunks[start : start + self.embedding_batch_size]
+            for start in range(0, len(new_chunks), self.embedding_batch_size)
+        ]
+        embed_semaphore = asyncio.Semaphore(self.ingestion_concurrency)
+        upsert_semaphore = asyncio.Semaphore(self.ingestion_concurrency)
+
+        async def add_batch(batch):
+            ids = [chunk_id for chunk_id, _ in batch]
+            sub_docs = [sub_doc for _, sub_doc in batch]
+            async with embed_semaphore:
+                _check_cancelled(cancelled)
+                with span("embedding"):
+                    embeddings = await _run_with_retries(
+                        self.document_embedding.embed_documents,
+                        [doc.page_content for doc in sub_docs],
+                    )
+            vectors = self._get_vectors(ids, sub_docs, embeddings)
+            if self.document_index is not None and document_id is not None:
+                await asyncio.to_thread(
+                    self.document_index.add_chunks, self.user_id, document_id, ids
+                )
+            async with upsert_semaphore:
+                _check_cancelled(cancelled)
+                with span("upsert"):
+                    await _run_with_retries(
+                        self.index.upsert, vectors=vectors, namespace=self.user_id
+                    )
+            await asyncio.to_thread(self.keyword_index.add, self.user_id, batch)
+
+        results = await asyncio.gather(
+            *(add_batch(batch) for batch in batches), return_exceptions=True
+        )
+        if batches:
+            retrieval_cache.invalidate(self.user_id)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return chunk_ids
+
+    def _split(
+        self, docs: List[Document], boilerplate: Optional[Set[Tuple[str, str]]] = None
+    ) -> List[Tuple[str, Document]]:
+        """The docs' chunks with their ids."""
+        return [
+            (self._chunk_id(sub_doc), sub_doc)
+            for sub_doc in self.text_splitter.split_documents(docs, boilerplate)
+        ]
 
-        self.index = pinecone.Index(os.environ["PINECONE_INDEX"])
-        self.vectorstore = Pinecone(
-            index=self.index, embedding_function=embedding.embed_query, text_key="text", namespace=self.user_id
+    def _chunk_id(self, doc: Document) -> str:
+        """Deterministic vector id from the chunk's text, metadata and source."""
+        key = json.dumps(
+            {"model": self.embedding_model, "metadata": doc.metadata, "text": doc.page_content},
+            sort_keys=True,
         )
+        return hashlib.sha256(key.encode()).hexdigest()
 
-    def add_docs_from_file(self, file_path: str):
-        docs = text_extractor.extract_docs(file_path)
-        self.add_docs(docs)
+    @staticmethod
+    def _get_vectors(
+        ids: List[str], sub_docs: List[Document], embeddings: List[List[float]]
+    ):
+        return [
+            (vector_id, embedding, {**doc.metadata, "text": doc.page_content})
+            for vector_id, doc, embedding in zip(ids, sub_docs, embeddings)
+        ]
+
+    async def adelete_document(self, document_id: str):
+        """Delete the vectors of one document, leaving the rest of the namespace."""
+        chunk_ids = await asyncio.to_thread(
+            self.document_index.get_chunks, self.user_id, document_id
+        )
+        await self._adelete_chunks(document_id, chunk_ids)
+
+    async def _arollback_chunks(self, document_id: str, stored_ids: Set[str]):
+        """Delete the document's chunks that are not in ``stored_ids``."""
+        try:
+            chunk_ids = await asyncio.to_thread(
+                self.document_index.get_chunks, self.user_id, document_id
+            )
+            await self._adelete_chunks(
+                document_id, [chunk_id for chunk_id in chunk_ids if chunk_id not in stored_ids]
+            )
+        except Exception as e:
+            logger.error("Failed to roll back the chunks of %s: %s", document_id, e)
 
-    def add_docs(self, docs: List[Document]):
-        if docs:
-            sub_docs = self.text_splitter.split_documents(docs)
-            self.vectorstore.add_documents(sub_docs)
+    async def _adelete_chunks(self, document_id: str, chunk_ids: List[str]):
+        for start in range(0, len(chunk_ids), DELETE_BATCH_SIZE):
+            batch = chunk_ids[start : start + DELETE_BATCH_SIZE]
+            await _run_with_retries(self.index.delete, ids=batch, namespace=self.user_id)
+            await asyncio.to_thread(self.keyword_index.delete, self.user_id, batch)
+            await asyncio.to_thread(
+                self.document_index.delete_chunks, self.user_id, document_id, batch
+            )
+        retrieval_cache.invalidate(self.user_id)
 
     def delete_vectorstore(self):
         self.index.delete(delete_all=True, namespace=self.user_id)
+        self.keyword_index.delete_namespace(self.user_id)
+        retrieval_cache.invalidate(self.user_id)
+
+
+def _check_cancelled(cancelled: Optional[asyncio.Event]) -> None:
+    if cancelled is not None and cancelled.is_set():
+        raise IngestionCancelled("Ingestion was cancelled")
+
+
+async def _run_with_retries(func, *args, retries=3, backoff=1.0, **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            logger.warning("Retrying %s after error: %s", func.__name__, e)
+            await asyncio.sleep(backoff * 2**attempt)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_shared_chains(summarize_docs: bool):
+    """Build the question generator and combine chains once per process.
+
+    The callback handler is passed at call time, so the chains are shared by
+    all requests.
+    """
+    llm = get_chat_model(ANSWER_MODEL_NAME, 0.7)
+    streaming_llm = get_chat_model(ANSWER_MODEL_NAME, 0.7, streaming=True)
+
+    # Chain that runs the final prompt after docs have been combined
+    llm_combined_docs_chain = LLMChain(llm=streaming_llm, prompt=COMBINE_PROMPT)
+    combine_results_chain = StuffDocumentsChain(
+        llm_chain=llm_combined_docs_chain,
+        document_prompt=DOCUMENT_PROMPT,
+        document_variable_name="summaries",
+    )
+
+    if summarize_docs:
+        # Chain that runs on each prompt to summarise it for the context
+        llm_each_doc_chain = LLMChain(llm=llm, prompt=EACH_DOC_PROMPT)
+        combine_document_chain = MapReduceDocumentsChain(
+            llm_chain=llm_each_doc_chain,
+            combine_document_chain=combine_results_chain,
+            document_variable_name="context",
+        )
+    else:
+        combine_document_chain = combine_results_chain
+
+    question_generator = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT)
+    return question_generator, combine_document_chain
+
+
+@functools.lru_cache(maxsize=None)
+def _get_history_compressor() -> ChatHistoryCompressor:
+    summary_chain = LLMChain(llm=get_chat_model("gpt-3.5-turbo", 0), prompt=SUMMARY_PROMPT)
+    return ChatHistoryCompressor(
+        summary_chain,
+        token_budget=int(os.environ.get("HISTORY_TOKEN_BUDGET", 1500)),
+        summary_tokens=int(os.environ.get("HISTORY_SUMMARY_TOKENS", 300)),
+    )
+
+
+def _differs_materially(question: str, condensed_question: str, threshold: float) -> bool:
+    """Whether the words of the two questions overlap less than ``threshold`` (Jaccard)."""
+    words = set(re.findall(r"\w+", question.lower()))
+    condensed_words = set(re.findall(r"\w+", condensed_question.lower()))
+    if not words or not condensed_words:
+        return words != condensed_words
+    return len(words & condensed_words) / len(words | condensed_words) < threshold
 
 
 class Material(MaterialVectorstore):
@@ -51,53 +380,45 @@ class Material(MaterialVectorstore):
     ):
         # Vectorstore
         super().__init__(user_id)
-
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.7,
+        self.callback_handler = callback_handler
+        self.speculative_retrieval = (
+            os.environ.get("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
         )
-        streaming_llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
-            temperature=0.7,
-            streaming=True,
-            callbacks=[callback_handler],
-        )
-
-        # Chain that runs the final prompt after docs have been combined
-        llm_combined_docs_chain = LLMChain(llm=streaming_llm, prompt=COMBINE_PROMPT)
-        combine_results_chain = StuffDocumentsChain(
-            llm_chain=llm_combined_docs_chain,
-            document_prompt=DOCUMENT_PROMPT,
-            document_variable_name="summaries",
+        self.condensed_question_similarity = float(
+            os.environ.get("CONDENSED_QUESTION_SIMILARITY", 0.8)
         )
+        self.use_answer_cache = os.environ.get("ANSWER_CACHE", "false").lower() == "true"
+        self.prompt_version = f"{ANSWER_PROMPT_VERSION}:{summarize_docs}"
 
-        if summarize_docs:
-            # Chain that runs on each prompt to summarise it for the context
-            llm_each_doc_chain = LLMChain(llm=llm, prompt=EACH_DOC_PROMPT)
-            combine_document_chain = MapReduceDocumentsChain(
-                llm_chain=llm_each_doc_chain,
-                combine_document_chain=combine_results_chain,
-                document_variable_name="context",
-            )
-        else:
-            combine_document_chain = combine_results_chain
-
-        # Enveloping QA chain that runs on the previous chains
-        question_generator = LLMChain(llm=llm, prompt=CONDENSE_QUESTION_PROMPT)
+        # Enveloping QA chain that runs on the shared chains, bound to this user's namespace
+        question_generator, combine_document_chain = _get_shared_chains(summarize_docs)
+        self.question_generator = question_generator
+        self.combine_document_chain = combine_document_chain
         self.qa_chain = ConversationalRetrievalChain(
-            retriever=self.vectorstore.as_retriever(),
+            retriever=self.retriever,
             question_generator=question_generator,
             combine_docs_chain=combine_document_chain,
             return_source_documents=True,
+            # The history is compressed into a string before the chain is called
+            get_chat_history=lambda chat_history: chat_history,
         )
 
     async def ask_docs(self, question: Document, chat_history=None):
         try:
-            result = await self.qa_chain.acall(
-                {"question": question.page_content, "chat_history": chat_history}
-            )
+            # An empty history string makes the chain skip the condense call
+            with span("history"):
+                history = await _get_history_compressor().acompress(
+                    chat_history, callbacks=[self.callback_handler]
+                )
+            if self.speculative_retrieval or self.use_answer_cache:
+                result = await self._acall_staged(question.page_content, history)
+            else:
+                result = await self.qa_chain.acall(
+                    {"question": question.page_content, "chat_history": history},
+                    callbacks=[self.callback_handler],
+                )
         except Exception as e:
-            print(e)
+            logger.error("Exception while answering: %s", e)
             raise
 
         source_documents = result["source_documents"]
@@ -111,3 +432,60 @@ class Material(MaterialVectorstore):
             result["answer"],
             result["source_documents"],
         )
+
+    async def _acall_staged(self, question: str, history: str) -> dict:
+        """Run the QA chain's stages, with speculative retrieval and the answer cache.
+
+        With speculative retrieval, the raw question is retrieved for while
+        it is condensed. The condensed question is then only retrieved for
+        as well when its words differ materially from the raw question's,
+        and both result sets are merged within the retriever's limits. With
+        the answer cache on, a cached answer for a similar question over the
+        same chunks is streamed to the callback handler instead of calling
+        the LLM.
+        """
+        callbacks = [self.callback_handler]
+        raw_retrieval = None
+        if self.speculative_retrieval or not history:
+            raw_retrieval = asyncio.ensure_future(
+                self.retriever.aget_relevant_documents(question)
+            )
+        try:
+            if history:
+                with span("condense"):
+                    condensed_question = await self.question_generator.arun(
+                        question=question, chat_history=history, callbacks=callbacks
+                    )
+            else:
+                condensed_question = question
+            docs = await raw_retrieval if raw_retrieval else None
+        finally:
+            if raw_retrieval:
+                raw_retrieval.cancel()
+
+        if docs is None:
+            docs = await self.retriever.aget_relevant_documents(condensed_question)
+        elif _differs_materially(question, condensed_question, self.condensed_question_similarity):
+            condensed_docs = await self.retriever.aget_relevant_documents(condensed_question)
+            docs = self.retriever.merge([condensed_docs, docs])
+
+        if self.use_answer_cache:
+            context = context_key(docs, self.prompt_version)
+            embedding = await asyncio.to_thread(self.retriever.embed, condensed_question)
+            answer = answer_cache.get(context, embedding)
+            if answer is not None:
+                await self._replay_answer(answer)
+                return {"answer": answer, "source_documents": docs}
+
+        with span("answer"):
+            answer = await self.combine_document_chain.arun(
+                input_documents=docs, question=condensed_question, callbacks=callbacks
+            )
+        if self.use_answer_cache:
+            answer_cache.set(context, embedding, answer)
+        return {"answer": answer, "source_documents": docs}
+
+    async def _replay_answer(self, answer: str) -> None:
+        """Stream a cached answer as tokens, like the LLM would have."""
+        for token in re.findall(r"\s*\S+|\s+$", answer):
+            await self.callback_handler.on_llm_new_token(token)
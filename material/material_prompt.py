@@ -33,3 +33,17 @@ DOCUMENT_PROMPT = PromptTemplate(
     template="CONTENT: {page_content}\nSOURCE: {source}",
     input_variables=["page_content", "source"],
 )
+
+summary_prompt_template = """Progressively summarize the lines of a conversation between a student and an assistant, adding onto the previous summary.
+Keep the topics, questions, facts and names that later questions may refer to. Use at most 150 words.
+
+CURRENT SUMMARY:
+{summary}
+
+NEW LINES OF CONVERSATION:
+{new_lines}
+
+NEW SUMMARY:"""
+SUMMARY_PROMPT = PromptTemplate(
+    template=summary_prompt_template, input_variables=["summary", "new_lines"]
+)
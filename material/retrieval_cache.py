@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+from langchain.schema import BaseRetriever, Document
+
+from vector_index import VectorIndex
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ``ttl`` seconds after insertion."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class RetrievalCache:
+    """Caches retrieval results per namespace.
+
+    Each namespace has a generation number that is part of every key, so
+    invalidating a namespace makes all of its entries unreachable at once and
+    LRU eviction reclaims them. Results are stored under the generation of
+    their lookup, so a query that overlaps an invalidation is not cached.
+    Generations live in this process only, other workers are not
+    invalidated and serve their entries until they expire.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self._cache = TTLCache(max_entries, ttl)
+        self._generations = defaultdict(int)
+
+    def get(
+        self, namespace: str, embedding_key: str, k: Hashable
+    ) -> Tuple[Optional[List[Document]], int]:
+        """The cached docs or None, and the generation to pass to ``set``."""
+        generation = self._generations[namespace]
+        docs = self._cache.get((namespace, generation, embedding_key, k))
+        if docs is None:
+            return None, generation
+        return [_copy_document(doc) for doc in docs], generation
+
+    def set(
+        self,
+        namespace: str,
+        embedding_key: str,
+        k: Hashable,
+        docs: List[Document],
+        generation: int,
+    ) -> None:
+        if generation != self._generations[namespace]:
+            # The namespace changed while the docs were retrieved
+            return
+        self._cache.set((namespace, generation, embedding_key, k), docs)
+
+    def invalidate(self, namespace: str) -> None:
+        self._generations[namespace] += 1
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _copy_document(doc: Document) -> Document:
+    return Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+
+query_embedding_cache = TTLCache(
+    max_entries=int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("QUERY_EMBEDDING_CACHE_TTL", 24 * 3600)),
+)
+retrieval_cache = RetrievalCache(
+    max_entries=int(os.environ.get("RETRIEVAL_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("RETRIEVAL_CACHE_TTL", 3600)),
+)
+
+
+class NamespaceRetriever(BaseRetriever):
+    """Vector index retriever for one namespace backed by the query caches."""
+
+    def __init__(
+        self,
+        index: VectorIndex,
+        embed_query: Callable[[str], List[float]],
+        namespace: str,
+        k: int = 4,
+        text_key: str = "text",
+    ):
+        self.index = index
+        self.embed_query = embed_query
+        self.namespace = namespace
+        self.k = k
+        self.text_key = text_key
+
+    def get_relevant_documents(self, query: str) -> List[Document]:
+        embedding, embedding_key = self._embed(normalize_query(query))
+        docs, generation = retrieval_cache.get(self.namespace, embedding_key, self.k)
+        if docs is not None:
+            return docs
+
+        results = self.index.query(
+            vector=embedding,
+            top_k=self.k,
+            include_metadata=True,
+            namespace=self.namespace,
+        )
+        docs = []
+        for match in results["matches"]:
+            metadata = dict(match["metadata"])
+            if self.text_key in metadata:
+                text = metadata.pop(self.text_key)
+                docs.append(Document(page_content=text, metadata=metadata))
+        retrieval_cache.set(self.namespace, embedding_key, self.k, docs, generation)
+        return [_copy_document(doc) for doc in docs]
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        return await asyncio.to_thread(self.get_relevant_documents, query)
+
+    def embed(self, query: str) -> List[float]:
+        """The query's embedding, shared with retrieval through the cache."""
+        return self._embed(normalize_query(query))[0]
+
+    def _embed(self, normalized_query: str) -> Tuple[List[float], str]:
+        """The query's embedding and a key identifying it, cached."""
+        cached = query_embedding_cache.get(normalized_query)
+        if cached is not None:
+            return cached
+        embedding = self.embed_query(normalized_query)
+        embedding_key = hashlib.sha256(repr(embedding).encode()).hexdigest()
+        query_embedding_cache.set(normalized_query, (embedding, embedding_key))
+        return embedding, embedding_key
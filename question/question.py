@@ -1,35 +1,137 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
 import re
+from typing import Optional
 
-from langchain.callbacks.base import AsyncCallbackHandler
-from langchain.chat_models import ChatOpenAI
 from langchain import LLMChain
 from langchain.schema import Document
 
 import text_extractor
+from clients import get_chat_model
+from disk_cache import DiskCache
+from streaming_utils import (
+    Stream,
+    PageOrderedStream,
+    QuestionFilteredAsyncCallbackHandler,
+)
 from question.question_prompt import QUESTION_PROMPT, QUESTION_WRAPPER, CONTEXT_WRAPPER
+from utils import dict_from_document, dict_from_document_list, hash_file
+
+logger = logging.getLogger(__name__)
+
+QUESTION_MODEL_NAME = "gpt-4"
+# Cached results are only replayed for the prompt and model that produced them
+PROMPT_VERSION = hashlib.sha256(
+    f"{QUESTION_MODEL_NAME}\0{QUESTION_PROMPT.template}".encode()
+).hexdigest()[:16]
+
+question_cache = DiskCache(
+    os.environ.get("QUESTION_CACHE_PATH", "cache/questions.sqlite3"),
+    max_bytes=int(os.environ.get("QUESTION_CACHE_MAX_BYTES", 256 * 1024**2)),
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_question_chain() -> LLMChain:
+    llm = get_chat_model(QUESTION_MODEL_NAME, 0, streaming=True, request_timeout=180)
+    return LLMChain(prompt=QUESTION_PROMPT, llm=llm)
 
 
 class Question:
-    def __init__(self, callback_handler: AsyncCallbackHandler):
-        llm = ChatOpenAI(
-            model_name="gpt-4",
-            temperature=0,
-            request_timeout=180,
-            streaming=True,
-            callbacks=[callback_handler],
+    def __init__(self, stream: Stream):
+        self.stream = stream
+        self.llm_chain = _get_question_chain()
+        self.page_concurrency = int(os.environ.get("QUESTION_PAGE_CONCURRENCY", 4))
+
+    async def get_questions_and_context(
+        self,
+        question_docs_path: str,
+        content_hash: Optional[str] = None,
+        source: Optional[str] = None,
+    ):
+        if content_hash is None:
+            content_hash, _ = await asyncio.to_thread(hash_file, question_docs_path)
+        # Keyed by content so identical documents share results across users
+        cache_key = f"{content_hash}:{PROMPT_VERSION}"
+        cached = await asyncio.to_thread(question_cache.get, cache_key)
+        if cached is not None:
+            pages = json.loads(cached)
+            await self._replay_pages(pages)
+            return pages
+
+        question_docs = await asyncio.to_thread(
+            text_extractor.extract_docs, question_docs_path, source
         )
-        self.llm_chain = LLMChain(prompt=QUESTION_PROMPT, llm=llm)
+        # Pages are sent to the LLM concurrently but streamed in page order
+        ordered_stream = PageOrderedStream(self.stream, len(question_docs))
+        semaphore = asyncio.Semaphore(self.page_concurrency)
+        pages = [None] * len(question_docs)
 
-    async def get_questions_and_context(self, question_docs_path: str):
-        question_docs = text_extractor.extract_docs(question_docs_path)
+        async def extract_page(page_index: int, question_doc: Document):
+            async with semaphore:
+                # Progress goes through the page's stream to stay in order with its tokens
+                page_stream = ordered_stream.page(page_index)
+                await self._send_page_progress(
+                    page_stream, page_index, len(question_docs), "started"
+                )
+                callback_handler = QuestionFilteredAsyncCallbackHandler(page_stream)
+                try:
+                    status = "done"
+                    try:
+                        response = await self.llm_chain.acall(
+                            {"text": question_doc.page_content}, callbacks=[callback_handler]
+                        )
+                        context, questions = self._get_context_and_questions(
+                            question_doc, response
+                        )
+                        pages[page_index] = {
+                            "response": response["text"],
+                            "context": dict_from_document(context),
+                            "questions": dict_from_document_list(questions),
+                        }
+                    except Exception as e:
+                        logger.warning("Got api call error: %s", e)
+                        status = "failed"
+                    await self._send_page_progress(
+                        page_stream, page_index, len(question_docs), status
+                    )
+                finally:
+                    await ordered_stream.finish_page(page_index)
 
-        for question_doc in question_docs:
-            full_text = question_doc.page_content
-            try:
-                response = await self.llm_chain.acall({"text": full_text})
-            except Exception as e:
-                print(f"Got api call error: {e}")
-                continue
+        await asyncio.gather(
+            *(
+                extract_page(page_index, question_doc)
+                for page_index, question_doc in enumerate(question_docs)
+            )
+        )
+
+        # Only complete results are cached so failed pages are retried next time
+        if all(page is not None for page in pages):
+            await asyncio.to_thread(
+                question_cache.set, cache_key, json.dumps(pages).encode()
+            )
+        return pages
+
+    async def _replay_pages(self, pages: list):
+        """Stream cached pages with the same events as a live extraction."""
+        for page_index, page in enumerate(pages):
+            await self._send_page_progress(self.stream, page_index, len(pages), "started")
+            callback_handler = QuestionFilteredAsyncCallbackHandler(self.stream)
+            await callback_handler.on_llm_new_token(page["response"])
+            await self._send_page_progress(self.stream, page_index, len(pages), "done")
+
+    @staticmethod
+    async def _send_page_progress(stream, page_index: int, page_count: int, status: str):
+        await stream.asend(
+            {
+                "event": "page_progress",
+                "data": {"page": page_index, "pages": page_count, "status": status},
+            }
+        )
 
     @staticmethod
     def _get_context_and_questions(question_doc, response):
@@ -52,4 +154,4 @@ class Question:
             for q in question_matches
         ]
 
-        return  context, questions
+        return context, questions
@@ -0,0 +1,394 @@
+import asyncio
+import json
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+
+class SchedulerOverloaded(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows ``capacity`` units at once, refilled at ``rate`` units per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._available = capacity
+        self._updated_at = time.monotonic()
+
+    @property
+    def available(self) -> float:
+        self._refill()
+        return self._available
+
+    @property
+    def full(self) -> bool:
+        return self.available >= self.capacity
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until ``amount`` units are available, 0 if they are now."""
+        # Amounts over the capacity would never fit, they wait for a full bucket
+        missing = min(amount, self.capacity) - self.available
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self._available -= min(amount, self.capacity)
+
+    def refund(self, amount: float) -> None:
+        self._refill()
+        self._available = min(self.capacity, self._available + amount)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(
+            self.capacity, self._available + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+
+class ModelLimits:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_concurrent: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+
+
+# Defaults for the models the server calls, overridden by MODEL_LIMITS
+DEFAULT_MODEL_LIMITS = {
+    "gpt-3.5-turbo": ModelLimits(3500, 90000, 50),
+    "gpt-4": ModelLimits(200, 40000, 10),
+}
+
+
+# Ticket of the request running in the current context, charged for its LLM calls
+_current_ticket: ContextVar[Optional["Ticket"]] = ContextVar("current_ticket", default=None)
+
+
+class Ticket:
+    """A request waiting for, then holding, slots of a model.
+
+    ``async with ticket`` waits for the slots, reporting queue position
+    changes to ``on_position``, and releases them on exit. LLM calls made
+    inside it are charged to the scheduler with ``record_llm_call``.
+    """
+
+    def __init__(
+        self,
+        scheduler: "Scheduler",
+        user_id: str,
+        model: str,
+        tokens: int,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+        slots: int = 1,
+    ):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.model = model
+        self.tokens = tokens
+        self.on_position = on_position
+        self.slots = slots
+        self.position: Optional[int] = None
+        self.granted = False
+        self.released = False
+        # What was paid for when granted and no LLM call has used yet
+        self.prepaid_requests = 0
+        self.prepaid_tokens = 0
+        self._changed = asyncio.Event()
+
+    async def __aenter__(self) -> "Ticket":
+        reported = None
+        try:
+            while True:
+                self._changed.clear()
+                if self.granted:
+                    _current_ticket.set(self)
+                    return self
+                if self.on_position and self.position != reported:
+                    reported = self.position
+                    await self.on_position(reported)
+                await self._changed.wait()
+        except BaseException:
+            self.scheduler.release(self)
+            raise
+
+    async def __aexit__(self, *exc_info) -> None:
+        _current_ticket.set(None)
+        self.scheduler.release(self)
+
+    def _notify(self) -> None:
+        self._changed.set()
+
+
+class _ModelQueue:
+    def __init__(self, model: str, limits: ModelLimits):
+        self.model = model
+        self.limits = limits
+        self.requests = TokenBucket(limits.requests_per_minute / 60, limits.requests_per_minute)
+        self.tokens = TokenBucket(limits.tokens_per_minute / 60, limits.tokens_per_minute)
+        self.active = 0
+        # Waiting tickets per user, users in round-robin order
+        self.waiting: "OrderedDict[str, Deque[Ticket]]" = OrderedDict()
+        self.waiting_count = 0
+        self.waiting_tokens = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class Scheduler:
+    """Admission control for LLM-backed requests.
+
+    Each request takes a ticket for the model it mostly uses, with an
+    estimate of its tokens and the number of calls it makes at once.
+    Tickets are granted while the model has that many free slots and its
+    request and token buckets allow, and the user's own buckets allow. The
+    estimate is paid when the ticket is granted, then reconciled with the
+    LLM calls the request actually makes: calls beyond it are charged as
+    they end, and what is left of it is refunded on release. Waiting users
+    are served round-robin, so one user's burst queues behind everyone
+    else's next request. A ticket that needs more slots than are free keeps
+    them for itself as they free up, instead of letting tickets behind it
+    take them. Requests are refused up front, instead of queued, when the
+    queues are too deep or the expected wait exceeds ``max_queue_wait``
+    seconds.
+    """
+
+    def __init__(
+        self,
+        model_limits: Dict[str, ModelLimits],
+        user_requests_per_minute: float = 20,
+        user_tokens_per_minute: float = 40000,
+        max_queue_size: int = 200,
+        max_user_queue_size: int = 5,
+        max_queue_wait: float = 30,
+    ):
+        self.model_limits = model_limits
+        self.user_requests_per_minute = user_requests_per_minute
+        self.user_tokens_per_minute = user_tokens_per_minute
+        self.max_queue_size = max_queue_size
+        self.max_user_queue_size = max_user_queue_size
+        self.max_queue_wait = max_queue_wait
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._user_requests: Dict[str, TokenBucket] = {}
+        self._user_tokens: Dict[str, TokenBucket] = {}
+
+    def enqueue(
+        self,
+        user_id: str,
+        model: str,
+        tokens: int,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+        slots: int = 1,
+    ) -> Ticket:
+        """Queue a request, raising SchedulerOverloaded if it should be refused."""
+        queue = self._queue(model)
+        slots = max(1, min(slots, queue.limits.max_concurrent))
+        user_waiting = len(queue.waiting.get(user_id, ()))
+        if queue.waiting_count >= self.max_queue_size:
+            raise SchedulerOverloaded(f"Too many queued {model} requests", self._retry_after(queue))
+        if user_waiting >= self.max_user_queue_size:
+            raise SchedulerOverloaded("Too many queued requests for this user", self._retry_after(queue))
+        expected_wait = self._expected_wait(queue, tokens)
+        if expected_wait > self.max_queue_wait:
+            raise SchedulerOverloaded(f"{model} is over capacity", expected_wait)
+
+        ticket = Ticket(self, user_id, model, tokens, on_position, slots)
+        queue.waiting.setdefault(user_id, deque()).append(ticket)
+        queue.waiting_count += 1
+        queue.waiting_tokens += tokens
+        self._dispatch(queue)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        if ticket.released:
+            return
+        ticket.released = True
+        queue = self._queues[ticket.model]
+        if ticket.granted:
+            queue.active -= ticket.slots
+            # Give back what the request was charged for and did not use
+            user_requests, user_tokens = self._user_buckets(ticket.user_id)
+            for bucket, amount in (
+                (queue.requests, ticket.prepaid_requests),
+                (queue.tokens, ticket.prepaid_tokens),
+                (user_requests, ticket.prepaid_requests),
+                (user_tokens, ticket.prepaid_tokens),
+            ):
+                bucket.refund(amount)
+            ticket.prepaid_requests = ticket.prepaid_tokens = 0
+        else:
+            user_tickets = queue.waiting[ticket.user_id]
+            user_tickets.remove(ticket)
+            if not user_tickets:
+                del queue.waiting[ticket.user_id]
+            queue.waiting_count -= 1
+            queue.waiting_tokens -= ticket.tokens
+        self._dispatch(queue)
+
+    def charge(self, ticket: Ticket, model: str, tokens: int) -> None:
+        """Charge one LLM call of ``tokens`` made under ``ticket``.
+
+        Calls of the ticket's model use what was paid when it was granted
+        first. The rest is taken from the buckets now, leaving them in debt
+        if needed so that the next tickets wait for it.
+        """
+        queue = self._queue(model)
+        requests = 1
+        if model == ticket.model:
+            if ticket.prepaid_requests:
+                ticket.prepaid_requests -= 1
+                requests = 0
+            prepaid = min(tokens, ticket.prepaid_tokens)
+            ticket.prepaid_tokens -= prepaid
+            tokens -= prepaid
+        user_requests, user_tokens = self._user_buckets(ticket.user_id)
+        for bucket, amount in (
+            (queue.requests, requests),
+            (queue.tokens, tokens),
+            (user_requests, requests),
+            (user_tokens, tokens),
+        ):
+            bucket.consume(amount)
+
+    def stats(self) -> dict:
+        return {
+            model: {
+                "active": queue.active,
+                "waiting": queue.waiting_count,
+                "waiting_users": len(queue.waiting),
+            }
+            for model, queue in self._queues.items()
+        }
+
+    def _queue(self, model: str) -> _ModelQueue:
+        if model not in self._queues:
+            limits = self.model_limits.get(model) or ModelLimits(600, 100000, 20)
+            self._queues[model] = _ModelQueue(model, limits)
+        return self._queues[model]
+
+    def _user_buckets(self, user_id: str):
+        if user_id not in self._user_requests:
+            self._prune_user_buckets()
+            self._user_requests[user_id] = TokenBucket(
+                self.user_requests_per_minute / 60, self.user_requests_per_minute
+            )
+            self._user_tokens[user_id] = TokenBucket(
+                self.user_tokens_per_minute / 60, self.user_tokens_per_minute
+            )
+        return self._user_requests[user_id], self._user_tokens[user_id]
+
+    def _prune_user_buckets(self) -> None:
+        # Full buckets hold no state, drop them once there are many
+        if len(self._user_requests) < 10000:
+            return
+        for user_id in list(self._user_requests):
+            if self._user_requests[user_id].full and self._user_tokens[user_id].full:
+                del self._user_requests[user_id]
+                del self._user_tokens[user_id]
+
+    def _dispatch(self, queue: _ModelQueue) -> None:
+        """Grant waiting tickets round-robin while the limits allow."""
+        if queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+
+        retry_in = math.inf
+        while queue.waiting and queue.active < queue.limits.max_concurrent:
+            granted = False
+            for user_id, user_tickets in queue.waiting.items():
+                ticket = user_tickets[0]
+                if queue.active + ticket.slots > queue.limits.max_concurrent:
+                    # Later tickets would keep taking the slots it waits for
+                    break
+                user_requests, user_tokens = self._user_buckets(user_id)
+                wait = max(
+                    queue.requests.wait_time(1),
+                    queue.tokens.wait_time(ticket.tokens),
+                    user_requests.wait_time(1),
+                    user_tokens.wait_time(ticket.tokens),
+                )
+                if wait > 0:
+                    retry_in = min(retry_in, wait)
+                    continue
+                for bucket, amount in (
+                    (queue.requests, 1),
+                    (queue.tokens, ticket.tokens),
+                    (user_requests, 1),
+                    (user_tokens, ticket.tokens),
+                ):
+                    bucket.consume(amount)
+                user_tickets.popleft()
+                # The user goes to the back of the round
+                del queue.waiting[user_id]
+                if user_tickets:
+                    queue.waiting[user_id] = user_tickets
+                queue.waiting_count -= 1
+                queue.waiting_tokens -= ticket.tokens
+                queue.active += ticket.slots
+                ticket.prepaid_requests = 1
+                ticket.prepaid_tokens = ticket.tokens
+                ticket.granted = True
+                ticket.position = 0
+                ticket._notify()
+                granted = True
+                break
+            if not granted:
+                break
+
+        if queue.waiting and queue.active < queue.limits.max_concurrent and retry_in < math.inf:
+            queue.timer = asyncio.get_running_loop().call_later(
+                retry_in, self._dispatch, queue
+            )
+        self._update_positions(queue)
+
+    def _update_positions(self, queue: _ModelQueue) -> None:
+        # A user's n-th ticket is served after the n-th round over the waiting users
+        users = len(queue.waiting)
+        for user_index, user_tickets in enumerate(queue.waiting.values()):
+            for depth, ticket in enumerate(user_tickets):
+                position = depth * users + user_index + 1
+                if ticket.position != position:
+                    ticket.position = position
+                    ticket._notify()
+
+    def _expected_wait(self, queue: _ModelQueue, tokens: int) -> float:
+        """Seconds before the model's buckets have served the queue and this request."""
+        return max(
+            (queue.waiting_count + 1 - queue.requests.available) / queue.requests.rate,
+            (queue.waiting_tokens + tokens - queue.tokens.available) / queue.tokens.rate,
+            0.0,
+        )
+
+    def _retry_after(self, queue: _ModelQueue) -> float:
+        return max(1.0, self._expected_wait(queue, 0))
+
+
+def record_llm_call(model: str, tokens: int) -> None:
+    """Charge an LLM call to the ticket of the request making it, if any."""
+    ticket = _current_ticket.get()
+    if ticket is not None:
+        ticket.scheduler.charge(ticket, model, tokens)
+
+
+def _load_model_limits() -> Dict[str, ModelLimits]:
+    limits = dict(DEFAULT_MODEL_LIMITS)
+    # e.g. {"gpt-4": {"requests_per_minute": 200, "tokens_per_minute": 40000, "max_concurrent": 10}}
+    for model, values in json.loads(os.environ.get("MODEL_LIMITS", "{}")).items():
+        limits[model] = ModelLimits(**values)
+    return limits
+
+
+scheduler = Scheduler(
+    _load_model_limits(),
+    user_requests_per_minute=float(os.environ.get("USER_REQUESTS_PER_MINUTE", 20)),
+    user_tokens_per_minute=float(os.environ.get("USER_TOKENS_PER_MINUTE", 40000)),
+    max_queue_size=int(os.environ.get("SCHEDULER_MAX_QUEUE_SIZE", 200)),
+    max_user_queue_size=int(os.environ.get("SCHEDULER_MAX_USER_QUEUE_SIZE", 5)),
+    max_queue_wait=float(os.environ.get("SCHEDULER_MAX_QUEUE_WAIT", 30)),
+)
@@ -0,0 +1,116 @@
+"""Startup resources and timing.
+
+Run ``python startup.py`` at build time to download the NLTK data used by the
+unstructured loaders and the tiktoken encoding used to count tokens, so
+nothing is fetched when a dyno or container starts. The server never
+downloads the encoding, it fails to start without it. On Heroku the python
+buildpack also downloads the NLTK data from ``nltk.txt``, and the Procfile
+runs this script in the release phase.
+"""
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# NLTK resource name -> path checked with nltk.data.find
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "averaged_perceptron_tagger": "taggers/averaged_perceptron_tagger",
+}
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._last_mark = self.started_at
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, name: str) -> None:
+        """Record the time since the previous mark as a phase."""
+        now = time.perf_counter()
+        self.phases[name] = now - self._last_mark
+        self._last_mark = now
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def report(self) -> str:
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        total = time.perf_counter() - self.started_at
+        return f"Ready in {total:.2f}s ({phases})"
+
+
+startup_timer = StartupTimer()
+
+
+def find_missing_nltk_resources() -> List[str]:
+    import nltk
+
+    missing = []
+    for resource, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            missing.append(resource)
+    return missing
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_nltk_resources() -> None:
+    """Download missing NLTK resources, once per process.
+
+    Only a fallback for environments that skipped the build step, it is
+    called the first time a loader that needs NLTK is used.
+    """
+    import nltk
+
+    with startup_timer.phase("nltk"):
+        for resource in find_missing_nltk_resources():
+            logger.warning("NLTK resource %s is missing, downloading it", resource)
+            nltk.download(resource, quiet=True)
+
+
+def download_tiktoken_encoding() -> None:
+    """Download the tiktoken encoding's ranks to ``utils.encoding_path()`` if missing."""
+    import requests
+
+    import utils
+
+    path = utils.encoding_path()
+    if os.path.exists(path):
+        return
+    response = requests.get(utils.ENCODING_URL, timeout=60)
+    response.raise_for_status()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.partial"
+    with open(partial, "wb") as f:
+        f.write(response.content)
+    os.replace(partial, path)
+
+
+def ensure_tiktoken_encoding() -> None:
+    """Load the tiktoken encoding, failing if the build step did not download it."""
+    import utils
+
+    with startup_timer.phase("tiktoken"):
+        utils._get_encoding()
+
+
+if __name__ == "__main__":
+    ensure_nltk_resources()
+    missing = find_missing_nltk_resources()
+    if missing:
+        raise SystemExit(f"Failed to download NLTK resources: {', '.join(missing)}")
+    print("NLTK resources are installed")
+    download_tiktoken_encoding()
+    ensure_tiktoken_encoding()
+    print("tiktoken encoding is installed")
@@ -0,0 +1,3 @@
+from storage.storage import *
+from storage.file_cache import FileCache
+from storage.document_index import DocumentIndex, InvalidCursor, get_document_index
@@ -0,0 +1,310 @@
+import base64
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class DocumentIndex:
+    """SQLite catalog of the documents each user has uploaded.
+
+    Records where each document is stored, its ingestion status, page count
+    and language, and the ids of its vectors. Listing and lookups read the
+    catalog instead of the storage backend or the vector index.
+    """
+
+    def __init__(self, path: str):
+        parent = os.path.dirname(path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            " user_id TEXT NOT NULL,"
+            " document_id TEXT NOT NULL,"
+            " content_hash TEXT NOT NULL,"
+            " object_key TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'uploaded',"
+            " page_count INTEGER,"
+            " language TEXT,"
+            " updated_at REAL,"
+            # A pending new version, the document serves the previous one until it is ingested
+            " pending_content_hash TEXT,"
+            " pending_object_key TEXT,"
+            " pending_size INTEGER,"
+            # Migrated from the per-user folders, its chunks were never recorded or keyword indexed
+            " legacy INTEGER NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (user_id, document_id))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS documents_user_hash"
+            " ON documents (user_id, content_hash)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS documents_object_key ON documents (object_key)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS documents_pending_object_key"
+            " ON documents (pending_object_key)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS documents_user_created"
+            " ON documents (user_id, created_at, document_id)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " user_id TEXT NOT NULL,"
+            " document_id TEXT NOT NULL,"
+            " chunk_id TEXT NOT NULL,"
+            " PRIMARY KEY (user_id, document_id, chunk_id))"
+        )
+
+    def add(
+        self,
+        user_id: str,
+        document_id: str,
+        content_hash: str,
+        object_key: str,
+        size: int,
+        legacy: bool = False,
+    ) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO documents (user_id, document_id, content_hash, object_key,"
+                " size, created_at, updated_at, legacy) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, document_id, content_hash, object_key, size, now, now, int(legacy)),
+            )
+
+    def add_version(
+        self, user_id: str, document_id: str, content_hash: str, object_key: str, size: int
+    ) -> None:
+        """Record a new version of a document as pending, replacing any pending one."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE documents SET pending_content_hash = ?, pending_object_key = ?,"
+                " pending_size = ?, status = 'uploaded', updated_at = ?"
+                " WHERE user_id = ? AND document_id = ?",
+                (content_hash, object_key, size, time.time(), user_id, document_id),
+            )
+
+    def promote_version(
+        self, user_id: str, document_id: str, content_hash: str, object_key: str, size: int
+    ) -> Optional[str]:
+        """Serve an ingested version, returning the object key it replaced.
+
+        The version stops being pending, unless a newer one was uploaded
+        while it was ingested.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            rows = self._conn.execute(
+                "SELECT object_key FROM documents WHERE user_id = ? AND document_id = ?",
+                (user_id, document_id),
+            ).fetchall()
+            self._conn.execute(
+                "UPDATE documents SET content_hash = ?, object_key = ?, size = ?, legacy = 0,"
+                " pending_content_hash = CASE WHEN pending_object_key = ?"
+                "  THEN NULL ELSE pending_content_hash END,"
+                " pending_size = CASE WHEN pending_object_key = ?"
+                "  THEN NULL ELSE pending_size END,"
+                " pending_object_key = CASE WHEN pending_object_key = ?"
+                "  THEN NULL ELSE pending_object_key END,"
+                " updated_at = ?"
+                " WHERE user_id = ? AND document_id = ?",
+                (
+                    content_hash,
+                    object_key,
+                    size,
+                    object_key,
+                    object_key,
+                    object_key,
+                    time.time(),
+                    user_id,
+                    document_id,
+                ),
+            )
+            self._conn.execute("COMMIT")
+        return rows[0]["object_key"] if rows else None
+
+    def drop_version(self, user_id: str, document_id: str, object_key: str) -> None:
+        """Forget a pending version, the document keeps serving its current one."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE documents SET pending_content_hash = NULL, pending_object_key = NULL,"
+                " pending_size = NULL, status = 'ready', updated_at = ?"
+                " WHERE user_id = ? AND document_id = ? AND pending_object_key = ?",
+                (time.time(), user_id, document_id, object_key),
+            )
+
+    def get(self, user_id: str, document_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM documents WHERE user_id = ? AND document_id = ?",
+                (user_id, document_id),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def has_legacy_documents(self, user_id: str) -> bool:
+        with self._lock:
+            return (
+                self._conn.execute(
+                    "SELECT 1 FROM documents WHERE user_id = ? AND legacy = 1 LIMIT 1",
+                    (user_id,),
+                ).fetchone()
+                is not None
+            )
+
+    def find_by_hash(self, user_id: str, content_hash: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM documents WHERE user_id = ? AND content_hash = ?",
+                (user_id, content_hash),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list(
+        self, user_id: str, limit: Optional[int] = None, cursor: Optional[str] = None
+    ) -> Tuple[List[dict], Optional[str]]:
+        """A page of the user's documents, oldest first, and the next page's cursor.
+
+        The cursor encodes the creation time and id of the last document of
+        the page, so pages stay consistent while documents are added or
+        deleted, including that one. Raises InvalidCursor for a cursor this
+        method did not return.
+        """
+        query = (
+            "SELECT documents.*,"
+            " (SELECT COUNT(*) FROM chunks"
+            "  WHERE chunks.user_id = documents.user_id"
+            "  AND chunks.document_id = documents.document_id) AS chunk_count"
+            " FROM documents WHERE user_id = ?"
+        )
+        params = [user_id]
+        if cursor is not None:
+            query += " AND (created_at, document_id) > (?, ?)"
+            params += _decode_cursor(cursor)
+        query += " ORDER BY created_at, document_id"
+        if limit is not None:
+            # One extra row tells whether there is a next page
+            query += " LIMIT ?"
+            params.append(limit + 1)
+        with self._lock:
+            rows = [dict(row) for row in self._conn.execute(query, params).fetchall()]
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            return rows, _encode_cursor(rows[-1])
+        return rows, None
+
+    def update_status(
+        self,
+        user_id: str,
+        document_id: str,
+        status: str,
+        page_count: Optional[int] = None,
+        language: Optional[str] = None,
+    ) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE documents SET status = ?,"
+                " page_count = COALESCE(?, page_count),"
+                " language = COALESCE(?, language),"
+                " updated_at = ?"
+                " WHERE user_id = ? AND document_id = ?",
+                (status, page_count, language, time.time(), user_id, document_id),
+            )
+
+    def add_chunks(self, user_id: str, document_id: str, chunk_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunks VALUES (?, ?, ?)",
+                [(user_id, document_id, chunk_id) for chunk_id in chunk_ids],
+            )
+            self._conn.execute("COMMIT")
+
+    def get_chunks(self, user_id: str, document_id: str) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id FROM chunks WHERE user_id = ? AND document_id = ?",
+                (user_id, document_id),
+            ).fetchall()
+        return [row["chunk_id"] for row in rows]
+
+    def delete_chunks(self, user_id: str, document_id: str, chunk_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "DELETE FROM chunks WHERE user_id = ? AND document_id = ? AND chunk_id = ?",
+                [(user_id, document_id, chunk_id) for chunk_id in chunk_ids],
+            )
+            self._conn.execute("COMMIT")
+
+    def delete(self, user_id: str, document_id: str) -> Optional[dict]:
+        """Remove a document and its chunks, returning the removed document."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            rows = self._conn.execute(
+                "DELETE FROM documents WHERE user_id = ? AND document_id = ? RETURNING *",
+                (user_id, document_id),
+            ).fetchall()
+            self._conn.execute(
+                "DELETE FROM chunks WHERE user_id = ? AND document_id = ?",
+                (user_id, document_id),
+            )
+            self._conn.execute("COMMIT")
+        return dict(rows[0]) if rows else None
+
+    def delete_user(self, user_id: str) -> List[dict]:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            rows = self._conn.execute(
+                "DELETE FROM documents WHERE user_id = ? RETURNING *", (user_id,)
+            ).fetchall()
+            self._conn.execute("DELETE FROM chunks WHERE user_id = ?", (user_id,))
+            self._conn.execute("COMMIT")
+        return [dict(row) for row in rows]
+
+    def object_references(self, object_key: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM documents WHERE object_key = ? OR pending_object_key = ?",
+                (object_key, object_key),
+            ).fetchone()[0]
+
+
+def _encode_cursor(document: dict) -> str:
+    key = json.dumps([document["created_at"], document["document_id"]])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> list:
+    try:
+        created_at, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid cursor") from e
+    if (
+        not isinstance(created_at, (int, float))
+        or isinstance(created_at, bool)
+        or not isinstance(document_id, str)
+    ):
+        raise InvalidCursor("Invalid cursor")
+    return [created_at, document_id]
+
+
+@functools.lru_cache(maxsize=None)
+def get_document_index() -> DocumentIndex:
+    """The process's document index, opened on first use."""
+    return DocumentIndex(os.environ.get("DOCUMENT_INDEX_PATH", "uploads/documents.sqlite3"))
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from storage.storage import StorageBackend
+
+
+class FileCache:
+    """Local read-through cache of storage objects, evicting least recently used.
+
+    Objects are immutable, so a cached copy is valid for as long as it is kept.
+    Concurrent reads of the same missing object wait for a single download.
+    """
+
+    def __init__(self, path: str = "cache/files", max_bytes: int = 2 * 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self._download_locks = defaultdict(asyncio.Lock)
+        self._evict_lock = threading.Lock()
+
+    async def get(self, key: str, storage: StorageBackend) -> str:
+        """Local path of the object, downloading it on a miss."""
+        path = self._path(key)
+        if await asyncio.to_thread(_touch, path):
+            return path
+        async with self._download_locks[key]:
+            if not await asyncio.to_thread(os.path.exists, path):
+                partial_path = f"{path}.{uuid.uuid4()}.part"
+                try:
+                    await storage.download(key, partial_path)
+                    await asyncio.to_thread(os.replace, partial_path, path)
+                finally:
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+                await asyncio.to_thread(self._evict)
+        self._download_locks.pop(key, None)
+        return path
+
+    def add(self, key: str, file_path: str) -> None:
+        """Move a file that was just stored into the cache, it is likely read next."""
+        shutil.move(file_path, self._path(key))
+        self._evict()
+
+    def discard(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        with self._evict_lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".part"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+
+def _touch(path: str) -> bool:
+    """Mark a cached file as recently used, False if it is not cached."""
+    try:
+        os.utime(path, (time.time(), time.time()))
+    except FileNotFoundError:
+        return False
+    return True
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import shutil
+import threading
+from typing import Optional
+
+
+class StorageBackend:
+    """Content-addressed blob store for uploaded files.
+
+    Keys are derived from the content, so an object is never modified once
+    written and can be cached anywhere without invalidation.
+    """
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        """Store the file under key, the backend may move it."""
+        raise NotImplementedError
+
+    async def download(self, key: str, file_path: str) -> None:
+        raise NotImplementedError
+
+    async def read_range(self, key: str, start: int, length: int) -> bytes:
+        raise NotImplementedError
+
+    async def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[str]:
+        """Path the object can be read from directly, if it is on local disk."""
+        return None
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root: str = "uploads/.objects"):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        await asyncio.to_thread(shutil.move, file_path, self._path(key))
+
+    async def download(self, key: str, file_path: str) -> None:
+        await asyncio.to_thread(shutil.copyfile, self._path(key), file_path)
+
+    async def read_range(self, key: str, start: int, length: int) -> bytes:
+        return await asyncio.to_thread(self._read_range, key, start, length)
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(key))
+
+    async def delete(self, key: str) -> None:
+        try:
+            await asyncio.to_thread(os.remove, self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, key: str) -> Optional[str]:
+        return self._path(key)
+
+    def _read_range(self, key: str, start: int, length: int) -> bytes:
+        with open(self._path(key), "rb") as file_object:
+            file_object.seek(start)
+            return file_object.read(length)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+
+class S3Storage(StorageBackend):
+    """Objects in an S3 bucket, or any S3 compatible store such as MinIO.
+
+    boto3 is only needed when this backend is used. Its client is thread
+    safe, so the blocking calls run in worker threads.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        client=None,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+
+                self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+            return self._client
+
+    async def put_file(self, key: str, file_path: str) -> None:
+        # upload_file switches to parallel multipart uploads for large files
+        await asyncio.to_thread(
+            self.client.upload_file, file_path, self.bucket, self._key(key)
+        )
+
+    async def download(self, key: str, file_path: str) -> None:
+        await asyncio.to_thread(
+            self.client.download_file, self.bucket, self._key(key), file_path
+        )
+
+    async def read_range(self, key: str, start: int, length: int) -> bytes:
+        response = await asyncio.to_thread(
+            self.client.get_object,
+            Bucket=self.bucket,
+            Key=self._key(key),
+            Range=f"bytes={start}-{start + length - 1}",
+        )
+        return await asyncio.to_thread(response["Body"].read)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(
+                self.client.head_object, Bucket=self.bucket, Key=self._key(key)
+            )
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(
+            self.client.delete_object, Bucket=self.bucket, Key=self._key(key)
+        )
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+
+def get_storage_backend() -> StorageBackend:
+    backend = os.environ.get("STORAGE_BACKEND", "local")
+    if backend == "local":
+        return LocalStorage(os.environ.get("STORAGE_PATH", "uploads/.objects"))
+    if backend == "s3":
+        return S3Storage(
+            bucket=os.environ["S3_BUCKET"],
+            prefix=os.environ.get("S3_PREFIX", ""),
+            endpoint_url=os.environ.get("S3_ENDPOINT_URL") or None,
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
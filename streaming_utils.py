@@ -1,51 +1,235 @@
 import json
+import logging
+import time
 
 import asyncio
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, Union
 from uuid import UUID
 
 from langchain.callbacks.base import AsyncCallbackHandler
 from langchain.schema import LLMResult
 
+from scheduler import record_llm_call
+from telemetry import LLMCall, observe_stage
+
+logger = logging.getLogger(__name__)
+
+
+_END_OF_STREAM = object()
+
+
+class StreamClosed(Exception):
+    pass
+
 
 class Stream:
-    def __init__(self) -> None:
-        self._queue = asyncio.Queue[dict]()
+    """Bounded stream of events from a producer task to the SSE publisher.
+
+    ``asend`` waits while ``maxsize`` events are queued, so a slow client
+    slows the producer down instead of growing memory. Consecutive token
+    events are coalesced into one frame of up to ``max_frame_bytes``, waiting
+    at most ``coalesce_window`` seconds for more tokens, and frames are
+    yielded already serialized.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 256,
+        coalesce_window: float = 0.0,
+        max_frame_bytes: int = 4096,
+    ) -> None:
+        self._queue = asyncio.Queue[Any](maxsize)
+        self._coalesce_window = coalesce_window
+        self._max_frame_bytes = max_frame_bytes
+        self._pending: Any = None
+        self._closed = False
 
     def __aiter__(self) -> "Stream":
         return self
 
-    async def __anext__(self) -> dict:
-        return await self._queue.get()
+    async def __anext__(self) -> str:
+        event = await self._next_event()
+        if event is _END_OF_STREAM:
+            raise StopAsyncIteration
+        if _token_group(event) is not None:
+            event = await self._coalesce_tokens(event)
+        return json.dumps(event)
 
     async def asend(self, value: dict) -> None:
+        if self._closed:
+            raise StreamClosed("Stream is closed")
         await self._queue.put(value)
 
+    async def error(self, error: Exception) -> None:
+        detail = getattr(error, "detail", None) or str(error)
+        await self.asend({"event": "error", "data": {"message": detail}})
+
+    async def close(self) -> None:
+        """End the stream once the consumer has read the queued events."""
+        if not self._closed:
+            self._closed = True
+            await self._queue.put(_END_OF_STREAM)
+
+    def abort(self) -> None:
+        """Close the stream and drop queued events, the consumer is gone."""
+        self._closed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def run(self, producer: Awaitable[None]) -> None:
+        """Run the producer, report its failure on the stream and close it."""
+        try:
+            await producer
+        except StreamClosed:
+            pass
+        except Exception as e:
+            logger.error("Exception while streaming: %s", e)
+            if not self._closed:
+                await self.error(e)
+        finally:
+            await self.close()
+
+    async def _next_event(self) -> Any:
+        if self._pending is not None:
+            event, self._pending = self._pending, None
+            return event
+        return await self._queue.get()
+
+    async def _coalesce_tokens(self, event: dict) -> dict:
+        group = _token_group(event)
+        tokens = [event["data"]["token"]]
+        size = len(tokens[0])
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._coalesce_window
+        while size < self._max_frame_bytes:
+            try:
+                next_event = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    next_event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if next_event is _END_OF_STREAM or _token_group(next_event) != group:
+                self._pending = next_event
+                break
+            tokens.append(next_event["data"]["token"])
+            size += len(tokens[-1])
+        return {**event, "data": {**event["data"], "token": "".join(tokens)}}
+
+
+def _token_group(event: dict) -> Optional[tuple]:
+    """Events with the same group can be merged by joining their tokens."""
+    if event.get("event") != "new_token":
+        return None
+    data = event["data"]
+    if data.get("delimiter"):
+        return None
+    return tuple(sorted((key, value) for key, value in data.items() if key != "token"))
+
+
+class PageOrderedStream:
+    """Merges events of pages generated concurrently into a stream in page order.
+
+    The first unfinished page streams live, events of later pages are buffered
+    until every page before them has finished.
+    """
+
+    def __init__(self, stream: Stream, page_count: int):
+        self.stream = stream
+        self._buffers = [[] for _ in range(page_count)]
+        self._finished = [False] * page_count
+        self._current = 0
+        self._lock = asyncio.Lock()
+
+    def page(self, page_index: int) -> "PageStream":
+        return PageStream(self, page_index)
+
+    async def send(self, page_index: int, value: dict) -> None:
+        async with self._lock:
+            if page_index == self._current:
+                await self.stream.asend(value)
+            else:
+                self._buffers[page_index].append(value)
+
+    async def finish_page(self, page_index: int) -> None:
+        async with self._lock:
+            self._finished[page_index] = True
+            while self._current < len(self._finished) and self._finished[self._current]:
+                self._current += 1
+                if self._current < len(self._buffers):
+                    for value in self._buffers[self._current]:
+                        await self.stream.asend(value)
+                    self._buffers[self._current] = []
+
+
+class PageStream:
+    """Stream-like view of a single page of a PageOrderedStream."""
+
+    def __init__(self, ordered_stream: PageOrderedStream, page_index: int):
+        self.ordered_stream = ordered_stream
+        self.page_index = page_index
+
+    async def asend(self, value: dict) -> None:
+        await self.ordered_stream.send(self.page_index, value)
+
 
 class ExplicitAsyncCallbackHandler(AsyncCallbackHandler):
+    """Records metrics of the LLM calls it sees and logs them at debug level.
+
+    Each call's tokens are charged to the scheduler ticket of the request.
+    """
+
+    def __init__(self):
+        self._llm_calls: Dict[UUID, LLMCall] = {}
+
     async def on_llm_start(
         self,
         serialized: Dict[str, Any],
         prompts: List[str],
         **kwargs: Any,
     ) -> None:
-        print({"serialized": serialized, "prompts": prompts, **kwargs})
+        invocation_params = kwargs.get("invocation_params") or {}
+        model = invocation_params.get("model_name") or serialized.get("name", "unknown")
+        self._llm_calls[kwargs.get("run_id")] = LLMCall(model, prompts)
+        logger.debug("LLM start %s: %s", model, prompts)
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        llm_call = self._llm_calls.get(kwargs.get("run_id"))
+        if llm_call is not None:
+            llm_call.on_token()
 
     async def on_llm_end(
             self,
             response: LLMResult,
             **kwargs: Any
     ) -> None:
-        print({"response": response, **kwargs})
+        llm_call = self._llm_calls.pop(kwargs.get("run_id"), None)
+        if llm_call is not None:
+            record_llm_call(llm_call.model, llm_call.finish(response.llm_output))
+        logger.debug("LLM end: %s", response)
+
+    async def on_llm_error(self, error: Exception, **kwargs: Any) -> None:
+        self._llm_calls.pop(kwargs.get("run_id"), None)
 
     async def on_end(self) -> None:
         pass
 
 class NonFilteredAsyncCallbackHandler(ExplicitAsyncCallbackHandler):
     def __init__(self, stream: Stream):
+        super().__init__()
         self.stream = stream
+        self.created_at = time.perf_counter()
+        self._sent_token = False
 
     async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        await super().on_llm_new_token(token, **kwargs)
+        if not self._sent_token:
+            # From the start of the request to the first answer token it receives
+            self._sent_token = True
+            observe_stage("time_to_first_token", time.perf_counter() - self.created_at)
         await self.stream.asend({"event": f"new_token", "data": {"token": token}})
 
     async def on_end(self) -> None:
@@ -53,52 +237,118 @@ class NonFilteredAsyncCallbackHandler(ExplicitAsyncCallbackHandler):
         await self.stream.asend({"event": "end_stream"})
 
 
+class DelimiterScanner:
+    """Incremental scanner for text enclosed between pairs of delimiters.
+
+    Tokens are fed as they arrive and the scanner returns the enclosed text
+    as ``(kind, text, closed)`` segments, ``closed`` marking the end of a
+    block. Delimiters are located with ``str.find`` and only a tail that may
+    be the start of a delimiter split across tokens is held back, so each
+    token is scanned once.
+    """
+
+    def __init__(self, delimiters: Dict[str, str]):
+        # Maps each delimiter to the kind of block it encloses
+        self.delimiters = delimiters
+        self._first_chars = sorted({delimiter[0] for delimiter in delimiters})
+        self._carry = ""
+        self._open_delimiter: Optional[str] = None
+
+    def feed(self, token: str) -> List[Tuple[str, str, bool]]:
+        text = self._carry + token if self._carry else token
+        # Most tokens cannot contain any part of a delimiter
+        if not self._carry and not self._has_first_char(text, 0):
+            self._carry = ""
+            if self._open_delimiter is not None and text:
+                return [(self.delimiters[self._open_delimiter], text, False)]
+            return []
+
+        segments = []
+        position = 0
+        while True:
+            if self._open_delimiter is not None:
+                end = text.find(self._open_delimiter, position)
+                if end == -1:
+                    break
+                kind = self.delimiters[self._open_delimiter]
+                segments.append((kind, text[position:end], True))
+                position = end + len(self._open_delimiter)
+                self._open_delimiter = None
+            else:
+                start, delimiter = self._find_opening(text, position)
+                if delimiter is None:
+                    break
+                self._open_delimiter = delimiter
+                position = start + len(delimiter)
+
+        split = self._partial_delimiter_start(text, position)
+        if self._open_delimiter is not None and split > position:
+            kind = self.delimiters[self._open_delimiter]
+            segments.append((kind, text[position:split], False))
+        self._carry = text[split:]
+        return segments
+
+    def _has_first_char(self, text: str, position: int) -> bool:
+        if len(self._first_chars) == 1:
+            return text.find(self._first_chars[0], position) != -1
+        for char in self._first_chars:
+            if text.find(char, position) != -1:
+                return True
+        return False
+
+    def _find_opening(self, text: str, position: int) -> Tuple[int, Optional[str]]:
+        first, first_delimiter = -1, None
+        for delimiter in self.delimiters:
+            index = text.find(delimiter, position)
+            if index != -1 and (first == -1 or index < first):
+                first, first_delimiter = index, delimiter
+        return first, first_delimiter
+
+    def _partial_delimiter_start(self, text: str, position: int) -> int:
+        """Start of the longest suffix of text that may begin a delimiter."""
+        if self._open_delimiter is not None:
+            candidates = (self._open_delimiter,)
+        else:
+            candidates = self.delimiters
+        window_start = max(position, len(text) - max(map(len, candidates)) + 1)
+        if not self._has_first_char(text, window_start):
+            return len(text)
+        for start in range(window_start, len(text)):
+            suffix = text[start:]
+            for delimiter in candidates:
+                if delimiter.startswith(suffix):
+                    return start
+        return len(text)
+
+
 class QuestionFilteredAsyncCallbackHandler(ExplicitAsyncCallbackHandler):
-    def __init__(self, stream: Stream, delimiter: str = "###QQQ###"):
+    """Streams only the questions and context blocks of the LLM output.
+
+    Each token event carries the block ``type``, the last event of a block
+    has ``delimiter`` set.
+    """
+
+    def __init__(
+        self,
+        stream: Union[Stream, PageStream],
+        delimiters: Optional[Dict[str, str]] = None,
+    ):
+        super().__init__()
         self.stream = stream
-        self.delimiter = delimiter
-        self.delimiter_index = 0
-        self.send_tokens = False
-        self.token_buffer = ""
+        self.scanner = DelimiterScanner(
+            delimiters or {"###QQQ###": "question", "###CCC###": "context"}
+        )
 
     async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        for char in token:
-            # Check if the current character matches the delimiter at the current index
-            if char == self.delimiter[self.delimiter_index]:
-                self.delimiter_index += 1
-
-                # If the entire delimiter is matched
-                if self.delimiter_index == len(self.delimiter):
-                    self.delimiter_index = 0
-                    self.send_tokens = not self.send_tokens
-
-                    # If send_tokens is False after toggling and token_buffer has content, signal the end of a block.
-                    # Send the content with the delimiter flag set to True
-                    if not self.send_tokens:
-                        await self.stream.asend(
-                            {
-                                "event": "new_token",
-                                "data": {
-                                    "token": self.token_buffer,
-                                    "delimiter": True,
-                                },
-                            }
-                        )
-                        self.token_buffer = ""
+        await super().on_llm_new_token(token, **kwargs)
+        for kind, text, closed in self.scanner.feed(token):
+            if closed:
+                data = {"token": text, "delimiter": True, "type": kind}
+            elif text:
+                data = {"token": text, "type": kind}
             else:
-                # If send_tokens is True, add any partial delimiter and the current character to token_buffer
-                if self.send_tokens:
-                    self.token_buffer += self.delimiter[: self.delimiter_index]
-                    self.token_buffer += char
-                # Reset the delimiter_index since the character didn't match the delimiter
-                self.delimiter_index = 0
-
-        # If send_tokens is True and token_buffer has content, send the content
-        if self.send_tokens and self.token_buffer:
-            await self.stream.asend(
-                {"event": "new_token", "data": {"token": self.token_buffer}}
-            )
-            self.token_buffer = ""
+                continue
+            await self.stream.asend({"event": "new_token", "data": data})
 
     async def on_end(self) -> None:
         """Run when the LLM finishes generating."""
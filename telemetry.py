@@ -0,0 +1,135 @@
+"""Request stage timings, LLM call metrics and logging setup.
+
+Metrics are Prometheus histograms and counters served by ``/metrics``.
+Logging is level controlled by ``LOG_LEVEL``, and records below WARNING are
+kept with probability ``LOG_SAMPLE_RATE`` so verbose logs stay cheap under
+load.
+"""
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+from prometheus_client import Counter, Histogram
+
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    "papyrion_stage_seconds",
+    "Duration of request and ingestion stages",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+LLM_CALL_SECONDS = Histogram(
+    "papyrion_llm_call_seconds",
+    "Duration of LLM calls",
+    ["model"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120),
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "papyrion_llm_time_to_first_token_seconds",
+    "Time from the start of a streaming LLM call to its first token",
+    ["model"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10),
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "papyrion_llm_tokens_per_second",
+    "Completion tokens per second of streaming LLM calls, after the first token",
+    ["model"],
+    buckets=(5, 10, 20, 30, 40, 50, 75, 100, 150, 200),
+)
+LLM_TOKENS = Counter(
+    "papyrion_llm_tokens_total",
+    "Tokens sent to and generated by LLMs",
+    ["model", "kind"],
+)
+
+
+class SampleFilter(logging.Filter):
+    """Keeps records below WARNING with probability ``rate``."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def configure_logging() -> None:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(SampleFilter(float(os.environ.get("LOG_SAMPLE_RATE", 1.0))))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def span(stage: str):
+    """Time the enclosed block as ``stage``, also around awaits."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        logger.debug("%s took %.3fs", stage, elapsed)
+
+
+class LLMCall:
+    """Times one LLM call and counts its tokens when it ends."""
+
+    def __init__(self, model: str, prompts: List[str]):
+        self.model = model
+        self.prompts = prompts
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.streamed_tokens = 0
+
+    def on_token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            LLM_TIME_TO_FIRST_TOKEN.labels(self.model).observe(
+                self.first_token_at - self.started_at
+            )
+        self.streamed_tokens += 1
+
+    def finish(self, llm_output: Optional[dict]) -> int:
+        """Record the call's metrics and return the tokens it used."""
+        ended_at = time.perf_counter()
+        LLM_CALL_SECONDS.labels(self.model).observe(ended_at - self.started_at)
+
+        usage = (llm_output or {}).get("token_usage")
+        if usage:
+            prompt_tokens = usage.get("prompt_tokens", 0)
+            completion_tokens = usage.get("completion_tokens", 0)
+        else:
+            # Streaming responses carry no usage, count what was sent and received
+            prompt_tokens = sum(count_tokens(prompt) for prompt in self.prompts)
+            completion_tokens = self.streamed_tokens
+        LLM_TOKENS.labels(self.model, "prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(self.model, "completion").inc(completion_tokens)
+
+        if self.first_token_at is not None and self.streamed_tokens > 1:
+            generation_seconds = ended_at - self.first_token_at
+            if generation_seconds > 0:
+                LLM_TOKENS_PER_SECOND.labels(self.model).observe(
+                    (self.streamed_tokens - 1) / generation_seconds
+                )
+        logger.debug(
+            "%s call took %.3fs, %d prompt and %d completion tokens",
+            self.model,
+            ended_at - self.started_at,
+            prompt_tokens,
+            completion_tokens,
+        )
+        return prompt_tokens + completion_tokens
@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+# Caches and indexes created at import time go to a scratch directory
+_workdir = tempfile.mkdtemp(prefix="papyrion-tests-")
+for key, path in {
+    "DOCUMENT_INDEX_PATH": "documents.sqlite3",
+    "EMBEDDING_CACHE_PATH": "embeddings.sqlite3",
+    "FILE_CACHE_PATH": "files",
+    "QUESTION_CACHE_PATH": "questions.sqlite3",
+    "STORAGE_PATH": "objects",
+    "TRANSLATION_CACHE_PATH": "translations.sqlite3",
+}.items():
+    os.environ.setdefault(key, os.path.join(_workdir, path))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
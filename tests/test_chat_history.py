@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+from langchain import LLMChain, PromptTemplate
+from langchain.callbacks.base import AsyncCallbackHandler
+
+import utils
+from benchmarks.fakes import ApproximateEncoding, FakeChatModel
+from material.chat_history import ChatHistoryCompressor
+from material.retrieval_cache import TTLCache
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    encoding = ApproximateEncoding()
+    monkeypatch.setattr(utils, "_get_encoding", lambda: encoding)
+
+
+class RecordingHandler(AsyncCallbackHandler):
+    def __init__(self):
+        self.ended = 0
+
+    async def on_llm_end(self, response, **kwargs):
+        self.ended += 1
+
+
+def test_summary_calls_reach_the_request_callbacks():
+    llm = FakeChatModel(
+        model_name="gpt-3.5-turbo", latency=0, response="The user asked about sorting."
+    )
+    chain = LLMChain(llm=llm, prompt=PromptTemplate.from_template("{summary}\n{new_lines}"))
+    compressor = ChatHistoryCompressor(
+        chain, token_budget=50, summary_tokens=10, cache=TTLCache(10, 60)
+    )
+    handler = RecordingHandler()
+    history = asyncio.run(
+        compressor.acompress(["how does merge sort work " * 6] * 6, callbacks=[handler])
+    )
+    assert history.startswith("Summary of the earlier conversation: The user asked")
+    assert handler.ended == 1
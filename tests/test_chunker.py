@@ -0,0 +1,89 @@
+import pytest
+from langchain.schema import Document
+
+import utils
+from benchmarks.fakes import ApproximateEncoding
+from material.chunker import TokenChunker
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    encoding = ApproximateEncoding()
+    monkeypatch.setattr(utils, "_get_encoding", lambda: encoding)
+
+
+def _pages(texts, source="doc"):
+    return [
+        Document(page_content=text, metadata={"source": source, "page": page})
+        for page, text in enumerate(texts)
+    ]
+
+
+def _text(chunks):
+    return "\n".join(chunk.page_content for chunk in chunks)
+
+
+def test_slides_keep_their_numbered_content():
+    pages = _pages(
+        f"Lecture 4: Sorting\nMerge sort splits the array into {n} halves\nSlide {n}"
+        for n in range(1, 11)
+    )
+    text = _text(TokenChunker().split_documents(pages))
+    for n in range(1, 11):
+        assert f"Merge sort splits the array into {n} halves" in text
+    assert "Slide" not in text
+    assert "Lecture 4" not in text
+
+
+def test_exam_questions_are_kept():
+    pages = _pages(
+        f"Question {n}\nExercise {n}\nProve that the sum of the first {n} odd numbers is a square.\n{n}"
+        for n in range(1, 9)
+    )
+    chunks = TokenChunker().split_documents(pages)
+    assert len(chunks) == 8
+    for n, chunk in enumerate(chunks, 1):
+        assert chunk.page_content.startswith(f"Question {n}\nExercise {n}\n")
+        assert not chunk.page_content.endswith(f"\n{n}")
+
+
+def test_a_repeated_line_that_is_most_of_a_page_is_kept():
+    pages = _pages(["Thank you"] + ["Thank you\nSome text on this slide"] * 5)
+    text = _text(TokenChunker().split_documents(pages))
+    assert text.split("\n")[0] == "Thank you"
+    assert text.count("Thank you") == 1
+
+
+def test_boilerplate_is_counted_over_the_whole_source():
+    texts = [f"Running header\nBody of page {n}" for n in range(10)]
+    texts += [f"Body of page {n}\nMore body of page {n}" for n in range(10, 40)]
+    pages = _pages(texts)
+    chunker = TokenChunker()
+    boilerplate = chunker.find_boilerplate(pages)
+    # The first ten pages alone would make the header boilerplate
+    assert chunker.find_boilerplate(pages[:10])
+    assert not boilerplate
+    assert "Running header" in _text(chunker.split_documents(pages[:10], boilerplate))
+
+
+def test_a_heading_starts_the_chunk_of_its_content():
+    # Each paragraph fits in a chunk, but not together with its heading
+    paragraph = " ".join(["word"] * 39)
+    pages = _pages(["SECTION ONE\n\n" + paragraph + "\n\nSECTION TWO\n\n" + paragraph])
+    chunks = TokenChunker(chunk_tokens=40).split_documents(pages)
+    assert not any(chunk.page_content in ("SECTION ONE", "SECTION TWO") for chunk in chunks)
+    assert [chunk.page_content[:17] for chunk in chunks if "SECTION" in chunk.page_content] == [
+        "SECTION ONE\n\nword",
+        "SECTION TWO\n\nword",
+    ]
+
+
+def test_chunks_with_a_carried_heading_stay_within_the_limit():
+    paragraph = " ".join(["word"] * 100)
+    pages = _pages(["INTRODUCTION\n\n" + paragraph + "\n\nSECTION TWO\n\n" + paragraph])
+    chunker = TokenChunker(chunk_tokens=50, overlap_tokens=20)
+    chunks = chunker.split_documents(pages)
+    counts = utils.count_tokens_batch([chunk.page_content for chunk in chunks])
+    assert max(counts) <= 50
+    assert not any(chunk.page_content in ("INTRODUCTION", "SECTION TWO") for chunk in chunks)
+    assert any(chunk.page_content.startswith("SECTION TWO\n\nword") for chunk in chunks)
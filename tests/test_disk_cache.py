@@ -0,0 +1,11 @@
+from disk_cache import DiskCache
+
+
+def test_the_database_is_created_on_first_use(tmp_path):
+    path = tmp_path / "cache" / "entries.sqlite3"
+    cache = DiskCache(str(path))
+    assert not path.parent.exists()
+    assert cache.get("key") is None
+    cache.set("key", b"value")
+    assert path.exists()
+    assert DiskCache(str(path)).stats()["bytes"] == len(b"value")
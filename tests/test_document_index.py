@@ -0,0 +1,36 @@
+import pytest
+
+from storage import DocumentIndex, InvalidCursor
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = DocumentIndex(str(tmp_path / "index.sqlite3"))
+    for number in range(5):
+        index.add("user", f"doc{number}.pdf", f"hash{number}", f"hash{number}.pdf", 1)
+    return index
+
+
+def _ids(documents):
+    return [document["document_id"] for document in documents]
+
+
+def test_pages_cover_every_document_once(index):
+    first, cursor = index.list("user", limit=2)
+    second, cursor = index.list("user", limit=2, cursor=cursor)
+    third, cursor = index.list("user", limit=2, cursor=cursor)
+    assert _ids(first + second + third) == [f"doc{number}.pdf" for number in range(5)]
+    assert cursor is None
+
+
+def test_deleting_the_last_document_of_a_page_keeps_the_next_page(index):
+    first, cursor = index.list("user", limit=2)
+    index.delete("user", first[-1]["document_id"])
+    second, _ = index.list("user", limit=2, cursor=cursor)
+    assert _ids(second) == ["doc2.pdf", "doc3.pdf"]
+
+
+@pytest.mark.parametrize("cursor", ["doc1.pdf", "bm90IGpzb24=", "WyJhIiwgImIiXQ==", "%%%"])
+def test_invalid_cursors_are_rejected(index, cursor):
+    with pytest.raises(InvalidCursor):
+        index.list("user", limit=2, cursor=cursor)
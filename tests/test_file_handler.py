@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from file_handler import FileHandler, InvalidUpload, MultipartUpload
+from storage import DocumentIndex, FileCache, LocalStorage
+
+
+class SlowDeleteStorage(LocalStorage):
+    """Deletes objects after a delay, leaving room for a concurrent upload."""
+
+    async def delete(self, key: str) -> None:
+        await asyncio.sleep(0.05)
+        await super().delete(key)
+
+
+def _handler(tmp_path) -> FileHandler:
+    return FileHandler(
+        storage=SlowDeleteStorage(str(tmp_path / "objects")),
+        index=DocumentIndex(str(tmp_path / "documents.sqlite3")),
+        cache=FileCache(str(tmp_path / "cache")),
+    )
+
+
+async def _chunks(*pieces: bytes):
+    for piece in pieces:
+        yield piece
+
+
+def test_an_upload_during_the_release_of_its_object_keeps_it(tmp_path):
+    async def run():
+        handler = _handler(tmp_path)
+        first = await handler.save_file("notes.pdf", _chunks(b"content"), "first")
+        # The first user deletes the document while the second uploads the same content
+        _, second = await asyncio.gather(
+            handler.delete_file("first", first.document_id),
+            handler.save_file("notes.pdf", _chunks(b"content"), "second"),
+        )
+        assert await handler.storage.exists(second.object_key)
+        assert await handler.get_file("second", second.document_id)
+
+    asyncio.run(run())
+
+
+def _multipart(*parts) -> bytes:
+    body = b""
+    for name, filename, content in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += f"--boundary\r\nContent-Disposition: {disposition}\r\n\r\n".encode()
+        body += content + b"\r\n"
+    return body + b"--boundary--\r\n"
+
+
+def _split(body: bytes, size: int):
+    return _chunks(*(body[start : start + size] for start in range(0, len(body), size)))
+
+
+HEADERS = {"content-type": "multipart/form-data; boundary=boundary"}
+
+
+@pytest.mark.parametrize("piece_size", [1, 7, 1 << 16])
+def test_the_file_field_is_streamed_from_the_body(piece_size):
+    async def run():
+        content = bytes(range(256)) * 40
+        body = _multipart(
+            ("note", None, b"before"), ("file", "notes.pdf", content), ("tail", None, b"after")
+        )
+        upload = MultipartUpload(HEADERS, _split(body, piece_size))
+        assert await upload.open() == "notes.pdf"
+        assert b"".join([chunk async for chunk in upload.chunks()]) == content
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "headers, body",
+    [
+        ({"content-type": "application/json"}, b"{}"),
+        (HEADERS, _multipart(("note", None, b"no file"))),
+        (HEADERS, b"--boundary\r\nContent-Disposition: form-data"),
+    ],
+)
+def test_bodies_without_a_file_are_invalid(headers, body):
+    async def run():
+        with pytest.raises(InvalidUpload):
+            await MultipartUpload(headers, _chunks(body)).open()
+
+    asyncio.run(run())
@@ -0,0 +1,76 @@
+import pytest
+from langchain.schema import Document
+
+import utils
+from benchmarks.fakes import ApproximateEncoding
+from material.hybrid_retriever import HybridRetriever
+from material.keyword_index import KeywordIndex
+from storage import DocumentIndex
+
+
+@pytest.fixture(autouse=True)
+def encoding(monkeypatch):
+    encoding = ApproximateEncoding()
+    monkeypatch.setattr(utils, "_get_encoding", lambda: encoding)
+
+
+class StubIndex:
+    """Returns fixed vector matches, as (id, cosine similarity, text)."""
+
+    def __init__(self, matches):
+        self.matches = matches
+
+    def query(self, **kwargs):
+        return {
+            "matches": [
+                {"id": chunk_id, "score": score, "metadata": {"text": text}}
+                for chunk_id, score, text in self.matches
+            ]
+        }
+
+
+@pytest.fixture
+def indexes(tmp_path):
+    path = str(tmp_path / "documents.sqlite3")
+    document_index = DocumentIndex(path)
+    keyword_index = KeywordIndex(path)
+    for namespace in ("user", "legacy"):
+        keyword_index.add(namespace, [("k1", Document(page_content="merge sort splits arrays"))])
+    return document_index, keyword_index
+
+
+def _retriever(indexes, matches, namespace):
+    document_index, keyword_index = indexes
+    return HybridRetriever(
+        StubIndex(matches),
+        lambda text: [1.0, 0.0],
+        # Each test asks a different namespace, the retrieval cache is process-wide
+        namespace,
+        keyword_index,
+        document_index,
+    )
+
+
+def _texts(docs):
+    return [doc.page_content for doc in docs]
+
+
+def test_vector_matches_far_below_the_best_are_dropped(indexes):
+    matches = [("v1", 0.86, "close match"), ("v2", 0.8, "near match"), ("v3", 0.72, "unrelated")]
+    docs = _retriever(indexes, matches, "gap").get_relevant_documents("quick sort")
+    assert _texts(docs) == ["close match", "near match"]
+
+
+def test_keyword_matches_are_fused(indexes):
+    retriever = _retriever(indexes, [("v1", 0.85, "close match")], "user")
+    assert _texts(retriever.get_relevant_documents("merge sort")) == [
+        "close match",
+        "merge sort splits arrays",
+    ]
+
+
+def test_users_with_legacy_documents_are_searched_by_vector_only(indexes):
+    document_index, _ = indexes
+    document_index.add("legacy", "old.pdf", "hash", "hash.pdf", 1, legacy=True)
+    retriever = _retriever(indexes, [("v1", 0.85, "close match")], "legacy")
+    assert _texts(retriever.get_relevant_documents("merge sort")) == ["close match"]
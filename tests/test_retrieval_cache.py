@@ -0,0 +1,22 @@
+from langchain.schema import Document
+
+from material.retrieval_cache import RetrievalCache
+
+
+def test_results_of_a_query_overlapping_an_invalidation_are_not_cached():
+    cache = RetrievalCache(max_entries=10, ttl=60)
+    docs, generation = cache.get("user", "query", 4)
+    assert docs is None
+    # A chunk is deleted while the query runs
+    cache.invalidate("user")
+    cache.set("user", "query", 4, [Document(page_content="deleted chunk")], generation)
+    assert cache.get("user", "query", 4)[0] is None
+
+
+def test_results_are_cached_until_invalidated():
+    cache = RetrievalCache(max_entries=10, ttl=60)
+    _, generation = cache.get("user", "query", 4)
+    cache.set("user", "query", 4, [Document(page_content="chunk")], generation)
+    assert [doc.page_content for doc in cache.get("user", "query", 4)[0]] == ["chunk"]
+    cache.invalidate("user")
+    assert cache.get("user", "query", 4)[0] is None
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from scheduler import ModelLimits, Scheduler, record_llm_call
+
+
+def _scheduler(**limits) -> Scheduler:
+    values = {"requests_per_minute": 60, "tokens_per_minute": 6000, "max_concurrent": 4}
+    values.update(limits)
+    return Scheduler({"model": ModelLimits(**values)}, 600, 60000)
+
+
+def test_calls_beyond_the_estimate_are_charged():
+    async def run():
+        scheduler = _scheduler()
+        async with scheduler.enqueue("user", "model", 1000):
+            for _ in range(3):
+                record_llm_call("model", 1500)
+        queue = scheduler._queues["model"]
+        # 4500 tokens and 3 requests used, whatever the estimate was
+        assert queue.tokens.available == pytest.approx(1500, abs=10)
+        assert queue.requests.available == pytest.approx(57, abs=0.5)
+
+    asyncio.run(run())
+
+
+def test_unused_estimate_is_refunded():
+    async def run():
+        scheduler = _scheduler()
+        async with scheduler.enqueue("user", "model", 4000):
+            record_llm_call("model", 500)
+        queue = scheduler._queues["model"]
+        assert queue.tokens.available == pytest.approx(5500, abs=10)
+        assert queue.requests.available == pytest.approx(59, abs=0.5)
+
+    asyncio.run(run())
+
+
+def test_calls_outside_a_ticket_are_not_charged():
+    async def run():
+        scheduler = _scheduler()
+        async with scheduler.enqueue("user", "model", 1000):
+            pass
+        record_llm_call("model", 1000)
+        assert scheduler._queues["model"].tokens.available == pytest.approx(6000, abs=10)
+
+    asyncio.run(run())
+
+
+def test_tickets_hold_their_slots():
+    async def run():
+        scheduler = _scheduler()
+        first = scheduler.enqueue("user", "model", 100, slots=3)
+        second = scheduler.enqueue("other", "model", 100, slots=2)
+        async with first:
+            assert not second.granted
+            assert scheduler.stats()["model"]["active"] == 3
+        assert second.granted
+        scheduler.release(second)
+
+    asyncio.run(run())
+
+
+def test_a_wide_ticket_is_granted_under_narrow_load():
+    async def run():
+        scheduler = _scheduler(requests_per_minute=6000, tokens_per_minute=600000)
+        narrow = [scheduler.enqueue(f"user{n}", "model", 10) for n in range(4)]
+        wide = scheduler.enqueue("wide", "model", 10, slots=4)
+        # New narrow tickets keep arriving as others end
+        for n in range(8):
+            scheduler.release(narrow.pop(0))
+            narrow.append(scheduler.enqueue(f"user{n + 4}", "model", 10))
+            if wide.granted:
+                break
+        # It waited for the slots to free up, nothing took them meanwhile
+        assert wide.granted
+        assert scheduler.stats()["model"]["active"] == 4
+        scheduler.release(wide)
+        assert all(ticket.granted for ticket in narrow)
+
+    asyncio.run(run())
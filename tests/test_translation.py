@@ -0,0 +1,88 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from disk_cache import DiskCache
+from text_extractor.translation import (
+    MAX_CHARS_PER_REQUEST,
+    MAX_ITEMS_PER_REQUEST,
+    Translator,
+)
+
+FRENCH = (
+    "La dérivée d'une fonction mesure la vitesse à laquelle elle change. "
+    "Nous étudions ici les limites, les intégrales et les séries de fonctions."
+)
+ENGLISH = (
+    "The derivative of a function measures how fast it changes. "
+    "Here we study limits, integrals and series of functions."
+)
+
+
+class StubClient:
+    """Translator client that tags each text and records the requests it got."""
+
+    def __init__(self, max_delay=0.0):
+        self.max_delay = max_delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def translate(self, content, to, from_parameter):
+        texts = [item.text for item in content]
+        with self._lock:
+            self.requests.append(texts)
+        time.sleep(random.uniform(0, self.max_delay))
+        return [
+            SimpleNamespace(translations=[SimpleNamespace(text=_translation(text))])
+            for text in texts
+        ]
+
+
+def _translation(text):
+    return text.upper()
+
+
+def _long_text(chars):
+    paragraphs = []
+    while sum(len(paragraph) + 2 for paragraph in paragraphs) < chars:
+        paragraphs.append(FRENCH * 20)
+    return "\n\n".join(paragraphs)
+
+
+def test_requests_stay_within_service_limits():
+    client = StubClient()
+    texts = [_long_text(70000), FRENCH] * 2 + [f"{FRENCH} {index}" for index in range(1500)]
+
+    results = Translator(client=client, max_concurrency=4).translate(texts)
+
+    assert results == [_translation(text) for text in texts]
+    assert all(len(request) <= MAX_ITEMS_PER_REQUEST for request in client.requests)
+    assert all(sum(map(len, request)) <= MAX_CHARS_PER_REQUEST for request in client.requests)
+
+
+def test_results_keep_input_order():
+    client = StubClient(max_delay=0.01)
+    texts = [
+        f"{FRENCH} {index}" if index % 3 else _long_text(60000)
+        for index in range(30)
+    ] + [ENGLISH]
+
+    results, languages = Translator(client=client, max_concurrency=8).translate_and_detect(texts)
+
+    assert results[:-1] == [_translation(text) for text in texts[:-1]]
+    assert results[-1] == ENGLISH
+    assert languages == ["fr"] * 30 + ["en"]
+
+
+def test_translations_are_cached(tmp_path):
+    cache = DiskCache(str(tmp_path / "translations.sqlite3"))
+    texts = [FRENCH, ENGLISH]
+    Translator(client=StubClient(), cache=cache).translate(texts)
+
+    client = StubClient()
+    results, languages = Translator(client=client, cache=cache).translate_and_detect(texts)
+
+    assert client.requests == []
+    assert results == [_translation(FRENCH), ENGLISH]
+    assert languages == ["fr", "en"]
@@ -0,0 +1,19 @@
+import base64
+
+import pytest
+
+import utils
+
+
+def test_the_encoding_is_built_from_its_ranks_file(tmp_path):
+    path = tmp_path / "ranks.tiktoken"
+    # Byte-level ranks, enough to encode any text one byte per token
+    path.write_text("".join(f"{base64.b64encode(bytes([b])).decode()} {b}\n" for b in range(256)))
+    encoding = utils.load_encoding(str(path))
+    assert encoding.encode("hi") == [104, 105]
+    assert encoding.decode([104, 105]) == "hi"
+
+
+def test_a_missing_encoding_is_not_downloaded(tmp_path):
+    with pytest.raises(RuntimeError, match="python startup.py"):
+        utils.load_encoding(str(tmp_path / "missing.tiktoken"))
@@ -0,0 +1,35 @@
+from vector_index import LocalVectorIndex
+
+
+def _upsert(index, namespace, vector_id):
+    index.upsert([(vector_id, [1.0, 0.0], {"text": vector_id})], namespace=namespace)
+
+
+def test_least_recently_used_namespaces_are_closed_and_reopened(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), max_open_namespaces=2)
+    for user in ("a", "b", "c"):
+        _upsert(index, user, f"{user}-1")
+    assert list(index._namespaces) == ["b", "c"]
+
+    matches = index.query([1.0, 0.0], top_k=1, namespace="a", include_metadata=True)["matches"]
+    assert matches[0]["metadata"] == {"text": "a-1"}
+    assert list(index._namespaces) == ["c", "a"]
+
+
+def test_namespaces_in_use_are_not_closed(tmp_path):
+    index = LocalVectorIndex(str(tmp_path), max_open_namespaces=1)
+    with index._namespace("a") as namespace_store:
+        _upsert(index, "b", "b-1")
+        # The more recently used namespace is closed instead
+        assert list(index._namespaces) == ["a"]
+        namespace_store.upsert([("a-1", [0.0, 1.0], {})])
+    assert index.fetch(["a-1"], namespace="a")["vectors"]["a-1"]["values"] == [0.0, 1.0]
+    assert index.fetch(["b-1"], namespace="b")["vectors"]["b-1"]["values"] == [1.0, 0.0]
+
+
+def test_close_releases_every_namespace(tmp_path):
+    index = LocalVectorIndex(str(tmp_path))
+    _upsert(index, "a", "a-1")
+    index.close()
+    assert not index._namespaces
+    assert index.fetch(["a-1"], namespace="a")["vectors"]["a-1"]["metadata"] == {"text": "a-1"}
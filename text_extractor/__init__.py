@@ -1 +1 @@
-from text_extractor.extractors import extract_docs
+from text_extractor.extractors import extract_docs, iter_docs, count_pages
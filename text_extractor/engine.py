@@ -0,0 +1,85 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional
+
+from langchain.schema import Document
+
+
+def _load_docs(file_path: str, loader: type) -> List[Document]:
+    return loader(file_path).load()
+
+
+def _load_pdf_pages(file_path: str, start: int, stop: int) -> List[Document]:
+    import pypdf
+
+    # Same output as PyPDFLoader, restricted to a page range
+    pdf_reader = pypdf.PdfReader(file_path)
+    return [
+        Document(
+            page_content=pdf_reader.pages[page_number].extract_text(),
+            metadata={"source": file_path, "page": page_number},
+        )
+        for page_number in range(start, stop)
+    ]
+
+
+def count_pdf_pages(file_path: str) -> int:
+    import pypdf
+
+    return len(pypdf.PdfReader(file_path).pages)
+
+
+class ExtractionEngine:
+    """Runs document loaders in a process pool and yields pages in order.
+
+    PDFs are split into page ranges that are parsed in parallel, other file
+    types are loaded whole on a worker process. At most ``max_in_flight``
+    tasks are outstanding, so pages are handed to the caller while later
+    pages are still being parsed and memory stays bounded for large files.
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        pdf_pages_per_task: int = 10,
+        max_in_flight: Optional[int] = None,
+    ):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pdf_pages_per_task = pdf_pages_per_task
+        self.max_in_flight = max_in_flight or self.max_workers * 2
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def load_docs(self, file_path: str, loader: type) -> List[Document]:
+        return self.executor.submit(_load_docs, file_path, loader).result()
+
+    def iter_pdf_pages(self, file_path: str) -> Iterator[Document]:
+        page_count = count_pdf_pages(file_path)
+        page_ranges = deque(
+            (start, min(start + self.pdf_pages_per_task, page_count))
+            for start in range(0, page_count, self.pdf_pages_per_task)
+        )
+        pending = deque()
+        try:
+            while page_ranges or pending:
+                while page_ranges and len(pending) < self.max_in_flight:
+                    start, stop = page_ranges.popleft()
+                    pending.append(
+                        self.executor.submit(_load_pdf_pages, file_path, start, stop)
+                    )
+                yield from pending.popleft().result()
+        finally:
+            # Consumer stopped early or a page range failed
+            for future in pending:
+                future.cancel()
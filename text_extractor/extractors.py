@@ -1,32 +1,81 @@
+import functools
+import importlib
+import itertools
 import re
-import nltk
-import ssl
 import os
 
-from langchain.document_loaders import (
-    UnstructuredWordDocumentLoader,
-    TextLoader,
-    CSVLoader,
-    PyPDFLoader,
-    UnstructuredPowerPointLoader,
+from disk_cache import DiskCache
+from startup import ensure_nltk_resources, startup_timer
+from telemetry import span
+from text_extractor.engine import ExtractionEngine, count_pdf_pages
+from text_extractor.translation import Translator
+
+PDF_LOADER = "langchain.document_loaders.PyPDFLoader"
+# Loaders whose unstructured partitioning needs the NLTK data
+NLTK_LOADERS = {
+    "langchain.document_loaders.UnstructuredWordDocumentLoader",
+    "langchain.document_loaders.UnstructuredPowerPointLoader",
+}
+
+
+extraction_engine = ExtractionEngine(
+    max_workers=int(os.environ.get("EXTRACTION_WORKERS", 0)) or None
+)
+translator = Translator(
+    cache=DiskCache(
+        os.environ.get("TRANSLATION_CACHE_PATH", "cache/translations.sqlite3"),
+        max_bytes=int(os.environ.get("TRANSLATION_CACHE_MAX_BYTES", 256 * 1024**2)),
+    ),
+    max_concurrency=int(os.environ.get("TRANSLATION_CONCURRENCY", 4)),
 )
-from langdetect import detect
-from azure.ai.translation.text.models import InputTextItem
-from azure.ai.translation.text import TextTranslationClient, TranslatorCredential
+# Pages translated together, more pages means fewer translation requests
+TRANSLATION_WINDOW_PAGES = int(os.environ.get("TRANSLATION_WINDOW_PAGES", 50))
 
 
-nltk_resources = ["punkt", "averaged_perceptron_tagger"]
-for resource in nltk_resources:
-    try:
-        _create_unverified_https_context = ssl._create_unverified_context
-    except AttributeError:
-        pass
+def extract_docs(file_path, source=None):
+    return list(iter_docs(file_path, source))
+
+
+def iter_docs(file_path, source=None):
+    """Yield the file's pages as they are parsed, translated to English.
+
+    ``source`` is the document name recorded in the pages' metadata, by
+    default the file name.
+    """
+    source = source or os.path.basename(file_path)
+    loader = _get_loader(file_path)
+    if loader == PDF_LOADER:
+        file_docs = extraction_engine.iter_pdf_pages(file_path)
     else:
-        ssl._create_default_https_context = _create_unverified_https_context
-    nltk.download(resource)
+        file_docs = extraction_engine.load_docs(file_path, _import_loader(loader))
+
+    file_docs = iter(file_docs)
+    while True:
+        with span("extraction"):
+            window = list(itertools.islice(file_docs, TRANSLATION_WINDOW_PAGES))
+        if not window:
+            break
+        yield from _format_docs(window, source)
+
+
+def count_pages(file_path):
+    """Page count when it is known before extraction, otherwise None."""
+    if _get_loader(file_path) == PDF_LOADER:
+        return count_pdf_pages(file_path)
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _import_loader(loader):
+    """Import a loader class the first time its file type is seen."""
+    if loader in NLTK_LOADERS:
+        ensure_nltk_resources()
+    module_name, class_name = loader.rsplit(".", 1)
+    with startup_timer.phase(f"import {class_name}"):
+        return getattr(importlib.import_module(module_name), class_name)
 
 
-def extract_docs(file_path):
+def _get_loader(file_path):
     file_extension = file_path.rsplit(".", 1)[1].lower()
     if file_extension == "markdown":
         # use markdown loader
@@ -36,13 +85,13 @@ def extract_docs(file_path):
         pass
     elif file_extension == "doc" or file_extension == "docx":
         # use Microsoft Word loader
-        return _extract_docs(file_path, UnstructuredWordDocumentLoader)
+        return "langchain.document_loaders.UnstructuredWordDocumentLoader"
     elif file_extension == "txt":
         # use plain text loader
-        return _extract_docs(file_path, TextLoader)
+        return "langchain.document_loaders.TextLoader"
     elif file_extension == "csv":
         # use CSV loader
-        return _extract_docs(file_path, TextLoader)
+        return "langchain.document_loaders.TextLoader"
     elif file_extension == "json":
         # use JSON loader
         pass
@@ -51,55 +100,31 @@ def extract_docs(file_path):
         pass
     elif file_extension == "pdf":
         # use PDF loader
-        return _extract_docs(file_path, PyPDFLoader)
+        return PDF_LOADER
     elif file_extension == "ppt" or file_extension == "pptx":
         # use Microsoft PowerPoint loader
-        return _extract_docs(file_path, UnstructuredPowerPointLoader)
+        return "langchain.document_loaders.UnstructuredPowerPointLoader"
 
     # handle unsupported file type
     raise NotImplementedError("This file type is not yet supported")
 
 
-def _extract_docs(file_path, loader, **loader_kwargs):
-    file_docs = loader(file_path, **loader_kwargs).load()
+def _format_docs(file_docs, source):
+    docs = []
     for file_doc in file_docs:
-        raw_text = file_doc.page_content
-        formatted_text = re.sub("\n{2,}", "\n\n", raw_text)
+        formatted_text = re.sub("\n{2,}", "\n\n", file_doc.page_content)
         if not formatted_text:
             continue
-        try:
-            english_text = _get_english_text(formatted_text)
-        except Exception as e:
-            print(f"Exception in translation: {e}")
-            english_text = formatted_text
-
-        file_doc.page_content = english_text
-        file_doc.metadata["source"] = os.path.basename(file_doc.metadata["source"])
-    return file_docs
-
-
-def _get_english_text(text, target_language="en"):
-    source_language = detect(text)
-    if source_language == target_language:
-        return text
-
-    # Set up the Azure Translate client
-    api_key = os.environ["TRANSLATOR_TEXT_SUBSCRIPTION_KEY"]
-    api_region = os.environ["TRANSLATOR_TEXT_REGION"]
-    api_endpoint = os.environ["TRANSLATOR_TEXT_ENDPOINT"]
-
-    text_translator = TextTranslationClient(
-        endpoint=api_endpoint,
-        credential=TranslatorCredential(api_key, api_region)
-    )
-
-    input_text_elements = [InputTextItem(text=text)]
-
-    # Translate the text to English
-    response = text_translator.translate(
-        content=input_text_elements,
-        to=[target_language],
-        from_parameter=source_language
-    )
-
-    return response[0].translations[0].text
+        file_doc.page_content = formatted_text
+        file_doc.metadata["source"] = source
+        docs.append(file_doc)
+
+    with span("translation"):
+        english_texts, languages = translator.translate_and_detect(
+            [doc.page_content for doc in docs]
+        )
+    for doc, english_text, language in zip(docs, english_texts, languages):
+        doc.page_content = english_text
+        if language:
+            doc.metadata["language"] = language
+    return docs
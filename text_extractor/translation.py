@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from langdetect import DetectorFactory, detect
+
+from disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+# Make detection deterministic so cached translations are reused
+DetectorFactory.seed = 0
+
+# Azure Translator limits per translate request
+MAX_ITEMS_PER_REQUEST = 1000
+MAX_CHARS_PER_REQUEST = 50000
+# Characters used for language detection, enough to identify a page
+DETECTION_SAMPLE_CHARS = 2000
+# Bumped when the format of cached translations changes
+CACHE_VERSION = 2
+
+
+class Translator:
+    """Translates texts to the target language in batched, concurrent requests.
+
+    Texts already in the target language are detected locally and skipped.
+    The rest are grouped by source language, packed into as few requests as
+    the service limits allow, and the translations are cached by content hash.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        cache: Optional[DiskCache] = None,
+        target_language: str = "en",
+        max_concurrency: int = 4,
+    ):
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.cache = cache
+        self.target_language = target_language
+        self.max_concurrency = max_concurrency
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from azure.ai.translation.text import (
+                    TextTranslationClient,
+                    TranslatorCredential,
+                )
+
+                self._client = TextTranslationClient(
+                    endpoint=os.environ["TRANSLATOR_TEXT_ENDPOINT"],
+                    credential=TranslatorCredential(
+                        os.environ["TRANSLATOR_TEXT_SUBSCRIPTION_KEY"],
+                        os.environ["TRANSLATOR_TEXT_REGION"],
+                    ),
+                )
+            return self._client
+
+    def translate(self, texts: List[str]) -> List[str]:
+        """Translate texts, a text that fails to translate is returned as is."""
+        return self.translate_and_detect(texts)[0]
+
+    def translate_and_detect(
+        self, texts: List[str]
+    ) -> Tuple[List[str], List[Optional[str]]]:
+        """Translate texts and return their detected source languages too."""
+        results = list(texts)
+        languages: List[Optional[str]] = [None] * len(texts)
+        keys = [self._key(text) for text in texts]
+        cached = self.cache.get_many(keys) if self.cache else {}
+
+        by_language = defaultdict(list)
+        for index, (key, text) in enumerate(zip(keys, texts)):
+            if key in cached:
+                languages[index], _, results[index] = cached[key].decode().partition("\0")
+                continue
+            try:
+                source_language = detect(text[:DETECTION_SAMPLE_CHARS])
+            except Exception as e:
+                logger.warning("Exception in language detection: %s", e)
+                continue
+            languages[index] = source_language
+            if source_language != self.target_language:
+                by_language[source_language].append(index)
+
+        batches = [
+            (source_language, batch)
+            for source_language, indexes in by_language.items()
+            for batch in _pack_batches([(index, texts[index]) for index in indexes])
+        ]
+        if not batches:
+            return results, languages
+
+        # (text index, piece index) -> translated piece
+        translated_pieces = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for translations in executor.map(
+                lambda batch: self._translate_batch(*batch), batches
+            ):
+                translated_pieces.update(translations)
+
+        new_entries = []
+        for source_language, indexes in by_language.items():
+            for index in indexes:
+                piece_count = len(_split_text(texts[index], MAX_CHARS_PER_REQUEST))
+                pieces = [translated_pieces.get((index, piece)) for piece in range(piece_count)]
+                if None in pieces:
+                    # Part of the text failed to translate, keep the original
+                    continue
+                results[index] = "".join(pieces)
+                new_entries.append(
+                    (keys[index], f"{source_language}\0{results[index]}".encode())
+                )
+        if self.cache:
+            self.cache.set_many(new_entries)
+        return results, languages
+
+    def _translate_batch(
+        self, source_language: str, batch: List[Tuple[Tuple[int, int], str]]
+    ) -> Dict[Tuple[int, int], str]:
+        from azure.ai.translation.text.models import InputTextItem
+
+        try:
+            response = self.client.translate(
+                content=[InputTextItem(text=piece) for _, piece in batch],
+                to=[self.target_language],
+                from_parameter=source_language,
+            )
+        except Exception as e:
+            logger.warning("Exception in translation: %s", e)
+            return {}
+
+        return {
+            piece_id: item.translations[0].text
+            for (piece_id, _), item in zip(batch, response)
+        }
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(
+            f"{CACHE_VERSION}\0{self.target_language}\0{text}".encode()
+        ).hexdigest()
+
+
+def _pack_batches(texts: List[Tuple[int, str]]) -> List[List[Tuple[Tuple[int, int], str]]]:
+    """Pack texts into request batches within the service limits.
+
+    Texts over the character limit are split on paragraph boundaries into
+    pieces that are translated separately and rejoined.
+    """
+    batches, batch, batch_chars = [], [], 0
+    for index, text in texts:
+        for piece_index, piece in enumerate(_split_text(text, MAX_CHARS_PER_REQUEST)):
+            if batch and (
+                len(batch) == MAX_ITEMS_PER_REQUEST
+                or batch_chars + len(piece) > MAX_CHARS_PER_REQUEST
+            ):
+                batches.append(batch)
+                batch, batch_chars = [], 0
+            batch.append(((index, piece_index), piece))
+            batch_chars += len(piece)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _split_text(text: str, max_chars: int) -> List[str]:
+    if len(text) <= max_chars:
+        return [text]
+    pieces, piece = [], ""
+    for paragraph in text.split("\n\n"):
+        paragraph += "\n\n"
+        while len(paragraph) > max_chars:
+            if piece:
+                pieces.append(piece)
+                piece = ""
+            pieces.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if len(piece) + len(paragraph) > max_chars:
+            pieces.append(piece)
+            piece = ""
+        piece += paragraph
+    if piece:
+        pieces.append(piece)
+    # Drop the separator added after the last paragraph
+    pieces[-1] = pieces[-1][:-2]
+    return pieces
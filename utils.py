@@ -1,6 +1,103 @@
+import base64
+import functools
+import hashlib
+import os
+from typing import List, Tuple
+
 from langchain.schema import Document
 
 
+# The encoding of the gpt-3.5-turbo and gpt-4 chat models, as defined by
+# tiktoken_ext.openai_public, whose constructor downloads the ranks itself
+ENCODING_NAME = "cl100k_base"
+ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+_ENCODING_PATTERN = (
+    r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}|"""
+    r""" ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+)
+_ENCODING_SPECIAL_TOKENS = {
+    "<|endoftext|>": 100257,
+    "<|fim_prefix|>": 100258,
+    "<|fim_middle|>": 100259,
+    "<|fim_suffix|>": 100260,
+    "<|endofprompt|>": 100276,
+}
+
+
+def encoding_path() -> str:
+    """Where ``python startup.py`` stores the encoding's ranks for the server."""
+    default = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".tiktoken", f"{ENCODING_NAME}.tiktoken"
+    )
+    return os.environ.get("TIKTOKEN_ENCODING_PATH", default)
+
+
+def load_encoding(path: str):
+    """Build the encoding from a ranks file, without network access."""
+    import tiktoken
+
+    try:
+        with open(path, "rb") as f:
+            contents = f.read()
+    except FileNotFoundError:
+        raise RuntimeError(
+            f"The tiktoken {ENCODING_NAME} encoding is missing from {path}, "
+            "run `python startup.py` to download it"
+        ) from None
+    ranks = {
+        base64.b64decode(token): int(rank)
+        for token, rank in (line.split() for line in contents.splitlines() if line)
+    }
+    return tiktoken.Encoding(
+        name=ENCODING_NAME,
+        pat_str=_ENCODING_PATTERN,
+        mergeable_ranks=ranks,
+        special_tokens=_ENCODING_SPECIAL_TOKENS,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    return load_encoding(encoding_path())
+
+
+def hash_file(file_path: str) -> Tuple[str, int]:
+    """SHA-256 hex digest and size of a file, read in 1 MiB pieces."""
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(file_path, "rb") as file_object:
+        for chunk in iter(lambda: file_object.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+            size += len(chunk)
+    return file_hash.hexdigest(), size
+
+
+def count_tokens(text: str) -> int:
+    return len(_get_encoding().encode(text, disallowed_special=()))
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """Token counts of many texts, encoded in parallel by tiktoken."""
+    return [len(tokens) for tokens in _get_encoding().encode_batch(texts, disallowed_special=())]
+
+
+def split_tokens(text: str, max_tokens: int) -> List[str]:
+    """Split text into consecutive pieces of at most ``max_tokens`` tokens."""
+    tokens = _get_encoding().encode(text, disallowed_special=())
+    return [
+        _get_encoding().decode(tokens[start : start + max_tokens])
+        for start in range(0, len(tokens), max_tokens)
+    ]
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Keep the last ``max_tokens`` tokens of text."""
+    tokens = _get_encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _get_encoding().decode(tokens[len(tokens) - max_tokens :])
+
+
 def stream_event_from_dict(stream_event: dict) -> str:
     return f"data:{stream_event}\n\n"
 
@@ -0,0 +1,305 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+class VectorIndex:
+    """The subset of the Pinecone Index interface the server relies on.
+
+    pinecone.Index provides it natively, LocalVectorIndex implements it
+    in-process, so either can be returned by clients.get_index.
+    """
+
+    def upsert(self, vectors: Sequence[tuple], namespace: str = "", batch_size=None, **kwargs):
+        raise NotImplementedError
+
+    def query(
+        self,
+        vector: Optional[List[float]] = None,
+        top_k: int = 10,
+        namespace: str = "",
+        include_metadata: bool = False,
+        include_values: bool = False,
+        **kwargs,
+    ) -> dict:
+        raise NotImplementedError
+
+    def fetch(self, ids: List[str], namespace: str = "") -> dict:
+        raise NotImplementedError
+
+    def delete(
+        self, ids: Optional[List[str]] = None, delete_all: bool = False, namespace: str = "", **kwargs
+    ):
+        raise NotImplementedError
+
+
+class LocalVectorIndex(VectorIndex):
+    """In-process vector index, one directory per namespace.
+
+    Vectors are kept normalized in a float32 matrix memory-mapped from disk and
+    searched by exact dot product, which at per-user corpus sizes takes well
+    under a millisecond. Ids and metadata live in SQLite next to the matrix.
+    Deleting a vector moves the last row into its slot, so the searched
+    matrix never has holes. At most ``max_open_namespaces`` namespaces keep
+    their files open, the least recently used ones are closed when no call
+    is using them and reopened on their next use.
+    """
+
+    def __init__(self, path: str = "vectors", max_open_namespaces: int = 128):
+        self.path = path
+        self.max_open_namespaces = max_open_namespaces
+        os.makedirs(path, exist_ok=True)
+        self._namespaces: "OrderedDict[str, _Namespace]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors: Sequence[tuple], namespace: str = "", batch_size=None, **kwargs):
+        items = [_vector_tuple(vector) for vector in vectors]
+        if items:
+            with self._namespace(namespace) as namespace_store:
+                namespace_store.upsert(items)
+        return {"upserted_count": len(items)}
+
+    def query(
+        self,
+        vector: Optional[List[float]] = None,
+        top_k: int = 10,
+        namespace: str = "",
+        include_metadata: bool = False,
+        include_values: bool = False,
+        **kwargs,
+    ) -> dict:
+        if vector and isinstance(vector[0], (list, tuple)):
+            # langchain passes a single query wrapped in a list
+            vector = vector[0]
+        with self._namespace(namespace) as namespace_store:
+            matches = namespace_store.query(vector, top_k, include_metadata, include_values)
+        return {"matches": matches, "namespace": namespace}
+
+    def fetch(self, ids: List[str], namespace: str = "") -> dict:
+        with self._namespace(namespace) as namespace_store:
+            vectors = namespace_store.fetch(ids)
+        return {"vectors": vectors, "namespace": namespace}
+
+    def delete(
+        self, ids: Optional[List[str]] = None, delete_all: bool = False, namespace: str = "", **kwargs
+    ):
+        with self._namespace(namespace) as namespace_store:
+            if delete_all:
+                namespace_store.clear()
+            elif ids:
+                namespace_store.delete(ids)
+        return {}
+
+    def close(self) -> None:
+        """Close the files of every open namespace."""
+        with self._lock:
+            namespaces = list(self._namespaces.values())
+            self._namespaces.clear()
+        for namespace_store in namespaces:
+            namespace_store.close()
+
+    @contextmanager
+    def _namespace(self, namespace: str):
+        with self._lock:
+            namespace_store = self._namespaces.get(namespace)
+            if namespace_store is None:
+                # Namespaces are user ids, keep the directory name safe regardless
+                directory = re.sub(r"[^A-Za-z0-9_.-]", "_", namespace) or "_default"
+                namespace_store = _Namespace(os.path.join(self.path, directory))
+                self._namespaces[namespace] = namespace_store
+            self._namespaces.move_to_end(namespace)
+            namespace_store.users += 1
+        try:
+            yield namespace_store
+        finally:
+            with self._lock:
+                namespace_store.users -= 1
+                self._evict()
+
+    def _evict(self) -> None:
+        """Close least recently used namespaces that are not in use, down to the limit."""
+        for namespace in list(self._namespaces):
+            if len(self._namespaces) <= self.max_open_namespaces:
+                break
+            namespace_store = self._namespaces[namespace]
+            if not namespace_store.users:
+                del self._namespaces[namespace]
+                namespace_store.close()
+
+
+class _Namespace:
+    def __init__(self, path: str):
+        # Calls using the namespace, it is only closed when there are none
+        self.users = 0
+        os.makedirs(path, exist_ok=True)
+        self._matrix_path = os.path.join(path, "vectors.f32")
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            os.path.join(path, "metadata.sqlite3"), check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value)")
+        dimension = self._conn.execute(
+            "SELECT value FROM settings WHERE key = 'dimension'"
+        ).fetchone()
+        self._dimension: Optional[int] = dimension[0] if dimension else None
+
+        rows = self._conn.execute("SELECT row, id, metadata FROM vectors ORDER BY row").fetchall()
+        self._ids = [vector_id for _, vector_id, _ in rows]
+        self._metadata = [json.loads(metadata) for _, _, metadata in rows]
+        self._rows = {vector_id: row for row, vector_id in enumerate(self._ids)}
+        self._matrix: Optional[np.memmap] = None
+        if self._dimension is not None and os.path.exists(self._matrix_path):
+            self._open_matrix()
+
+    @property
+    def count(self) -> int:
+        return len(self._ids)
+
+    def upsert(self, items: List[tuple]) -> None:
+        with self._lock:
+            if self._dimension is None:
+                self._dimension = len(items[0][1])
+                self._conn.execute(
+                    "INSERT INTO settings VALUES ('dimension', ?)", (self._dimension,)
+                )
+            values = np.asarray([values for _, values, _ in items], dtype=np.float32)
+            if values.shape[1] != self._dimension:
+                raise ValueError(
+                    f"Vector dimension {values.shape[1]} does not match {self._dimension}"
+                )
+            norms = np.linalg.norm(values, axis=1, keepdims=True)
+            values /= np.where(norms == 0, 1, norms)
+
+            new_ids = [vector_id for vector_id, _, _ in items if vector_id not in self._rows]
+            self._reserve(self.count + len(set(new_ids)))
+            self._conn.execute("BEGIN")
+            for (vector_id, _, metadata), vector in zip(items, values):
+                row = self._rows.get(vector_id)
+                if row is None:
+                    row = self.count
+                    self._rows[vector_id] = row
+                    self._ids.append(vector_id)
+                    self._metadata.append(metadata)
+                else:
+                    self._metadata[row] = metadata
+                self._matrix[row] = vector
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)",
+                    (row, vector_id, json.dumps(metadata)),
+                )
+            self._matrix.flush()
+            self._conn.execute("COMMIT")
+
+    def query(
+        self, vector: List[float], top_k: int, include_metadata: bool, include_values: bool
+    ) -> List[dict]:
+        with self._lock:
+            if not self.count:
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm:
+                query /= norm
+            scores = self._matrix[: self.count] @ query
+            top_k = min(top_k, self.count)
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+            matches = []
+            for row in top:
+                match = {"id": self._ids[row], "score": float(scores[row])}
+                if include_metadata:
+                    match["metadata"] = dict(self._metadata[row])
+                if include_values:
+                    match["values"] = self._matrix[row].tolist()
+                matches.append(match)
+            return matches
+
+    def fetch(self, ids: List[str]) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                vector_id: {
+                    "id": vector_id,
+                    "values": self._matrix[self._rows[vector_id]].tolist(),
+                    "metadata": dict(self._metadata[self._rows[vector_id]]),
+                }
+                for vector_id in ids
+                if vector_id in self._rows
+            }
+
+    def delete(self, ids: List[str]) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for vector_id in ids:
+                row = self._rows.pop(vector_id, None)
+                if row is None:
+                    continue
+                last = self.count - 1
+                self._conn.execute("DELETE FROM vectors WHERE row = ?", (row,))
+                if row != last:
+                    # Fill the hole with the last row
+                    moved_id = self._ids[last]
+                    self._matrix[row] = self._matrix[last]
+                    self._ids[row] = moved_id
+                    self._metadata[row] = self._metadata[last]
+                    self._rows[moved_id] = row
+                    self._conn.execute(
+                        "UPDATE vectors SET row = ? WHERE row = ?", (row, last)
+                    )
+                self._ids.pop()
+                self._metadata.pop()
+            if self._matrix is not None:
+                self._matrix.flush()
+            self._conn.execute("COMMIT")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM vectors")
+            self._ids, self._metadata, self._rows = [], [], {}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._matrix is not None:
+                self._matrix.flush()
+                # The mapping is released with the last reference to it
+                self._matrix = None
+            self._conn.close()
+
+    def _reserve(self, rows: int) -> None:
+        """Grow the matrix file to hold at least ``rows`` vectors."""
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, 1024)
+        if self._matrix is not None:
+            self._matrix.flush()
+            del self._matrix
+        with open(self._matrix_path, "ab") as matrix_file:
+            matrix_file.truncate(capacity * self._dimension * 4)
+        self._open_matrix()
+
+    def _open_matrix(self) -> None:
+        rows = os.path.getsize(self._matrix_path) // (self._dimension * 4)
+        self._matrix = np.memmap(
+            self._matrix_path, dtype=np.float32, mode="r+", shape=(rows, self._dimension)
+        )
+
+
+def _vector_tuple(vector) -> tuple:
+    """(id, values, metadata) from the tuple or dict forms Pinecone accepts."""
+    if isinstance(vector, dict):
+        return vector["id"], vector["values"], vector.get("metadata") or {}
+    if len(vector) == 2:
+        return vector[0], vector[1], {}
+    return vector[0], vector[1], vector[2] or {}